@@ -0,0 +1,231 @@
+# admission.py
+"""
+Admission control for expensive endpoints.
+
+Each endpoint class (OCR, image processing, batch reports) has a `Limiter`
+with a concurrency limit and a bounded wait queue. Waiters are queued per
+company and served round-robin, and while other companies are waiting a
+company may hold only a share of the slots, so one tenant's upload burst
+cannot starve the others (alone, it may use them all). On top of
+that, the `AdmissionController` caps how many expensive requests run at
+once across all classes (the thread budget: the waitress worker threads
+minus a reserve), so logins and catalog reads always find a free worker.
+A queued request holds its waitress thread while it waits, so the budget
+counts running and queued requests alike: once they fill it, further
+expensive requests are turned away instead of queued.
+
+Rejections are immediate:
+    429  the company already has its full share queued
+    503  the thread budget or the class's queue is full, or the wait timed out
+both with a Retry-After estimate from recent service times.
+
+    with controller.admit("ocr", company_id): ...
+"""
+import re
+import math
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+DEFAULT_WORKER_THREADS = 4  # waitress default, used when no waitress workers are running (dev server, tests)
+DEFAULT_RESERVED_THREADS = 1
+WAITRESS_THREAD = re.compile(r"waitress-\d+$")
+DEFAULT_LIMITS = {
+    "ocr": {"max_concurrent": 2, "max_queue": 8, "queue_timeout": 10},
+    "process": {"max_concurrent": 2, "max_queue": 8, "queue_timeout": 15},
+    "batch": {"max_concurrent": 1, "max_queue": 2, "queue_timeout": 5},
+}
+MAX_RETRY_AFTER = 60
+
+def serving_threads():
+    """Number of waitress worker threads in this process (its `threads` setting), or 0 outside waitress."""
+    return sum(1 for thread in threading.enumerate() if WAITRESS_THREAD.match(thread.name))
+
+class _Budget:
+    """
+    Worker threads shared by every limiter of a controller: `used` run,
+    `waiting` are queued. Limiters using it must share its lock.
+    """
+    def __init__(self, slots):
+        self.slots, self.used, self.waiting, self.limiters = slots, 0, 0, []
+
+    def full(self):
+        return self.used + self.waiting >= self.slots
+
+class Rejected(Exception):
+    def __init__(self, status, reason, retry_after):
+        super().__init__(reason)
+        self.status, self.reason, self.retry_after = status, reason, retry_after
+
+class _Waiter:
+    __slots__ = ("company", "event", "granted")
+    def __init__(self, company):
+        self.company, self.event, self.granted = company, threading.Event(), False
+
+class Limiter:
+    def __init__(self, name, max_concurrent, max_queue, queue_timeout=10, company_max_concurrent=None, company_max_queue=None,
+                 budget=None, lock=None):
+        self.name = name
+        self._lock = lock or threading.Lock()
+        self._budget = budget
+        self._running = 0
+        self._company_running = {}
+        self._queues = {}        # company -> deque of waiters
+        self._order = deque()    # companies with waiters, in round-robin order
+        self._waiting = 0
+        self._service_time = 1.0  # EWMA of seconds per admitted request
+        self.rejected = {}
+        self.configure(max_concurrent, max_queue, queue_timeout, company_max_concurrent, company_max_queue)
+
+    def configure(self, max_concurrent, max_queue, queue_timeout=10, company_max_concurrent=None, company_max_queue=None):
+        """Applies new limits; requests already admitted or queued are kept."""
+        with self._lock:
+            self.max_concurrent, self.max_queue, self.queue_timeout = max(1, max_concurrent), max(0, max_queue), queue_timeout
+            # Fair share under contention: by default half the slots and half the queue per company.
+            self.company_max_concurrent = company_max_concurrent or max(1, math.ceil(self.max_concurrent / 2))
+            self.company_max_queue = company_max_queue if company_max_queue is not None else max(1, self.max_queue // 2)
+            self._dispatch()
+
+    def retry_after(self):
+        backlog = self._waiting + self._running
+        return max(1, min(MAX_RETRY_AFTER, math.ceil(self._service_time * backlog / self.max_concurrent)))
+
+    def _reject(self, status, reason):
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        return Rejected(status, reason, self.retry_after())
+
+    def _has_slot(self):
+        return self._running < self.max_concurrent and (self._budget is None or self._budget.used < self._budget.slots)
+
+    def acquire(self, company):
+        with self._lock:
+            if self._budget is not None and self._budget.full():
+                raise self._reject(503, "thread_budget")
+            if self._has_slot() and not self._waiting:
+                self._grant(company); return
+            if self._waiting >= self.max_queue:
+                raise self._reject(503, "queue_full")
+            queue = self._queues.get(company)
+            if queue is not None and len(queue) >= self.company_max_queue:
+                raise self._reject(429, "company_share")
+            waiter = _Waiter(company)
+            if queue is None:
+                queue = self._queues[company] = deque(); self._order.append(company)
+            queue.append(waiter); self._waiting += 1
+            if self._budget is not None: self._budget.waiting += 1
+        waiter.event.wait(self.queue_timeout)
+        with self._lock:
+            if waiter.granted:
+                return
+            queue = self._queues[company]
+            queue.remove(waiter); self._waiting -= 1
+            if self._budget is not None: self._budget.waiting -= 1
+            if not queue:
+                del self._queues[company]; self._order.remove(company)
+            raise self._reject(503, "queue_timeout")
+
+    def release(self, company, duration):
+        with self._lock:
+            self._running -= 1
+            left = self._company_running[company] - 1
+            if left: self._company_running[company] = left
+            else: del self._company_running[company]
+            self._service_time = 0.8 * self._service_time + 0.2 * duration
+            if self._budget is None:
+                self._dispatch()
+            else:
+                # The freed budget slot may go to a waiter of any class; the other classes are offered it first.
+                self._budget.used -= 1
+                limiters = self._budget.limiters
+                i = limiters.index(self)
+                for limiter in limiters[i + 1:] + limiters[:i + 1]: limiter._dispatch()
+
+    def _grant(self, company):
+        self._running += 1
+        self._company_running[company] = self._company_running.get(company, 0) + 1
+        if self._budget is not None: self._budget.used += 1
+
+    def _dispatch(self):
+        """
+        Hands free slots to queued waiters, one company at a time in round-robin
+        order. Companies at their share are skipped unless every waiting company
+        is, so no slot idles while someone is queued.
+        """
+        skipped = 0
+        while self._has_slot() and self._order:
+            company = self._order[0]; self._order.rotate(-1)
+            if self._company_running.get(company, 0) >= self.company_max_concurrent and skipped < len(self._order):
+                skipped += 1; continue
+            skipped = 0
+            queue = self._queues[company]
+            waiter = queue.popleft(); self._waiting -= 1
+            if self._budget is not None: self._budget.waiting -= 1
+            if not queue:
+                del self._queues[company]; self._order.remove(company)
+            self._grant(company)
+            waiter.granted = True; waiter.event.set()
+
+    def snapshot(self):
+        with self._lock:
+            return {"running": self._running, "waiting": self._waiting, "max_concurrent": self.max_concurrent,
+                    "max_queue": self.max_queue, "company_max_concurrent": self.company_max_concurrent,
+                    "company_max_queue": self.company_max_queue, "queue_timeout": self.queue_timeout,
+                    "companies_waiting": {company: len(queue) for company, queue in self._queues.items()},
+                    "avg_service_seconds": round(self._service_time, 3), "rejected": dict(self.rejected)}
+
+class AdmissionController:
+    def __init__(self):
+        self.limiters = {}
+        self._lock = threading.Lock()  # Shared by all limiters, so a freed budget slot can be handed across classes.
+        self._budget = _Budget(DEFAULT_WORKER_THREADS - DEFAULT_RESERVED_THREADS)
+        self._worker_threads = self._reserved = None
+        self.configure()
+
+    @property
+    def thread_budget(self):
+        return self._budget.slots
+
+    def configure(self, worker_threads=None, reserved_threads=None, limits=None):
+        """
+        (Re)applies settings; `limits` overrides DEFAULT_LIMITS per class.
+        Without `worker_threads`, the budget follows the waitress `threads`
+        setting, read from the running workers on first use.
+        """
+        self._worker_threads = worker_threads
+        self._reserved = DEFAULT_RESERVED_THREADS if reserved_threads is None else reserved_threads
+        self._apply_budget(worker_threads or serving_threads() or DEFAULT_WORKER_THREADS)
+        for name, defaults in DEFAULT_LIMITS.items():
+            overrides = (limits or {}).get(name) or {}
+            settings = {**defaults, **{k: v for k, v in overrides.items() if v is not None}}
+            if name in self.limiters:
+                self.limiters[name].configure(**settings)
+            else:
+                self.limiters[name] = Limiter(name, **settings, budget=self._budget, lock=self._lock)
+                self._budget.limiters.append(self.limiters[name])
+
+    def _apply_budget(self, worker_threads):
+        self._detected = worker_threads
+        with self._lock:
+            self._budget.slots = max(1, worker_threads - self._reserved)
+            for limiter in self._budget.limiters: limiter._dispatch()
+
+    @contextmanager
+    def admit(self, endpoint_class, company):
+        """Holds a slot of `endpoint_class` for the block; raises Rejected when over limits."""
+        if not self._worker_threads:
+            # The app is imported before waitress starts its workers; pick up their count once they serve.
+            threads = serving_threads()
+            if threads and threads != self._detected: self._apply_budget(threads)
+        limiter = self.limiters[endpoint_class]
+        limiter.acquire(company)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            limiter.release(company, time.perf_counter() - started)
+
+    def snapshot(self):
+        return {"worker_threads": self._detected, "thread_budget": self._budget.slots, "in_flight": self._budget.used,
+                "queued": self._budget.waiting,
+                "classes": {name: limiter.snapshot() for name, limiter in self.limiters.items()}}
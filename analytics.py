@@ -0,0 +1,142 @@
+# analytics.py
+"""
+Usage and COGS rollups keyed by company, period (day/week/month), printer,
+material and brand. `apply_job` runs inside the job-processing transaction,
+so reads from `usage_rollups` never need to scan job history.
+"""
+import os
+import json
+import uuid
+import argparse
+from datetime import datetime, timedelta
+
+from costing import parse_time_string
+from database import insert_row
+
+PERIOD_TYPES = ("day", "week", "month")
+DIMENSIONS = ("period_start", "printer_id", "material", "brand")
+MEASURES = ("job_count", "filament_g", "time_h", "labour_time_min", "user_cogs", "default_cogs")
+
+def period_starts(timestamp):
+    """Maps an ISO timestamp to the start key of its day, ISO week (Monday) and month."""
+    dt = datetime.fromisoformat(str(timestamp).replace('Z', ''))
+    return {
+        "day": dt.strftime("%Y-%m-%d"),
+        "week": (dt - timedelta(days=dt.weekday())).strftime("%Y-%m-%d"),
+        "month": dt.strftime("%Y-%m"),
+    }
+
+def _upsert(conn, job, values):
+    rows = [(job["company_id"], period_type, start, job.get("printer_id") or "", job.get("material") or "",
+             job.get("brand") or "") + values
+            for period_type, start in period_starts(job["timestamp"]).items()]
+    conn.executemany("""
+        INSERT INTO usage_rollups (company_id, period_type, period_start, printer_id, material, brand,
+                                   job_count, filament_g, time_h, labour_time_min, user_cogs, default_cogs)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (company_id, period_type, period_start, printer_id, material, brand) DO UPDATE SET
+            job_count = job_count + excluded.job_count, filament_g = filament_g + excluded.filament_g,
+            time_h = time_h + excluded.time_h, labour_time_min = labour_time_min + excluded.labour_time_min,
+            user_cogs = user_cogs + excluded.user_cogs, default_cogs = default_cogs + excluded.default_cogs""", rows)
+
+def apply_job(conn, job, sign=1):
+    """Adds a job's measures to every rollup it falls into (sign=-1 removes them). Does not commit."""
+    _upsert(conn, job, (sign, sign * (job.get("filament_g") or 0), sign * (job.get("time_h") or 0),
+                        sign * (job.get("labour_time_min") or 0), sign * (job.get("user_cogs") or 0),
+                        sign * (job.get("default_cogs") or 0)))
+
+def apply_cogs_delta(conn, job, user_delta, default_delta):
+    """Shifts only the COGS sums of a job's rollups, used when a job is re-costed. Does not commit."""
+    _upsert(conn, job, (0, 0, 0, 0, user_delta, default_delta))
+
+def query_usage(conn, company_id, period_type="month", start=None, end=None, filters=None, group_by=DIMENSIONS):
+    """Reads rollups for one period type, optionally filtered and re-grouped along fewer dimensions."""
+    if period_type not in PERIOD_TYPES:
+        raise ValueError(f"period must be one of {', '.join(PERIOD_TYPES)}")
+    group_by = [d for d in group_by if d in DIMENSIONS]
+    where, params = ["company_id = ?", "period_type = ?"], [company_id, period_type]
+    if start: where.append("period_start >= ?"); params.append(start)
+    if end: where.append("period_start <= ?"); params.append(end)
+    for column, value in (filters or {}).items():
+        if column in DIMENSIONS and value is not None:
+            where.append(f"{column} = ?"); params.append(value)
+    select = ", ".join(list(group_by) + [f"SUM({m}) AS {m}" for m in MEASURES])
+    sql = f"SELECT {select} FROM usage_rollups WHERE {' AND '.join(where)}"
+    if group_by:
+        sql += f" GROUP BY {', '.join(group_by)} ORDER BY {', '.join(group_by)}"
+    return [dict(row) for row in conn.execute(sql, params) if row["job_count"]]
+
+def import_legacy_app_logs(conn, company_id, company_dir):
+    """
+    Creates job records for app_logs.json entries written before jobs were
+    stored in the database, so rollups and other job-based features cover
+    the full history. Entries already present (same filename and timestamp)
+    are skipped. Does not commit.
+    """
+    log_path = os.path.join(company_dir, "app_logs.json")
+    if not os.path.exists(log_path):
+        return 0
+    with open(log_path, 'r') as f:
+        content = f.read(); entries = json.loads(content) if content else []
+    printers = conn.execute("SELECT id, brand, model FROM printers WHERE company_id = ?", (company_id,)).fetchall()
+    printer_ids = {}
+    for p in printers:
+        printer_ids[(p['model'] or '').lower()] = p['id']
+        printer_ids[f"{p['brand'] or ''} {p['model'] or ''}".strip().lower()] = p['id']
+
+    imported = 0
+    for entry in entries:
+        if entry.get("job_id"):
+            continue
+        exists = conn.execute("SELECT 1 FROM jobs WHERE company_id = ? AND filename = ? AND timestamp = ?",
+                              (company_id, entry["filename"], entry["timestamp"])).fetchone()
+        if exists:
+            continue
+        data = entry.get("data", {})
+        time_str = data.get("Time") or "0h 0m"
+        job = {
+            "id": str(uuid.uuid4()), "company_id": company_id, "filename": entry["filename"], "source_name": None,
+            "timestamp": entry["timestamp"], "printer_id": printer_ids.get(str(data.get("Printer", "")).lower()),
+            "printer_name": data.get("Printer"), "material": data.get("Material"), "brand": data.get("Brand"),
+            "filament_g": float(data.get("Filament (g)") or 0), "time_str": time_str, "time_h": parse_time_string(time_str),
+            "labour_time_min": 0.0, "labour_rate_hr": 0.0, "user_cogs": float(data.get("User COGS (₹)") or 0),
+            "default_cogs": float(data.get("Default COGS (₹)") or 0), "image_path": entry.get("image_path"),
+            "created_at": datetime.utcnow().isoformat(),
+        }
+        insert_row(conn, "jobs", job)
+        imported += 1
+    return imported
+
+def rebuild_rollups(conn, company_id):
+    """Recomputes a company's rollups from its job records. Does not commit."""
+    conn.execute("DELETE FROM usage_rollups WHERE company_id = ?", (company_id,))
+    count = 0
+    for row in conn.execute("SELECT * FROM jobs WHERE company_id = ?", (company_id,)).fetchall():
+        apply_job(conn, dict(row)); count += 1
+    return count
+
+if __name__ == "__main__":
+    from database import get_db_connection, get_company_db_connection, init_db
+    parser = argparse.ArgumentParser(description="Maintenance for the usage/COGS analytics rollups.")
+    parser.add_argument("command", choices=["rebuild"])
+    parser.add_argument("--company", help="Limit to one company id (default: all companies)")
+    parser.add_argument("--skip-legacy", action="store_true", help="Do not import legacy app_logs.json entries")
+    args = parser.parse_args()
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    os.chdir(script_dir)
+    init_db(script_dir)
+    directory = get_db_connection()
+    company_ids = [args.company] if args.company else [row['id'] for row in directory.execute("SELECT id FROM companies")]
+    directory.close()
+    for cid in company_ids:
+        conn = get_company_db_connection(cid)
+        try:
+            imported = 0 if args.skip_legacy else import_legacy_app_logs(conn, cid, os.path.join(script_dir, "data", cid))
+            jobs = rebuild_rollups(conn, cid)
+            conn.commit()
+            print(f"{cid}: imported {imported} legacy job(s), rolled up {jobs} job(s)")
+        except Exception:
+            conn.rollback(); raise
+        finally:
+            conn.close()
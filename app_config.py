@@ -0,0 +1,144 @@
+# app_config.py
+"""
+Validated, hot-reloading server configuration.
+
+`server_config.json` is parsed and validated (validators.ServerConfigModel)
+once into an immutable snapshot. Readers take `store.current()`, a single
+reference read, so a reload is an atomic swap and a request never sees a
+half-applied change. The file is read only at startup, when a watcher thread
+sees its mtime or size change, and after `save()`, which validates before
+anything is written. Invalid content is rejected and the previous snapshot
+stays in effect.
+
+    store = app_config.ConfigStore("server_config.json", defaults)
+    store.load(); store.watch()
+    store.current().get("TEMPLATE_PATH")
+"""
+import os
+import json
+import time
+import logging
+import threading
+from types import MappingProxyType
+
+from pydantic import ValidationError
+from validators import ServerConfigModel, error_list
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RELOAD_INTERVAL = 2.0
+
+class ConfigError(ValueError):
+    """Invalid configuration; `errors` is a list of {"field", "message"} dicts."""
+    def __init__(self, message, errors=()):
+        super().__init__(message)
+        self.errors = list(errors)
+
+def freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+def thaw(value):
+    """Plain dicts/lists from a snapshot, e.g. for JSON responses."""
+    if isinstance(value, MappingProxyType):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(v) for v in value]
+    return value
+
+def validate(data, defaults=None):
+    """Validated plain dict (defaults filled in for missing keys); raises ConfigError."""
+    if not isinstance(data, dict):
+        raise ConfigError("Settings must be a JSON object.", [{"field": "", "message": "Expected an object"}])
+    try:
+        model = ServerConfigModel(**{**(defaults or {}), **data})
+    except ValidationError as e:
+        errors = error_list(e)
+        raise ConfigError("Invalid settings: " + "; ".join(f"{err['field']}: {err['message']}" for err in errors), errors)
+    return model.model_dump(exclude_unset=True)
+
+class ConfigStore:
+    def __init__(self, path, defaults=None):
+        self.path, self.defaults = path, dict(defaults or {})
+        self._snapshot = freeze(dict(self.defaults))
+        self._file_stamp = None
+        self._write_lock = threading.Lock()
+        self._listeners = []
+        self._watcher = None
+
+    def current(self):
+        return self._snapshot
+
+    def on_change(self, fn):
+        """`fn(old, new)` runs after every swap, on the thread that made it."""
+        self._listeners.append(fn)
+
+    def _stamp(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            return None
+
+    def _swap(self, data, stamp):
+        old, self._snapshot = self._snapshot, freeze(data)
+        self._file_stamp = stamp
+        for fn in self._listeners:
+            try: fn(old, self._snapshot)
+            except Exception: logger.exception("Config change listener failed")
+
+    def load(self):
+        """Reads and validates the file; keeps the current snapshot (and raises ConfigError) if it is invalid."""
+        with self._write_lock:
+            stamp = self._stamp()
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f: raw = json.load(f)
+            except FileNotFoundError:
+                raw = {}
+            except json.JSONDecodeError as e:
+                self._file_stamp = stamp  # Do not retry the same broken file on every poll.
+                raise ConfigError(f"{self.path} is not valid JSON: {e}", [{"field": "", "message": str(e)}])
+            try:
+                data = validate(raw, self.defaults)
+            except ConfigError:
+                self._file_stamp = stamp
+                raise
+            self._swap(data, stamp)
+            return self._snapshot
+
+    def save(self, data):
+        """Validates, writes atomically and swaps in the new snapshot; nothing is written if validation fails."""
+        validated = validate(data, self.defaults)
+        with self._write_lock:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(validated, f, indent=4)
+            os.replace(tmp_path, self.path)
+            self._swap(validated, self._stamp())
+        return self._snapshot
+
+    def check_for_changes(self):
+        """Reloads if the file changed on disk since the last load or save. Returns True if it reloaded."""
+        if self._stamp() == self._file_stamp:
+            return False
+        try:
+            self.load()
+            logger.info(f"Reloaded {self.path}")
+            return True
+        except ConfigError as e:
+            logger.error(f"Ignoring changed {self.path}; keeping the previous settings. {e}")
+            return False
+
+    def watch(self, interval=None):
+        """Starts (once) a daemon thread that polls the file's mtime."""
+        if self._watcher is not None:
+            return
+        def poll():
+            while True:
+                time.sleep(interval or self._snapshot.get("CONFIG_RELOAD_INTERVAL") or DEFAULT_RELOAD_INTERVAL)
+                try: self.check_for_changes()
+                except Exception: logger.exception("Config watcher failed")
+        self._watcher = threading.Thread(target=poll, name="config-watcher", daemon=True)
+        self._watcher.start()
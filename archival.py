@@ -0,0 +1,269 @@
+# archival.py
+"""
+Tiered archival of old job artifacts in data/<company_id>/.
+
+Images: blobs in the image store whose file is older than `image_age_days`
+are recompressed to WebP (<sha256>.webp next to the original) and the
+original is removed. The hash stays the blob's identity, so names, job
+records and pinned URLs are unchanged; image_store.stored_path serves the
+archived file. Legacy files in local_log_images are moved into the store
+first.
+
+Workbooks: per-job workbooks in Excel_Logs from closed months (the month
+ended more than `month_grace_days` ago) are packed into one ZIP per month,
+Archive/Excel_Logs_<year>_<Month>.zip, and listed in the `archived_files`
+table. ZIP keeps a central directory, so `read_archived_file` opens a
+single member without reading the rest. Monthly master logs stay in place
+because re-costing rewrites them.
+
+Every step is restartable: an archive is written to a temp file and
+swapped in, the index is committed, and only then are the source files
+removed. A file changed after it was packed is left on disk and, being
+newer, wins over the archived copy until the next run repacks it.
+
+    python archival.py [--company ID] [--image-age-days 90] [--month-grace-days 7]
+"""
+import os
+import time
+import zipfile
+import logging
+import argparse
+import threading
+from datetime import datetime, timedelta
+from contextlib import nullcontext
+from PIL import Image
+
+import image_store
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = "Archive"
+EXCEL_DIR = "Excel_Logs"
+KIND_EXCEL_LOG = "excel_log"
+ARCHIVE_IMAGE_EXT = ".webp"
+DEFAULT_IMAGE_AGE_DAYS = 90
+DEFAULT_IMAGE_QUALITY = 80
+DEFAULT_MONTH_GRACE_DAYS = 7
+# Formats that are already compact; recompressing them would only lose quality.
+COMPACT_IMAGE_EXTS = {".webp", ".jpg", ".jpeg"}
+
+def _now():
+    return datetime.utcnow().isoformat()
+
+# --- IMAGES ---
+
+def _recompress(source_path, target_path, quality):
+    """Writes a WebP copy of `source_path`; returns its size, or None if it is not smaller than the original."""
+    tmp_path = f"{target_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with Image.open(source_path) as img:
+            if img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGBA" if "transparency" in img.info else "RGB")
+            img.save(tmp_path, "WEBP", quality=quality, method=6, lossless=quality >= 100)
+        size = os.path.getsize(tmp_path)
+        if size >= os.path.getsize(source_path):
+            os.remove(tmp_path); return None
+        os.replace(tmp_path, target_path)
+        return size
+    except Exception:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        raise
+
+def archive_images(conn, company_id, company_dir, image_age_days=DEFAULT_IMAGE_AGE_DAYS, quality=DEFAULT_IMAGE_QUALITY):
+    """
+    Recompresses image blobs last used more than `image_age_days` ago: by the
+    newest job referencing them (its timestamp or, if later, when it was
+    recorded), else the file's mtime. Returns counts for reporting.
+    """
+    stats = {"legacy_images_migrated": image_store.migrate_legacy_images(conn, company_id, company_dir),
+             "images_archived": 0, "images_skipped": 0, "image_bytes_saved": 0}
+    blob_root = os.path.join(company_dir, image_store.BLOB_DIR)
+    cutoff = time.time() - image_age_days * 86400
+    rows = conn.execute("""
+        SELECT b.hash, b.ext, NULLIF(MAX(COALESCE(MAX(j.timestamp), ''), COALESCE(MAX(j.created_at), '')), '') AS last_used FROM image_blobs b
+        LEFT JOIN jobs j ON j.company_id = b.company_id AND j.image_hash = b.hash
+        WHERE b.company_id = ? AND b.refcount > 0 GROUP BY b.hash, b.ext""", (company_id,)).fetchall()
+    for row in rows:
+        if row['ext'] in COMPACT_IMAGE_EXTS:
+            continue
+        original = image_store.blob_path(blob_root, row['hash'], row['ext'])
+        try:
+            st = os.stat(original)
+        except FileNotFoundError:
+            continue  # Already archived.
+        try: last_used = datetime.fromisoformat(row['last_used']).timestamp()
+        except (TypeError, ValueError): last_used = st.st_mtime
+        if last_used > cutoff:
+            continue
+        try:
+            size = _recompress(original, image_store.blob_path(blob_root, row['hash'], ARCHIVE_IMAGE_EXT), quality)
+        except Exception as e:
+            logger.warning(f"Archival: could not recompress {original}: {e}"); stats["images_skipped"] += 1; continue
+        if size is None:
+            stats["images_skipped"] += 1; continue
+        conn.execute("UPDATE image_blobs SET archived_ext = ? WHERE company_id = ? AND hash = ?", (ARCHIVE_IMAGE_EXT, company_id, row['hash']))
+        conn.commit()
+        image_store.remove_variants(blob_root, row['hash'], row['ext'])
+        try:
+            os.remove(original)
+        except OSError as e:
+            # e.g. still open for a download on Windows; stored_path keeps serving it and the next run retries.
+            logger.warning(f"Archival: could not remove {original}: {e}"); continue
+        stats["images_archived"] += 1; stats["image_bytes_saved"] += st.st_size - size
+    return stats
+
+# --- WORKBOOKS ---
+
+def _period(dt):
+    return f"{dt.year}_{dt.strftime('%B')}"
+
+def _closed_before(now, grace_days):
+    """First day of the oldest month that is not closed yet: months before it are archived."""
+    return (now - timedelta(days=grace_days)).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+def archive_path(company_dir, period):
+    return os.path.join(company_dir, ARCHIVE_DIR, f"Excel_Logs_{period}.zip")
+
+def _workbook_months(conn, company_id, excel_dir):
+    """{filename: month start} for the workbooks in Excel_Logs: the job's timestamp, else the file's mtime."""
+    job_times = {}
+    for row in conn.execute("SELECT excel_path, MAX(timestamp) AS ts FROM jobs WHERE company_id = ? AND excel_path IS NOT NULL GROUP BY excel_path",
+                            (company_id,)):
+        job_times[os.path.basename(row['excel_path'])] = row['ts']
+    months = {}
+    for entry in os.scandir(excel_dir):
+        if not entry.is_file() or not entry.name.lower().endswith(".xlsx"):
+            continue
+        try: dt = datetime.fromisoformat(job_times[entry.name])
+        except (KeyError, TypeError, ValueError): dt = datetime.fromtimestamp(entry.stat().st_mtime)
+        months[entry.name] = dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+    return months
+
+def _pack_month(conn, company_id, company_dir, period, names, excel_dir):
+    """Rewrites the month's archive with its existing members plus `names`; returns {name: (size, mtime_ns)} packed from disk."""
+    path = archive_path(company_dir, period)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    packed = {}
+    try:
+        with zipfile.ZipFile(tmp_path, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=9) as out:
+            if os.path.exists(path):
+                with zipfile.ZipFile(path) as old:
+                    for info in old.infolist():
+                        if info.filename not in names: out.writestr(info, old.read(info))
+            for name in sorted(names):
+                source = os.path.join(excel_dir, name)
+                st = os.stat(source)
+                out.write(source, arcname=name)
+                packed[name] = (st.st_size, st.st_mtime_ns)
+        with zipfile.ZipFile(tmp_path) as check:
+            if check.testzip() is not None: raise zipfile.BadZipFile(f"Corrupt member in {tmp_path}")
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        raise
+    relative = os.path.relpath(path, company_dir)
+    conn.executemany("INSERT OR REPLACE INTO archived_files (company_id, kind, name, archive, size, period, archived_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     [(company_id, KIND_EXCEL_LOG, name, relative, size, period, _now()) for name, (size, _) in packed.items()])
+    conn.commit()
+    return packed
+
+def archive_workbooks(conn, company_id, company_dir, month_grace_days=DEFAULT_MONTH_GRACE_DAYS, lock=None, now=None):
+    """
+    Packs closed months' per-job workbooks into monthly archives. `lock`
+    (e.g. the company's file lock) is held while sources are removed, so a
+    workbook being rewritten by a job is never deleted. Returns counts.
+    """
+    stats = {"workbooks_archived": 0, "workbook_bytes_packed": 0, "archives_written": 0}
+    excel_dir = os.path.join(company_dir, EXCEL_DIR)
+    if not os.path.isdir(excel_dir):
+        return stats
+    cutoff = _closed_before(now or datetime.now(), month_grace_days)
+    by_period = {}
+    for name, month in _workbook_months(conn, company_id, excel_dir).items():
+        if month < cutoff: by_period.setdefault(_period(month), set()).add(name)
+    for period, names in sorted(by_period.items()):
+        packed = _pack_month(conn, company_id, company_dir, period, names, excel_dir)
+        stats["archives_written"] += 1
+        with lock or nullcontext():
+            for name, (size, mtime_ns) in packed.items():
+                source = os.path.join(excel_dir, name)
+                try:
+                    st = os.stat(source)
+                    if (st.st_size, st.st_mtime_ns) != (size, mtime_ns): continue  # Rewritten since it was packed.
+                    os.remove(source)
+                except OSError as e:
+                    logger.warning(f"Archival: could not remove {source}: {e}"); continue
+                stats["workbooks_archived"] += 1; stats["workbook_bytes_packed"] += size
+    return stats
+
+def read_archived_file(conn, company_id, company_dir, kind, name):
+    """Contents of an archived file, or None if it is not in the index."""
+    row = conn.execute("SELECT archive FROM archived_files WHERE company_id = ? AND kind = ? AND name = ?", (company_id, kind, name)).fetchone()
+    if not row:
+        return None
+    path = os.path.join(company_dir, row['archive'])
+    try:
+        with zipfile.ZipFile(path) as archive:
+            return archive.read(name)
+    except (FileNotFoundError, KeyError):
+        logger.error(f"Archival: {name} is indexed in {path} but missing from it")
+        return None
+
+# --- RUNS ---
+
+_run_locks = {}
+_run_locks_guard = threading.Lock()
+
+def _run_lock(company_id):
+    """Serializes archival passes of one company in this process (scheduled and on-demand)."""
+    with _run_locks_guard:
+        return _run_locks.setdefault(company_id, threading.Lock())
+
+def run(conn, company_id, company_dir, settings=None, lock=None):
+    """One archival pass for a company. `settings` uses the ARCHIVE_* server settings."""
+    setting = lambda key, default: default if (settings or {}).get(key) is None else settings[key]
+    with _run_lock(company_id):
+        stats = archive_images(conn, company_id, company_dir, setting("ARCHIVE_IMAGE_AGE_DAYS", DEFAULT_IMAGE_AGE_DAYS),
+                               setting("ARCHIVE_IMAGE_QUALITY", DEFAULT_IMAGE_QUALITY))
+        stats.update(archive_workbooks(conn, company_id, company_dir, setting("ARCHIVE_MONTH_GRACE_DAYS", DEFAULT_MONTH_GRACE_DAYS), lock))
+    return stats
+
+def schedule(interval_hours, job):
+    """
+    Starts a daemon thread that calls `job()` every `interval_hours()` hours
+    (read before each sleep, so a settings change applies to the next wait).
+    A falsy interval pauses the schedule, checking again hourly.
+    """
+    def loop():
+        while True:
+            hours = interval_hours()
+            time.sleep((hours or 1) * 3600)
+            if not hours: continue
+            try: job()
+            except Exception: logger.exception("Scheduled archival failed")
+    thread = threading.Thread(target=loop, name="archival", daemon=True)
+    thread.start()
+    return thread
+
+if __name__ == "__main__":
+    from database import get_db_connection, get_company_db_connection, init_db
+    parser = argparse.ArgumentParser(description="Recompress old job images and pack closed months' workbooks.")
+    parser.add_argument("--company", help="Limit to one company id (default: all companies)")
+    parser.add_argument("--image-age-days", type=int, default=DEFAULT_IMAGE_AGE_DAYS)
+    parser.add_argument("--image-quality", type=int, default=DEFAULT_IMAGE_QUALITY, help="WebP quality; 100 = lossless")
+    parser.add_argument("--month-grace-days", type=int, default=DEFAULT_MONTH_GRACE_DAYS)
+    args = parser.parse_args()
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    os.chdir(script_dir)
+    init_db(script_dir)
+    directory = get_db_connection()
+    company_ids = [args.company] if args.company else [row['id'] for row in directory.execute("SELECT id FROM companies")]
+    directory.close()
+    settings = {"ARCHIVE_IMAGE_AGE_DAYS": args.image_age_days, "ARCHIVE_IMAGE_QUALITY": args.image_quality,
+                "ARCHIVE_MONTH_GRACE_DAYS": args.month_grace_days}
+    for cid in company_ids:
+        conn = get_company_db_connection(cid)
+        try: print(f"{cid}: {run(conn, cid, os.path.join(script_dir, 'data', cid), settings)}")
+        finally: conn.close()
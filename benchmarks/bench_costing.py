@@ -0,0 +1,72 @@
+# benchmarks/bench_costing.py
+"""
+Benchmarks the vectorized batch COGS engine against the scalar per-job
+functions and checks that both give bit-identical results.
+
+    python benchmarks/bench_costing.py --jobs 500 --printers 20 --filaments 10 --labour-rates 1
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import costing
+
+def synthetic_inputs(n_jobs, n_printers, n_filaments, seed=42):
+    rng = random.Random(seed)
+    jobs = [{"Filament (g)": round(rng.uniform(1, 800), 2), "Time (e.g. 7h 30m)": f"{rng.randint(0, 30)}h {rng.randint(0, 59)}m",
+             "Labour Time (min)": rng.randint(0, 120)} for _ in range(n_jobs)]
+    printers = [{"id": f"p{i}", "setup_cost": rng.uniform(15000, 250000), "maintenance_cost": rng.uniform(1000, 10000),
+                 "lifetime_years": rng.randint(1, 8), "power_w": rng.uniform(100, 1200), "price_kwh": rng.uniform(5, 12),
+                 "buffer_factor": rng.uniform(1.0, 1.5), "uptime_percent": rng.uniform(10, 90)} for i in range(n_printers)]
+    filaments = [{"material": f"M{i}", "brand": "B", "price": rng.uniform(600, 4000),
+                  "efficiency_factor": rng.uniform(1.0, 1.3)} for i in range(n_filaments)]
+    return jobs, printers, filaments
+
+def scalar_cogs(jobs, printers, filaments, labour_rates):
+    user = np.empty((len(jobs), len(printers), len(filaments), len(labour_rates)))
+    default = np.empty((len(jobs), len(printers), len(filaments)))
+    for ji, job in enumerate(jobs):
+        for pi, printer in enumerate(printers):
+            for fi, filament in enumerate(filaments):
+                for li, rate in enumerate(labour_rates):
+                    cogs = costing.calculate_cogs_values({**job, "Labour Rate (₹/hr)": rate}, printer, filament)
+                    user[ji, pi, fi, li] = cogs["user_cogs"]
+                default[ji, pi, fi] = cogs["default_cogs"]
+    return user, default
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--jobs", type=int, default=500)
+    parser.add_argument("--printers", type=int, default=20)
+    parser.add_argument("--filaments", type=int, default=10)
+    parser.add_argument("--labour-rates", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    jobs, printers, filaments = synthetic_inputs(args.jobs, args.printers, args.filaments)
+    labour_rates = [100 + 25 * i for i in range(args.labour_rates)]
+    scenarios = args.jobs * args.printers * args.filaments * args.labour_rates
+
+    t0 = time.perf_counter(); s_user, s_default = scalar_cogs(jobs, printers, filaments, labour_rates)
+    scalar_s = time.perf_counter() - t0
+
+    batch_times = []
+    for _ in range(args.repeat):
+        t0 = time.perf_counter(); b_user, b_default = costing.batch_cogs(jobs, printers, filaments, labour_rates)
+        batch_times.append(time.perf_counter() - t0)
+    batch_s = min(batch_times)
+
+    exact = np.array_equal(s_user, b_user) and np.array_equal(s_default, b_default)
+    print(f"scenarios:        {scenarios:,}")
+    print(f"scalar:           {scalar_s * 1000:10.2f} ms  ({scalar_s / scenarios * 1e9:8.1f} ns/scenario)")
+    print(f"batch (best of {args.repeat}): {batch_s * 1000:8.2f} ms  ({batch_s / scenarios * 1e9:8.1f} ns/scenario)")
+    print(f"speedup:          {scalar_s / batch_s:10.1f}x")
+    print(f"bit-identical:    {exact}")
+    sys.exit(0 if exact else 1)
+
+if __name__ == "__main__":
+    main()
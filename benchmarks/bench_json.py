@@ -0,0 +1,60 @@
+# benchmarks/bench_json.py
+"""
+Serialization CPU and transfer size of the /logs payload: the stdlib JSON
+provider against orjson (one-shot and streamed), each compressed with gzip
+and, when the brotli package is installed, brotli.
+
+    python benchmarks/bench_json.py --entries 20000 [--rounds 5]
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from flask import Flask
+import json_output
+
+def synthetic_logs(n_entries, seed=7):
+    rng = random.Random(seed)
+    materials = ["PLA", "PETG", "ABS", "TPU", "ASA"]
+    return [{"job_id": f"{i:08x}", "filename": f"job_{i}.png", "timestamp": f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T10:00:00",
+             "data": {"Part Number": f"PN-{rng.randint(1000, 9999)}", "Material": rng.choice(materials), "Filament (g)": f"{rng.uniform(5, 900):.2f}",
+                      "Time (h)": f"{rng.uniform(0.2, 40):.2f}", "User COGS (₹)": f"{rng.uniform(20, 4000):.2f}",
+                      "Default COGS (₹)": f"{rng.uniform(20, 4000):.2f}", "Printer": f"Printer {rng.randint(1, 12)}"}}
+            for i in range(n_entries)]
+
+def best_of(rounds, fn):
+    best, result = None, None
+    for _ in range(rounds):
+        t0 = time.perf_counter(); result = fn(); elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", type=int, default=20000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    logs = synthetic_logs(args.entries)
+    app = Flask(__name__)
+    providers = [("stdlib", json_output.create_provider(app, "stdlib"))]
+    if json_output.orjson is not None: providers.append(("orjson", json_output.create_provider(app, "orjson")))
+    encodings = ["gzip"] + (["br"] if json_output.brotli is not None else [])
+
+    print(f"{'provider':<18} {'encode ms':>10} {'bytes':>12}" + "".join(f" {enc + ' ms':>10} {enc + ' bytes':>12}" for enc in encodings))
+    for name, provider in providers:
+        variants = [(name, lambda: [json_output.encode(provider, logs)]),
+                    (name + " streamed", lambda: list(json_output._iter_chunks(provider, logs)))]
+        for label, encode in variants:
+            elapsed, chunks = best_of(args.rounds, encode)
+            row = f"{label:<18} {elapsed * 1000:10.1f} {sum(map(len, chunks)):12,}"
+            for encoding in encodings:
+                c_elapsed, compressed = best_of(args.rounds, lambda: b"".join(json_output._compressed_stream(iter(chunks), encoding)))
+                row += f" {c_elapsed * 1000:10.1f} {len(compressed):12,}"
+            print(row)
+
+if __name__ == "__main__":
+    main()
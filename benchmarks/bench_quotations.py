@@ -0,0 +1,50 @@
+# benchmarks/bench_quotations.py
+"""
+Quotation throughput (quotes/sec): one PDF per call, a batch into a single
+multi-document PDF, and a batch into a zip of PDFs.
+
+    python benchmarks/bench_quotations.py --quotes 200 --parts 5 [--itemized] [--logo path.png]
+"""
+import os
+import sys
+import time
+import random
+import argparse
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import quotations
+
+def synthetic_quotes(n_quotes, n_parts, itemized, seed=7):
+    rng = random.Random(seed)
+    company = {"name": "FabraForma", "address": "12 Industrial Estate, Pune", "contact": "sales@fabraforma.example"}
+    return [{"customer_name": f"Customer {i}", "customer_company": f"Company {i}", "itemized": itemized,
+             "parts": [{"name": f"Part {i}-{j}", "cogs": round(rng.uniform(20, 2000), 2)} for j in range(n_parts)],
+             "margin_percent": 25, "tax_rate_percent": 18, "company_details": company} for i in range(n_quotes)]
+
+def timed(label, n_quotes, fn):
+    buffer = BytesIO()
+    t0 = time.perf_counter(); fn(buffer); elapsed = time.perf_counter() - t0
+    print(f"{label:<28} {n_quotes / elapsed:10.1f} quotes/sec   {elapsed * 1000:9.1f} ms   {len(buffer.getvalue()) / 1024:9.1f} KiB")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quotes", type=int, default=200)
+    parser.add_argument("--parts", type=int, default=5)
+    parser.add_argument("--itemized", action="store_true")
+    parser.add_argument("--logo", help="Optional logo image drawn in the company header")
+    args = parser.parse_args()
+
+    quotes = synthetic_quotes(args.quotes, args.parts, args.itemized)
+    if args.logo: quotations.get_logo_reader(args.logo)  # warm the LRU as the server would
+
+    def one_by_one(_buffer):
+        for quote in quotes:
+            quotations.generate_quotation_pdf(BytesIO(), quote, args.logo)
+
+    timed("single PDF per call", args.quotes, one_by_one)
+    timed("batch -> one PDF", args.quotes, lambda b: quotations.generate_batch_pdf(b, quotes, args.logo))
+    timed("batch -> zip of PDFs", args.quotes, lambda b: quotations.generate_batch_zip(b, quotes, args.logo))
+
+if __name__ == "__main__":
+    main()
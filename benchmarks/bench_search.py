@@ -0,0 +1,79 @@
+# benchmarks/bench_search.py
+"""
+/search latency over years of job history: seeds synthetic jobs into a
+temporary database, builds the FTS index with the backfill, then times
+typical queries (prefix terms, filters, date words, browsing).
+
+    python benchmarks/bench_search.py --jobs 200000 [--rounds 20]
+"""
+import os
+import io
+import sys
+import time
+import uuid
+import random
+import shutil
+import argparse
+import tempfile
+import contextlib
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import database
+import job_search
+
+COMPANY = "bench"
+WORDS = ["labubu", "plate", "bracket", "gear", "housing", "vase", "hook", "clip", "mount", "lid", "case", "stand", "knob", "spacer"]
+MATERIALS = [("PLA", "Generic"), ("PETG", "Prusament"), ("ABS", "eSun"), ("TPU", "Overture")]
+QUERIES = [("prefix", {"text": "lab plat"}), ("phrase", {"text": "that labubu plate in petg last spring"}),
+           ("ocr", {"text": "bambu 120"}), ("filtered", {"text": "bracket", "filters": {"material": "PETG"}}),
+           ("date range", {"text": "gear", "start": "2023-01-01", "end": "2023-12-31"}),
+           ("recent", {"text": "vase", "sort": "recent"}), ("browse", {"text": ""}), ("no match", {"text": "zzzz"})]
+
+def seed(n_jobs, seed=11):
+    rng = random.Random(seed)
+    with contextlib.redirect_stdout(io.StringIO()):
+        database.init_db(os.getcwd())
+    conn = database.get_db_connection()
+    conn.execute("INSERT INTO companies (id, name) VALUES (?, ?)", (COMPANY, COMPANY))
+    start = datetime(2021, 1, 1)
+    rows = []
+    for i in range(n_jobs):
+        material, brand = rng.choice(MATERIALS)
+        name = "_".join(rng.sample(WORDS, 2)) + f"_v{rng.randint(1, 9)}"
+        rows.append((str(uuid.uuid4()), COMPANY, name, (start + timedelta(minutes=rng.randint(0, 5 * 525600))).isoformat(timespec="seconds"),
+                     f"P{rng.randint(1, 12)}", f"Printer {rng.randint(1, 12)}", material, brand, rng.uniform(5, 900), "1h 30m",
+                     f"Bambu Studio total filament {rng.uniform(5, 900):.1f} g print time {rng.randint(1, 40)}h", datetime.utcnow().isoformat()))
+    conn.executemany("""INSERT INTO jobs (id, company_id, filename, timestamp, printer_id, printer_name, material, brand,
+                        filament_g, time_str, ocr_text, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", rows)
+    conn.commit()
+    t0 = time.perf_counter()
+    job_search.backfill(conn, COMPANY); conn.commit()
+    print(f"Seeded {n_jobs} jobs; backfill took {time.perf_counter() - t0:.1f}s")
+    return conn
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--jobs", type=int, default=200000)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    original_dir = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="bench_search_")
+    try:
+        os.chdir(workdir)
+        conn = seed(args.jobs)
+        print(f"{'query':<12} {'p50 ms':>8} {'p95 ms':>8} {'results':>8}")
+        for label, kwargs in QUERIES:
+            timings = []
+            for _ in range(args.rounds):
+                t0 = time.perf_counter(); results, _ = job_search.search(conn, COMPANY, **kwargs); timings.append(time.perf_counter() - t0)
+            timings.sort()
+            print(f"{label:<12} {timings[len(timings) // 2] * 1000:8.2f} {timings[int(len(timings) * 0.95)] * 1000:8.2f} {len(results):8}")
+        conn.close()
+    finally:
+        os.chdir(original_dir)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
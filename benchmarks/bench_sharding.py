@@ -0,0 +1,90 @@
+# benchmarks/bench_sharding.py
+"""
+Multi-tenant write throughput: one writer thread per company doing stock
+ledger transactions, first against the shared database and then after
+splitting it into per-company shards with the migration tool.
+
+    python benchmarks/bench_sharding.py --companies 8 --transactions 200 --movements 20
+"""
+import os
+import io
+import sys
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import threading
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import database
+import stock_ledger
+
+MATERIALS = [("PLA", "Generic"), ("PETG", "Generic"), ("ABS", "Generic")]
+
+def seed(n_companies):
+    """Shared database with `n_companies` companies, each with a small filament catalog."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        database.init_db(os.getcwd())
+    conn = database.get_db_connection()
+    company_ids = [f"bench_{i}" for i in range(n_companies)]
+    for cid in company_ids:
+        conn.execute("INSERT INTO companies (id, name) VALUES (?, ?)", (cid, cid))
+        conn.executemany("INSERT INTO filaments (company_id, material, brand, price, stock_g, efficiency_factor) VALUES (?, ?, ?, 1200, 1000000, 1.0)",
+                         [(cid, material, brand) for material, brand in MATERIALS])
+    stock_ledger.ensure_opening_balances(conn)
+    conn.commit(); conn.close()
+    return company_ids
+
+def writer(company_id, transactions, movements, latencies, errors):
+    conn = database.get_company_db_connection(company_id)
+    try:
+        for t in range(transactions):
+            t0 = time.perf_counter()
+            try:
+                for m in range(movements):
+                    material, brand = MATERIALS[(t + m) % len(MATERIALS)]
+                    stock_ledger.record_movement(conn, company_id, material, brand, -1.0, "job")
+                conn.commit()
+                latencies.append(time.perf_counter() - t0)
+            except sqlite3.OperationalError:
+                conn.rollback(); errors.append(company_id)
+    finally:
+        conn.close()
+
+def run(label, company_ids, args):
+    latencies, errors, threads = [], [], []
+    t0 = time.perf_counter()
+    for cid in company_ids:
+        thread = threading.Thread(target=writer, args=(cid, args.transactions, args.movements, latencies, errors))
+        thread.start(); threads.append(thread)
+    for thread in threads: thread.join()
+    elapsed = time.perf_counter() - t0
+    latencies.sort()
+    p = lambda q: latencies[min(len(latencies) - 1, int(len(latencies) * q))] * 1000 if latencies else float("nan")
+    print(f"{label:<8} {len(latencies) / elapsed:10.1f} tx/s  {len(latencies) * args.movements / elapsed:10.1f} movements/s  "
+          f"p50 {p(0.5):7.2f} ms  p99 {p(0.99):7.2f} ms  locked {len(errors)}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--companies", type=int, default=8)
+    parser.add_argument("--transactions", type=int, default=200, help="Write transactions per company")
+    parser.add_argument("--movements", type=int, default=20, help="Ledger movements per transaction")
+    args = parser.parse_args()
+
+    original_dir = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="bench_sharding_")
+    try:
+        os.chdir(workdir)
+        company_ids = seed(args.companies)
+        run("shared", company_ids, args)
+        with contextlib.redirect_stdout(io.StringIO()):
+            database.split_into_shards(backup=False)
+        run("sharded", company_ids, args)
+    finally:
+        os.chdir(original_dir)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,356 @@
+# benchmarks/load_test.py
+"""
+End-to-end load test of the API: login -> /ocr_upload -> /process_image ->
+/logs, plus quotation generation, driven in-process through the Flask test
+client and/or over HTTP against a local waitress server.
+
+Everything runs offline in a scratch copy of the server (its own SQLite DB,
+data/ and logs/), with a stub OCR reader and a synthetic FDM.xlsx template.
+Results (throughput, p50/p95/p99 per step, RSS) are written as JSON; with
+--baseline the run fails if throughput or p95 latency regressed.
+
+    python benchmarks/load_test.py --target both --concurrency 8 --requests 400 \
+        --mix full=2,logs=5,quote=1 --companies 3 --users-per-company 2 \
+        --history-months 6 --jobs-per-month 200 --out load_results.json
+"""
+import os
+import io
+import sys
+import json
+import time
+import uuid
+import glob
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import http.client
+from datetime import datetime, timedelta
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FLOWS = ("full", "ocr", "process", "logs", "quote")
+
+STUB_EASYOCR = '''
+import os, time
+class Reader:
+    """Benchmark stand-in for easyocr.Reader: fixed slicer-screenshot text after an optional delay."""
+    def __init__(self, *args, **kwargs):
+        self.delay = float(os.environ.get("BENCH_OCR_DELAY_MS", "0")) / 1000
+    def readtext(self, image, **kwargs):
+        if self.delay: time.sleep(self.delay)
+        return [([[0, 0], [10, 0], [10, 10], [0, 10]], "Total filament 42.5 g", 0.98),
+                ([[0, 20], [10, 20], [10, 30], [0, 30]], "Print time 3h 25m", 0.97),
+                ([[0, 40], [10, 40], [10, 50], [0, 50]], "PLA Bambu Lab P1S", 0.95)]
+'''
+
+# --- SCRATCH SERVER ---
+
+def build_template(path):
+    from openpyxl import Workbook
+    wb = Workbook()
+    calc = wb.active; calc.title = "Calculation Sheet"
+    for cell, label in (("C4", "Part"), ("C6", "Date"), ("C9", "Material"), ("C10", "Cost/kg"),
+                        ("C11", "Filament (g)"), ("C12", "Time (h)"), ("C13", "Labour (min)")):
+        calc[cell] = label
+    wb.create_sheet("Adv. Inputs")
+    wb.save(path)
+
+def prepare_workdir(ocr_delay_ms):
+    workdir = tempfile.mkdtemp(prefix="fabraforma_bench_")
+    for path in glob.glob(os.path.join(REPO_ROOT, "*.py")):
+        shutil.copy(path, workdir)
+    with open(os.path.join(workdir, "easyocr.py"), "w") as f: f.write(STUB_EASYOCR)
+    build_template(os.path.join(workdir, "FDM.xlsx"))
+    with open(os.path.join(workdir, "server_config.json"), "w") as f:
+        json.dump({"SERVER_SHARE_DIR": "server_share", "TEMPLATE_PATH": "FDM.xlsx", "SECRET_KEY": uuid.uuid4().hex,
+                   "LOG_LEVEL": "WARNING"}, f)
+    os.environ["BENCH_OCR_DELAY_MS"] = str(ocr_delay_ms)
+    sys.path.insert(0, workdir)
+    return workdir
+
+def png_bytes():
+    from PIL import Image
+    buf = io.BytesIO(); Image.new("RGB", (1280, 720), (40, 90, 160)).save(buf, "PNG")
+    return buf.getvalue()
+
+def seed_dataset(server, args, image):
+    """Creates companies, users, catalogs and historical jobs; returns the per-company fixtures."""
+    client = server.app.test_client()
+    companies, rng = [], random.Random(args.seed)
+    for ci in range(args.companies):
+        name = f"Bench Co {ci}"
+        client.post('/auth/register_company', json={"company_name": name, "admin_username": f"admin{ci}",
+                                                    "admin_email": f"admin{ci}@bench.example.com", "admin_password": "benchpass"})
+        admin_token = client.post('/auth/login', json={"identifier": f"admin{ci}", "password": "benchpass"}).get_json()['token']
+        headers = {"Authorization": f"Bearer {admin_token}"}
+        users = [(f"admin{ci}", admin_token)]
+        for ui in range(1, args.users_per_company):
+            username = f"user{ci}_{ui}"
+            client.post('/auth/create_user', headers=headers, json={"username": username, "email": f"{username}@bench.example.com",
+                                                                    "password": "benchpass", "role": "user"})
+            users.append((username, client.post('/auth/login', json={"identifier": username, "password": "benchpass"}).get_json()['token']))
+        printers = [{"id": f"bench-p{ci}-{pi}", "brand": "Bambu Lab", "model": f"P1S-{pi}", "setup_cost": 70000,
+                     "maintenance_cost": 5000, "lifetime_years": 5, "power_w": 300, "price_kwh": 8} for pi in range(3)]
+        client.post('/printers', headers=headers, json=printers)
+        client.post('/filaments', headers=headers, json={"PLA": {"Bambu Lab": {"price": 1200, "stock_g": 10_000_000, "efficiency_factor": 1.1}},
+                                                         "PETG": {"Generic": {"price": 1500, "stock_g": 10_000_000, "efficiency_factor": 1.05}}})
+        conn = server.get_db_connection()
+        company_id = conn.execute("SELECT id FROM companies WHERE name = ?", (name,)).fetchone()['id']
+        conn.close()
+        companies.append({"id": company_id, "users": users, "printers": printers})
+        seed_history(server, company_id, printers, args, image, rng)
+    return companies
+
+def seed_history(server, company_id, printers, args, image, rng):
+    """Historical jobs written through the same unit of work as /process_image (without per-job Excel files)."""
+    conn = server.get_company_db_connection(company_id)
+    blob_root = server.get_company_data_path(company_id, server.image_store.BLOB_DIR)
+    image_blob = server.image_store.save_blob(blob_root, io.BytesIO(image), ".png")
+    start = datetime.now() - timedelta(days=30 * args.history_months)
+    for month in range(args.history_months):
+        for j in range(args.jobs_per_month):
+            material, brand = rng.choice([("PLA", "Bambu Lab"), ("PETG", "Generic")])
+            printer = rng.choice(printers)
+            data = job_payload(printer, material, brand, rng, start + timedelta(days=30 * month + rng.random() * 29))
+            cogs = server.calculate_cogs_values(data, printer, {"price": 1200, "efficiency_factor": 1.1})
+            server.record_processed_job(conn, company_id, data, cogs, data["Filename"] + ".png", image_blob, None, data["Filename"] + ".png")
+        conn.commit()
+    server.finalize_job_outputs(conn, company_id)
+    conn.close()
+
+def job_payload(printer, material, brand, rng, when=None):
+    return {"Filename": f"bench_{uuid.uuid4().hex[:12]}", "Filament (g)": round(rng.uniform(5, 400), 1),
+            "Time (e.g. 7h 30m)": f"{rng.randint(0, 20)}h {rng.randint(0, 59)}m", "timestamp": (when or datetime.now()).isoformat(),
+            "printer_id": printer["id"], "Printer": printer["model"], "Material": material, "Brand": brand,
+            "Filament Cost (₹/kg)": 1200, "Labour Time (min)": rng.randint(0, 60), "Labour Rate (₹/hr)": 100}
+
+# --- CLIENTS ---
+
+class InProcessClient:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def call(self, method, path, token=None, json_body=None, form=None, files=None):
+        headers = {"Authorization": f"Bearer {token}"} if token else {}
+        if files is not None:
+            data = dict(form or {}); data.update({k: (io.BytesIO(v), name) for k, (name, v) in files.items()})
+            r = self.client.open(path, method=method, headers=headers, data=data, content_type="multipart/form-data")
+        else:
+            r = self.client.open(path, method=method, headers=headers, json=json_body)
+        return r.status_code, r.get_data()
+
+class HTTPClient:
+    """Keep-alive HTTP/1.1 client for one worker thread."""
+    def __init__(self, port):
+        self.port, self.conn = port, None
+
+    def call(self, method, path, token=None, json_body=None, form=None, files=None):
+        headers = {"Authorization": f"Bearer {token}"} if token else {}
+        body = None
+        if files is not None:
+            boundary = uuid.uuid4().hex
+            parts = []
+            for key, value in (form or {}).items():
+                parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n{value}\r\n'.encode("utf-8"))
+            for key, (name, content) in files.items():
+                parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{key}"; filename="{name}"\r\n'
+                             f'Content-Type: application/octet-stream\r\n\r\n'.encode("utf-8") + content + b"\r\n")
+            body = b"".join(parts) + f"--{boundary}--\r\n".encode("utf-8")
+            headers["Content-Type"] = f"multipart/form-data; boundary={boundary}"
+        elif json_body is not None:
+            body = json.dumps(json_body).encode("utf-8"); headers["Content-Type"] = "application/json"
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=300)
+            try:
+                self.conn.request(method, path, body=body, headers=headers)
+                response = self.conn.getresponse()
+                return response.status, response.read()
+            except (http.client.HTTPException, ConnectionError):
+                self.conn.close(); self.conn = None
+                if attempt: raise
+
+# --- WORKLOAD ---
+
+class Recorder:
+    def __init__(self):
+        self.samples, self.errors, self.first_error, self.lock = {}, {}, {}, threading.Lock()
+
+    def timed(self, step, fn, *args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            status, body = fn(*args, **kwargs)
+        except Exception:
+            status, body = 0, b""
+        elapsed = time.perf_counter() - t0
+        with self.lock:
+            self.samples.setdefault(step, []).append(elapsed)
+            if not 200 <= status < 300:
+                self.errors[step] = self.errors.get(step, 0) + 1
+                self.first_error.setdefault(step, f"{status}: {body[:300].decode('utf-8', 'replace')}")
+        return status, body
+
+def run_flow(flow, client, company, rec, rng, image):
+    username, token = rng.choice(company["users"])
+    printer = rng.choice(company["printers"])
+    if flow == "full":
+        status, body = rec.timed("login", client.call, "POST", "/auth/login", json_body={"identifier": username, "password": "benchpass"})
+        if status == 200: token = json.loads(body)["token"]
+    if flow in ("full", "ocr"):
+        rec.timed("ocr_upload", client.call, "POST", "/ocr_upload", token, files={"image": ("shot.png", image)})
+    if flow in ("full", "process"):
+        data = job_payload(printer, "PLA", "Bambu Lab", rng)
+        rec.timed("process_image", client.call, "POST", "/process_image", token, form={"json": json.dumps(data)},
+                  files={"image": (data["Filename"] + ".png", image)})
+    if flow in ("full", "logs"):
+        rec.timed("logs", client.call, "GET", "/logs", token)
+    if flow == "quote":
+        quote = {"customer_name": "Bench Customer", "parts": [{"name": f"Part {i}", "cogs": rng.uniform(50, 900)} for i in range(5)],
+                 "margin_percent": 25, "tax_rate_percent": 18, "company_details": {"name": "Bench Co"}}
+        rec.timed("quote", client.call, "POST", "/generate_quotation", token, form={"json": json.dumps(quote)}, files={})
+
+def parse_mix(spec):
+    weights = {}
+    for item in spec.split(","):
+        name, _, weight = item.partition("=")
+        if name.strip() not in FLOWS: raise SystemExit(f"Unknown flow '{name}'. Choose from {', '.join(FLOWS)}.")
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+def percentile(sorted_values, p):
+    if not sorted_values: return None
+    k = (len(sorted_values) - 1) * p / 100.0
+    lo, hi = int(k), min(int(k) + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+def rss_mb():
+    """(current, peak) resident set size in MiB where the platform exposes it."""
+    current = peak = None
+    try:
+        import psutil
+        current = psutil.Process().memory_info().rss / 2**20
+    except ImportError:
+        try:
+            with open("/proc/self/statm") as f: current = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+        except (OSError, ValueError, AttributeError): pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2**20 if sys.platform == "darwin" else 2**10)
+    except ImportError: pass
+    return {"current": current and round(current, 1), "peak": peak and round(peak, 1)}
+
+def run_load(make_client, companies, args, image):
+    weights = parse_mix(args.mix)
+    flows, flow_weights = list(weights), list(weights.values())
+    rec, remaining, remaining_lock = Recorder(), [args.requests], threading.Lock()
+
+    def worker(index):
+        rng, client = random.Random(args.seed * 1000 + index), make_client()
+        while True:
+            with remaining_lock:
+                if remaining[0] <= 0: return
+                remaining[0] -= 1
+            run_flow(rng.choices(flows, flow_weights)[0], client, rng.choice(companies), rec, rng, image)
+
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.concurrency)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    wall = time.perf_counter() - t0
+
+    steps = {}
+    for step, values in sorted(rec.samples.items()):
+        values.sort()
+        steps[step] = {"count": len(values), "errors": rec.errors.get(step, 0), "throughput_rps": round(len(values) / wall, 2),
+                       "mean_ms": round(sum(values) / len(values) * 1000, 2), "max_ms": round(values[-1] * 1000, 2),
+                       **{f"p{p}_ms": round(percentile(values, p) * 1000, 2) for p in (50, 95, 99)}}
+        if step in rec.first_error: steps[step]["first_error"] = rec.first_error[step]
+    total = sum(len(v) for v in rec.samples.values())
+    return {"wall_s": round(wall, 3), "flows": args.requests, "flows_per_s": round(args.requests / wall, 2),
+            "requests": total, "requests_per_s": round(total / wall, 2), "errors": sum(rec.errors.values()),
+            "steps": steps, "rss_mb": rss_mb()}
+
+def serve_until_closed(srv):
+    try: srv.run()
+    except OSError: pass  # The listening socket was closed from the main thread.
+
+def compare(results, baseline_path, tolerance):
+    """Regressions vs. a previous results file: lower throughput or higher p95 beyond `tolerance`."""
+    with open(baseline_path) as f: baseline = json.load(f)["results"]
+    problems = []
+    for target, current in results.items():
+        before = baseline.get(target)
+        if not before: continue
+        if current["requests_per_s"] < before["requests_per_s"] * (1 - tolerance):
+            problems.append(f"{target}: throughput {current['requests_per_s']} < baseline {before['requests_per_s']}")
+        for step, stats in current["steps"].items():
+            old = before["steps"].get(step)
+            if old and stats["p95_ms"] > old["p95_ms"] * (1 + tolerance):
+                problems.append(f"{target}/{step}: p95 {stats['p95_ms']} ms > baseline {old['p95_ms']} ms")
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", choices=("inprocess", "waitress", "both"), default="inprocess")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=200, help="Flows to run per target.")
+    parser.add_argument("--mix", default="full=2,logs=5,quote=1", help=f"Weighted flows: {', '.join(FLOWS)}.")
+    parser.add_argument("--companies", type=int, default=2)
+    parser.add_argument("--users-per-company", type=int, default=2, help="Users (and so tokens) per company.")
+    parser.add_argument("--history-months", type=int, default=3)
+    parser.add_argument("--jobs-per-month", type=int, default=100)
+    parser.add_argument("--ocr-delay-ms", type=float, default=0, help="Simulated OCR inference time.")
+    parser.add_argument("--waitress-threads", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", default="load_results.json")
+    parser.add_argument("--baseline", help="Previous results JSON to compare against.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression vs. the baseline.")
+    parser.add_argument("--keep-workdir", action="store_true")
+    args = parser.parse_args()
+    if args.tolerance < 0: parser.error("--tolerance must not be negative")
+    out_path = os.path.abspath(args.out)
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+
+    workdir = prepare_workdir(args.ocr_delay_ms)
+    try:
+        import server  # Imported from the scratch copy; it chdirs there.
+        image = png_bytes()
+        t0 = time.perf_counter()
+        companies = seed_dataset(server, args, image)
+        print(f"Seeded {args.companies} companies x {args.history_months * args.jobs_per_month} jobs in {time.perf_counter() - t0:.1f}s")
+
+        results = {}
+        if args.target in ("inprocess", "both"):
+            results["inprocess"] = run_load(lambda: InProcessClient(server.app), companies, args, image)
+        if args.target in ("waitress", "both"):
+            from waitress import create_server
+            srv = create_server(server.app, host="127.0.0.1", port=0, threads=args.waitress_threads)
+            threading.Thread(target=serve_until_closed, args=(srv,), daemon=True).start()
+            try: results["waitress"] = run_load(lambda: HTTPClient(srv.effective_port), companies, args, image)
+            finally: srv.close()
+
+        report = {"created_at": datetime.now().isoformat(), "config": vars(args),
+                  "env": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+                  "results": results}
+        with open(out_path, "w") as f: json.dump(report, f, indent=2)
+        for target, result in results.items():
+            print(f"\n[{target}] {result['requests_per_s']} req/s, {result['flows_per_s']} flows/s, "
+                  f"{result['errors']} errors, RSS {result['rss_mb']}")
+            for step, stats in result["steps"].items():
+                print(f"  {step:<14} n={stats['count']:<5} p50={stats['p50_ms']:>8} ms  p95={stats['p95_ms']:>8} ms  p99={stats['p99_ms']:>8} ms")
+        print(f"\nResults written to {out_path}")
+
+        if baseline_path:
+            problems = compare(results, baseline_path, args.tolerance)
+            for problem in problems: print(f"REGRESSION: {problem}")
+            if problems: sys.exit(1)
+    finally:
+        if not args.keep_workdir:
+            from logging_setup import shutdown_logging
+            shutdown_logging()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+# costing.py
+"""
+COGS calculations: the scalar per-job functions used while processing a job
+and a vectorized engine that evaluates many jobs against many printer,
+filament and labour-rate scenarios at once.
+
+The batch engine performs the same floating-point operations in the same
+order as the scalar functions, so both give bit-identical results.
+"""
+import re
+import numpy as np
+
+DEFAULT_LABOUR_RATE_HR = 100
+
+# --- SCALAR (PER-JOB) ---
+
+def parse_time_string(time_str):
+    h_match = re.search(r'(\d+)\s*h', time_str, re.IGNORECASE); h = int(h_match.group(1)) if h_match else 0
+    m_match = re.search(r'(\d+)\s*m', time_str, re.IGNORECASE); m = int(m_match.group(1)) if m_match else 0
+    s_match = re.search(r'(\d+)\s*s', time_str, re.IGNORECASE); s = int(s_match.group(1)) if s_match else 0
+    return round(h + (m / 60.0) + (s / 3600.0), 2)
+
+def calculate_printer_hourly_rate(printer_data):
+    try:
+        total_cost = printer_data['setup_cost'] + (printer_data['maintenance_cost'] * printer_data['lifetime_years'])
+        total_hours = printer_data['lifetime_years'] * 365 * 24 * (printer_data.get('uptime_percent', 50) / 100)
+        if total_hours == 0: return 0.0
+        return (total_cost / total_hours) + ((printer_data['power_w'] / 1000) * printer_data['price_kwh'])
+    except (KeyError, TypeError, ZeroDivisionError): return 0.0
+
+def calculate_cogs_values(form_data, printer_data, filament_data):
+    try:
+        filament_g = float(form_data.get("Filament (g)", 0)); time_str = form_data.get("Time (e.g. 7h 30m)", "0h 0m")
+        labour_time_min = float(form_data.get("Labour Time (min)", 0)); labour_rate_user = float(form_data.get("Labour Rate (₹/hr)", 0))
+        print_time_hours = parse_time_string(time_str)
+        mat_cost = (filament_data.get('price', 0) / 1000) * filament_g * filament_data.get('efficiency_factor', 1.0)
+        labour_cogs = (labour_rate_user / 60) * labour_time_min
+        printer_cogs = calculate_printer_hourly_rate(printer_data) * printer_data.get('buffer_factor', 1.0) * print_time_hours
+        total_cogs_user = mat_cost + labour_cogs + printer_cogs
+        mat_cost_default = (filament_data.get('price', 0) / 1000) * filament_g
+        labour_cogs_default = (DEFAULT_LABOUR_RATE_HR / 60) * labour_time_min
+        printer_cogs_default = calculate_printer_hourly_rate(printer_data) * print_time_hours
+        total_cogs_default = mat_cost_default + labour_cogs_default + printer_cogs_default
+        return {"user_cogs": total_cogs_user, "default_cogs": total_cogs_default}
+    except (ValueError, TypeError, KeyError, ZeroDivisionError): return {"user_cogs": 0.0, "default_cogs": 0.0}
+
+# --- VECTORIZED (BATCH) ---
+
+def float_column(rows, key, default=None):
+    """Float column from a list of dicts; missing or None values become NaN."""
+    values = [row.get(key, default) for row in rows]
+    return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+
+def job_arrays(jobs):
+    """
+    Converts job dicts (the same keys `calculate_cogs_values` reads) into
+    arrays. Malformed jobs are flagged in `valid` and cost 0, as in the
+    scalar function.
+    """
+    filament_g, hours, labour_min, valid = [], [], [], []
+    for job in jobs:
+        try:
+            g_val = float(job.get("Filament (g)", 0)); m_val = float(job.get("Labour Time (min)", 0))
+            h_val = parse_time_string(job.get("Time (e.g. 7h 30m)", "0h 0m"))
+            filament_g.append(g_val); labour_min.append(m_val); hours.append(h_val); valid.append(True)
+        except (ValueError, TypeError):
+            filament_g.append(0.0); labour_min.append(0.0); hours.append(0.0); valid.append(False)
+    return {"filament_g": np.array(filament_g, dtype=np.float64), "hours": np.array(hours, dtype=np.float64),
+            "labour_min": np.array(labour_min, dtype=np.float64), "valid": np.array(valid, dtype=bool)}
+
+def printer_hourly_rates(printers):
+    """Vectorized `calculate_printer_hourly_rate` over a list of printer dicts."""
+    setup, maint = float_column(printers, 'setup_cost'), float_column(printers, 'maintenance_cost')
+    life, uptime = float_column(printers, 'lifetime_years'), float_column(printers, 'uptime_percent', 50)
+    power, kwh = float_column(printers, 'power_w'), float_column(printers, 'price_kwh')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        total_cost = setup + (maint * life)
+        total_hours = life * 365 * 24 * (uptime / 100)
+        rate = (total_cost / total_hours) + ((power / 1000) * kwh)
+    ok = ~np.isnan(setup) & ~np.isnan(maint) & ~np.isnan(life) & ~np.isnan(uptime) & ~np.isnan(power) & ~np.isnan(kwh)
+    return np.where(ok & (total_hours != 0), rate, 0.0)
+
+def cogs_arrays(filament_g, hours, labour_min, hourly, buffer, price, efficiency, labour_rate):
+    """
+    Elementwise `calculate_cogs_values` over broadcast-compatible arrays.
+    Returns (user_cogs, default_cogs); any NaN catalog input costs 0.
+    """
+    mat_cost = (price / 1000) * filament_g * efficiency
+    labour_cogs = (labour_rate / 60) * labour_min
+    printer_cogs = hourly * buffer * hours
+    user = mat_cost + labour_cogs + printer_cogs
+
+    mat_cost_default = (price / 1000) * filament_g
+    labour_cogs_default = (DEFAULT_LABOUR_RATE_HR / 60) * labour_min
+    printer_cogs_default = hourly * hours
+    default = mat_cost_default + labour_cogs_default + printer_cogs_default
+
+    # Mirror the scalar function's "any bad input costs 0" behaviour.
+    ok = ~np.isnan(buffer) & ~np.isnan(price) & ~np.isnan(efficiency)
+    return np.where(ok, user, 0.0), np.where(ok, default, 0.0)
+
+def batch_cogs(jobs, printers, filaments, labour_rates):
+    """
+    Costs every job on every printer x filament x labour-rate combination.
+
+    Returns (user_cogs, default_cogs): user_cogs has shape
+    (jobs, printers, filaments, labour_rates); default_cogs ignores the user
+    labour rate, efficiency and buffer factors and has shape
+    (jobs, printers, filaments).
+    """
+    j = job_arrays(jobs) if not isinstance(jobs, dict) else jobs
+    hourly = printer_hourly_rates(printers)
+    buffer = float_column(printers, 'buffer_factor', 1.0)
+    price, efficiency = float_column(filaments, 'price', 0), float_column(filaments, 'efficiency_factor', 1.0)
+    rates = np.asarray(labour_rates, dtype=np.float64)
+
+    # Axes: [job, printer, filament, labour_rate]
+    user, default = cogs_arrays(
+        j["filament_g"][:, None, None, None], j["hours"][:, None, None, None], j["labour_min"][:, None, None, None],
+        hourly[None, :, None, None], buffer[None, :, None, None],
+        price[None, None, :, None], efficiency[None, None, :, None], rates[None, None, None, :])
+    default = default[..., 0]
+    valid = j["valid"][:, None, None]
+    return np.where(valid[..., None], user, 0.0), np.where(valid, default, 0.0)
+
+def apply_margins(cogs, margin_percents):
+    """Quote price for each margin (same formula as the quotation PDF); adds a trailing axis."""
+    margins = np.asarray(margin_percents, dtype=np.float64)
+    with np.errstate(divide='ignore'):
+        prices = cogs[..., None] / (1 - (margins / 100.0))
+    return np.where(margins < 100, prices, 0.0)
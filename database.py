@@ -2,18 +2,103 @@
 import sqlite3
 import json
 import os
+import re
 import uuid
 import time
+import threading
 from werkzeug.security import generate_password_hash
 
 DB_FILE = "server_data.sqlite"
 
+# --- STORAGE ROUTING ---
+# In the default (shared) mode every table lives in DB_FILE. In sharded mode
+# DB_FILE is the directory (companies, users, auth_tokens) and each company's
+# operational tables live in data/<company_id>/company.sqlite, so tenants no
+# longer queue on one SQLite writer lock. A company connection attaches the
+# directory, so queries that name directory tables keep working unchanged.
+
+DATA_DIR = "data"
+SHARD_FILE = "company.sqlite"
+DIRECTORY_TABLES = ("companies", "users", "auth_tokens", "storage_meta")
+COMPANY_TABLES = ("printers", "filaments", "jobs", "processed_files", "job_outputs", "image_blobs", "image_refs",
+                  "usage_rollups", "stock_movements", "recost_runs", "recost_outputs", "company_assets", "archived_files")
+# Derived company tables: dropped from the directory when sharding and rebuilt in each shard.
+DERIVED_COMPANY_TABLES = ("jobs_fts",)
+_storage_mode = None
+_ready_shards = set()
+_shard_lock = threading.Lock()
+
 def get_db_connection():
+    """The directory database; in shared mode it holds every table."""
     conn = sqlite3.connect(DB_FILE)
     conn.row_factory = sqlite3.Row
     return conn
 
+def read_storage_mode(conn=None):
+    """'sharded' or 'shared', as recorded in the directory database."""
+    own = conn is None
+    conn = conn or get_db_connection()
+    try:
+        row = conn.execute("SELECT value FROM storage_meta WHERE key = 'storage_mode'").fetchone()
+        return row[0] if row else "shared"
+    except sqlite3.OperationalError:
+        return "shared"  # Databases that predate storage_meta.
+    finally:
+        if own: conn.close()
+
+def is_sharded():
+    global _storage_mode
+    if _storage_mode is None:
+        _storage_mode = read_storage_mode()
+    return _storage_mode == "sharded"
+
+def shard_path(company_id):
+    if not re.fullmatch(r'[A-Za-z0-9_.-]+', str(company_id)) or company_id in ('.', '..'):
+        raise ValueError(f"Invalid company id '{company_id}'")
+    return os.path.join(DATA_DIR, str(company_id), SHARD_FILE)
+
+def get_company_db_connection(company_id):
+    """Connection for a company's data: its shard (with the directory attached as `directory`) or the shared DB."""
+    if not is_sharded():
+        return get_db_connection()
+    path = shard_path(company_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    key = os.path.abspath(path)
+    if key not in _ready_shards:
+        with _shard_lock:
+            if key not in _ready_shards:
+                _ensure_company_tables(conn.cursor()); conn.commit()
+                _ready_shards.add(key)
+    conn.execute("ATTACH DATABASE ? AS directory", (DB_FILE,))
+    return conn
+
+def iter_company_connections():
+    """
+    Yields (company_id, connection) for maintenance that spans companies; in
+    shared mode a single (None, connection) covers all of them. Each
+    connection is closed when the loop moves on.
+    """
+    if not is_sharded():
+        conn = get_db_connection()
+        try: yield None, conn
+        finally: conn.close()
+        return
+    directory = get_db_connection()
+    try: company_ids = [row['id'] for row in directory.execute("SELECT id FROM companies ORDER BY id")]
+    finally: directory.close()
+    for company_id in company_ids:
+        conn = get_company_db_connection(company_id)
+        try: yield company_id, conn
+        finally: conn.close()
+
+def insert_row(conn, table_name, row):
+    """Inserts a dict as one row; keys are trusted column names."""
+    conn.execute(f"INSERT INTO {table_name} ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})", tuple(row.values()))
+
 def init_db(script_dir):
+    global _storage_mode
     conn = get_db_connection()
     cursor = conn.cursor()
 
@@ -105,6 +190,249 @@ def init_db(script_dir):
         )''')
         print("✅ 'auth_tokens' table created.")
 
+    _ensure_table(cursor, 'storage_meta', "CREATE TABLE storage_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+    _storage_mode = read_storage_mode(conn)
+    _ready_shards.clear()
+    if _storage_mode != "sharded":
+        _ensure_company_tables(cursor)
+
     conn.commit()
     conn.close()
     print("✅ Database initialization/check complete.")
+
+def _ensure_company_tables(cursor):
+    """Company-scoped tables: in the shared DB, or in one company's shard."""
+    _ensure_table(cursor, 'printers', '''
+        CREATE TABLE printers (
+            id TEXT PRIMARY KEY, company_id TEXT NOT NULL, brand TEXT, model TEXT, setup_cost REAL,
+            maintenance_cost REAL, lifetime_years INTEGER, power_w REAL, price_kwh REAL,
+            buffer_factor REAL, uptime_percent REAL, FOREIGN KEY (company_id) REFERENCES companies (id)
+        )''')
+    _ensure_table(cursor, 'filaments', '''
+        CREATE TABLE filaments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, company_id TEXT NOT NULL, material TEXT NOT NULL,
+            brand TEXT NOT NULL, price REAL, stock_g REAL, efficiency_factor REAL,
+            FOREIGN KEY (company_id) REFERENCES companies (id), UNIQUE (company_id, material, brand)
+        )''')
+
+    # --- Job records and the file-output journal (one transaction per processed job) ---
+    _ensure_table(cursor, 'jobs', '''
+        CREATE TABLE jobs (
+            id TEXT PRIMARY KEY, company_id TEXT NOT NULL, filename TEXT NOT NULL, source_name TEXT,
+            timestamp TEXT NOT NULL, printer_id TEXT, printer_name TEXT, material TEXT, brand TEXT,
+            filament_g REAL, time_str TEXT, time_h REAL, labour_time_min REAL, labour_rate_hr REAL,
+            filament_cost_kg REAL, user_cogs REAL, default_cogs REAL, image_path TEXT, excel_path TEXT,
+            created_at TEXT NOT NULL, FOREIGN KEY (company_id) REFERENCES companies (id)
+        )''', "CREATE INDEX idx_jobs_company_timestamp ON jobs (company_id, timestamp)")
+    _ensure_table(cursor, 'processed_files', '''
+        CREATE TABLE processed_files (
+            company_id TEXT NOT NULL, source_name TEXT NOT NULL, status TEXT NOT NULL, job_id TEXT,
+            PRIMARY KEY (company_id, source_name), FOREIGN KEY (job_id) REFERENCES jobs (id)
+        )''')
+    _ensure_table(cursor, 'job_outputs', '''
+        CREATE TABLE job_outputs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, job_id TEXT NOT NULL, company_id TEXT NOT NULL,
+            payload TEXT NOT NULL, applied INTEGER NOT NULL DEFAULT 0, created_at TEXT NOT NULL,
+            FOREIGN KEY (job_id) REFERENCES jobs (id)
+        )''', "CREATE INDEX idx_job_outputs_pending ON job_outputs (applied, company_id)")
+
+    # --- Content-addressed image store ---
+    _ensure_table(cursor, 'image_blobs', '''
+        CREATE TABLE image_blobs (
+            company_id TEXT NOT NULL, hash TEXT NOT NULL, ext TEXT NOT NULL, size INTEGER NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0, created_at TEXT NOT NULL,
+            PRIMARY KEY (company_id, hash), FOREIGN KEY (company_id) REFERENCES companies (id)
+        )''', "CREATE INDEX idx_image_blobs_refcount ON image_blobs (company_id, refcount)")
+    _ensure_table(cursor, 'image_refs', '''
+        CREATE TABLE image_refs (
+            company_id TEXT NOT NULL, name TEXT NOT NULL, hash TEXT NOT NULL,
+            PRIMARY KEY (company_id, name), FOREIGN KEY (company_id, hash) REFERENCES image_blobs (company_id, hash)
+        )''')
+    _ensure_column(cursor, 'jobs', 'image_hash', 'TEXT')
+    _ensure_column(cursor, 'jobs', 'ocr_text', 'TEXT')
+    # Set once archival.py has recompressed the blob to <hash><archived_ext>.
+    _ensure_column(cursor, 'image_blobs', 'archived_ext', 'TEXT')
+
+    # --- Analytics rollups, maintained incrementally as jobs are processed ---
+    _ensure_table(cursor, 'usage_rollups', '''
+        CREATE TABLE usage_rollups (
+            company_id TEXT NOT NULL, period_type TEXT NOT NULL, period_start TEXT NOT NULL,
+            printer_id TEXT NOT NULL, material TEXT NOT NULL, brand TEXT NOT NULL,
+            job_count INTEGER NOT NULL DEFAULT 0, filament_g REAL NOT NULL DEFAULT 0, time_h REAL NOT NULL DEFAULT 0,
+            labour_time_min REAL NOT NULL DEFAULT 0, user_cogs REAL NOT NULL DEFAULT 0, default_cogs REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (company_id, period_type, period_start, printer_id, material, brand)
+        )''')
+
+    # --- Append-only filament stock ledger (filaments.stock_g is its materialized balance) ---
+    _ensure_table(cursor, 'stock_movements', '''
+        CREATE TABLE stock_movements (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, company_id TEXT NOT NULL, material TEXT NOT NULL, brand TEXT NOT NULL,
+            delta_g REAL NOT NULL, balance_after REAL NOT NULL, reason TEXT NOT NULL, job_id TEXT, created_at TEXT NOT NULL,
+            FOREIGN KEY (company_id) REFERENCES companies (id)
+        )''', "CREATE INDEX idx_stock_movements_lookup ON stock_movements (company_id, material, brand, created_at)")
+
+    # --- Background re-costing runs and the job indexes they use to find affected jobs ---
+    _ensure_table(cursor, 'recost_runs', '''
+        CREATE TABLE recost_runs (
+            id TEXT PRIMARY KEY, company_id TEXT NOT NULL, scope TEXT NOT NULL, status TEXT NOT NULL,
+            total INTEGER NOT NULL DEFAULT 0, done INTEGER NOT NULL DEFAULT 0, changed INTEGER NOT NULL DEFAULT 0,
+            skipped INTEGER NOT NULL DEFAULT 0, error TEXT, started_at TEXT NOT NULL, finished_at TEXT,
+            FOREIGN KEY (company_id) REFERENCES companies (id)
+        )''')
+    # File outputs of re-costing batches (COGS updates), journaled like job_outputs but keyed by run.
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='recost_outputs'")
+    migrate_recost_outputs = cursor.fetchone() is None
+    _ensure_table(cursor, 'recost_outputs', '''
+        CREATE TABLE recost_outputs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, run_id TEXT NOT NULL, company_id TEXT NOT NULL,
+            payload TEXT NOT NULL, applied INTEGER NOT NULL DEFAULT 0, created_at TEXT NOT NULL,
+            FOREIGN KEY (run_id) REFERENCES recost_runs (id)
+        )''', "CREATE INDEX idx_recost_outputs_pending ON recost_outputs (applied, company_id)")
+    if migrate_recost_outputs:
+        # Earlier versions journaled re-costing batches in job_outputs under the run id.
+        cursor.execute("""INSERT INTO recost_outputs (run_id, company_id, payload, applied, created_at)
+                          SELECT job_id, company_id, payload, applied, created_at FROM job_outputs
+                          WHERE job_id IN (SELECT id FROM recost_runs) ORDER BY id""")
+        cursor.execute("DELETE FROM job_outputs WHERE job_id IN (SELECT id FROM recost_runs)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_company_printer ON jobs (company_id, printer_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_company_filament ON jobs (company_id, material, brand)")
+
+    # --- Per-company assets (e.g. the quotation logo), stored by content hash ---
+    _ensure_table(cursor, 'company_assets', '''
+        CREATE TABLE company_assets (
+            company_id TEXT NOT NULL, kind TEXT NOT NULL, hash TEXT NOT NULL, ext TEXT NOT NULL, updated_at TEXT NOT NULL,
+            PRIMARY KEY (company_id, kind), FOREIGN KEY (company_id) REFERENCES companies (id)
+        )''')
+
+    # --- Full-text index over jobs, maintained by job_search.py (derived data: rebuilt, never copied) ---
+    _ensure_table(cursor, 'jobs_fts', '''
+        CREATE VIRTUAL TABLE jobs_fts USING fts5(
+            job_id UNINDEXED, filename, printer, material, brand, ocr_text, date_terms,
+            tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+        )''')
+
+    # --- Index of files packed into archives by archival.py ---
+    _ensure_table(cursor, 'archived_files', '''
+        CREATE TABLE archived_files (
+            company_id TEXT NOT NULL, kind TEXT NOT NULL, name TEXT NOT NULL, archive TEXT NOT NULL,
+            size INTEGER NOT NULL, period TEXT NOT NULL, archived_at TEXT NOT NULL,
+            PRIMARY KEY (company_id, kind, name), FOREIGN KEY (company_id) REFERENCES companies (id)
+        )''', "CREATE INDEX idx_archived_files_archive ON archived_files (company_id, archive)")
+
+def _ensure_table(cursor, table_name, create_sql, *extra_sql):
+    """Creates a table (plus any indexes) if it does not exist yet."""
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?;", (table_name,))
+    if cursor.fetchone():
+        return
+    print(f"INFO: Creating '{table_name}' table...")
+    cursor.execute(create_sql)
+    for statement in extra_sql:
+        cursor.execute(statement)
+    print(f"✅ '{table_name}' table created.")
+
+def _ensure_column(cursor, table_name, column_name, column_type):
+    """Adds a column to an existing table (schema migration for older databases)."""
+    columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({table_name})")]
+    if column_name not in columns:
+        print(f"INFO: Adding column '{column_name}' to '{table_name}' table...")
+        cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}")
+
+def _table_columns(conn, schema, table_name):
+    return [(row[1], row[2]) for row in conn.execute(f"PRAGMA {schema}.table_info({table_name})")]
+
+# --- SHARD MIGRATION ---
+
+def split_into_shards(backup=True):
+    """
+    Copies each company's operational rows from the shared DB into its own
+    shard, verifies the row counts, then switches the directory to sharded
+    mode and drops the moved tables from it. Run with the server stopped.
+    The switch happens last, so an interrupted run leaves the shared DB in
+    charge and can simply be repeated. Returns {company_id: {table: rows}}.
+    """
+    global _storage_mode
+    directory = get_db_connection()
+    try:
+        if read_storage_mode(directory) == "sharded":
+            raise RuntimeError("The database is already sharded.")
+        if backup:
+            backup_conn = sqlite3.connect(f"{DB_FILE}.pre-shard.bak")
+            try: directory.backup(backup_conn)
+            finally: backup_conn.close()
+        tables = [name for name in COMPANY_TABLES
+                  if directory.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (name,)).fetchone()]
+        orphans = {}
+        for table in tables:
+            count = directory.execute(f"SELECT COUNT(*) FROM {table} WHERE company_id NOT IN (SELECT id FROM companies)").fetchone()[0]
+            if count: orphans[table] = count
+        if orphans:
+            raise RuntimeError(f"Rows reference companies that do not exist: {orphans}. Remove or reassign them first.")
+
+        company_ids = [row['id'] for row in directory.execute("SELECT id FROM companies ORDER BY id")]
+        copied = {}
+        for company_id in company_ids:
+            path = shard_path(company_id)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.exists(path): os.remove(path)  # Left over from an interrupted run.
+            shard = sqlite3.connect(path)
+            try:
+                _ensure_company_tables(shard.cursor())
+                shard.commit()
+                shard.execute("ATTACH DATABASE ? AS source", (DB_FILE,))
+                counts = {}
+                for table in tables:
+                    shard_columns = {name for name, _ in _table_columns(shard, "main", table)}
+                    source_columns = _table_columns(shard, "source", table)
+                    for name, column_type in source_columns:
+                        if name not in shard_columns:  # Columns added to the shared DB outside init_db.
+                            shard.execute(f"ALTER TABLE main.{table} ADD COLUMN {name} {column_type}")
+                    column_list = ", ".join(name for name, _ in source_columns)
+                    shard.execute(f"INSERT INTO main.{table} ({column_list}) SELECT {column_list} FROM source.{table} WHERE company_id = ?", (company_id,))
+                    counts[table] = shard.execute(f"SELECT COUNT(*) FROM main.{table}").fetchone()[0]
+                shard.commit()
+                shard.execute("DETACH DATABASE source")
+            finally:
+                shard.close()
+            copied[company_id] = counts
+
+        for table in tables:
+            expected = directory.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            moved = sum(counts[table] for counts in copied.values())
+            if moved != expected:
+                raise RuntimeError(f"Row count mismatch for '{table}': {expected} in the shared DB, {moved} in shards. Nothing was switched.")
+
+        directory.execute("CREATE TABLE IF NOT EXISTS storage_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        directory.execute("INSERT OR REPLACE INTO storage_meta (key, value) VALUES ('storage_mode', 'sharded')")
+        for table in tables + [name for name in DERIVED_COMPANY_TABLES
+                               if directory.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (name,)).fetchone()]:
+            directory.execute(f"DROP TABLE {table}")
+        directory.commit()
+        directory.execute("VACUUM")
+    finally:
+        directory.close()
+    _storage_mode = None
+    _ready_shards.clear()
+    return copied
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Storage maintenance for the server database.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("status", help="Show the storage mode and per-company shard sizes.")
+    shard_p = sub.add_parser("shard", help="Split the shared database into per-company shards (server must be stopped).")
+    shard_p.add_argument("--no-backup", action="store_true", help=f"Skip the {DB_FILE}.pre-shard.bak copy.")
+    args = parser.parse_args()
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    os.chdir(script_dir)
+    init_db(script_dir)
+    if args.command == "shard":
+        for company_id, counts in split_into_shards(backup=not args.no_backup).items():
+            print(f"{company_id}: " + ", ".join(f"{table}={n}" for table, n in counts.items() if n))
+        print(f"✅ Sharded. The previous database was kept as {DB_FILE}.pre-shard.bak." if not args.no_backup else "✅ Sharded.")
+    else:
+        print(f"Storage mode: {'sharded' if is_sharded() else 'shared'} ({os.path.getsize(DB_FILE) / 1024:.0f} KiB directory)")
+        if is_sharded():
+            for company_id, conn in iter_company_connections():
+                path = shard_path(company_id)
+                print(f"  {company_id}: {os.path.getsize(path) / 1024:.0f} KiB, {conn.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]} job(s)")
@@ -0,0 +1,357 @@
+# event_stream.py
+"""
+Per-company Server-Sent Events: job stage transitions, new log entries and
+catalog changes are pushed to subscribed clients instead of being polled.
+
+WSGI ties a worker thread to every open response, so the stream is served
+by its own listener (EVENT_STREAM_PORT, default 5001) on one asyncio thread:
+an idle subscriber costs a socket and a coroutine, not a waitress thread.
+`publish` may be called from any thread; it appends the event to the
+company's replay buffer and hands it to the event loop without blocking.
+
+    GET /events?token=<access token>            (or Authorization: Bearer)
+    Last-Event-ID: <id>  /  ?last_event_id=<id>   resume after a reconnect
+
+The listener speaks plain HTTP. Behind TLS, put a proxy in front of it
+and set EVENT_STREAM_PUBLIC_URL so /events on the API port redirects there.
+
+With several worker processes only one can bind the port. When
+EVENT_STREAM_RELAY_ADDRESS is set, that process also listens there (a Unix
+socket, or a named pipe on Windows, via multiprocessing.connection with the
+app's secret key, like ocr_service.py) and the others forward every publish
+to it from a background thread. Without it, the other processes log an
+error and their events reach no subscriber.
+
+Event ids are "<epoch>-<seq>". A client resuming from an id this process
+can no longer replay (older than the buffer, or from before a restart) gets
+a `reset` event and should refetch state over the REST API. Each stream ends
+when its token expires; clients reconnect with a refreshed token. A client
+too slow to keep up (MAX_PENDING undelivered events) is disconnected and
+resumes from its last id.
+
+Events:
+    job      {"request_id", "stage": queued|ocr|costing|excel|done|failed, ...}
+    log      {"entries": [...app log entries], "cogs_updates": [...]}
+    catalog  {"catalog": "printers"|"filaments", "version": n, "reason"}
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+import queue
+import threading
+from collections import deque
+from multiprocessing.connection import Listener, Client
+from urllib.parse import urlsplit, parse_qs
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = "0.0.0.0"
+DEFAULT_PORT = 5001
+BUFFER_SIZE = 500          # Events kept per company for Last-Event-ID replay.
+MAX_PENDING = 256          # Undelivered events per subscriber before it is dropped.
+MAX_SUBSCRIBERS = 1000
+HEARTBEAT_SECONDS = 15
+RECONNECT_MS = 3000
+REQUEST_TIMEOUT = 10
+MAX_REQUEST_BYTES = 16 * 1024
+RELAY_QUEUE_SIZE = 10000   # Events a relaying process holds while the hub process is unreachable.
+CORS_HEADERS = "Access-Control-Allow-Origin: *\r\nAccess-Control-Allow-Headers: Authorization, Last-Event-ID\r\n"
+
+class AuthError(Exception):
+    pass
+
+def _frame(event_id, event, data):
+    return f"id: {event_id}\nevent: {event}\ndata: {data}\n\n".encode("utf-8")
+
+def _http_error(status, message):
+    body = json.dumps({"status": "error", "message": message}).encode("utf-8")
+    return (f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+            f"{CORS_HEADERS}Connection: close\r\n\r\n").encode("ascii") + body
+
+class _Subscriber:
+    __slots__ = ("company", "queue", "last_seq", "task")
+    def __init__(self, company, last_seq):
+        self.company, self.last_seq, self.task = company, last_seq, asyncio.current_task()
+        self.queue = asyncio.Queue(MAX_PENDING)
+
+class EventHub:
+    def __init__(self, authenticate):
+        """`authenticate(token)` returns (company_id, expires_at epoch seconds or None) or raises AuthError."""
+        self.authenticate = authenticate
+        self.epoch = format(int(time.time()), "x")
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._buffers = {}           # company -> deque of (seq, event, data json)
+        self._catalog_versions = {}  # (company, catalog) -> version
+        self._subscribers = {}       # company -> set of _Subscriber (event loop thread only)
+        self._loop = self._server = self._thread = None
+        self._relay = self._relay_thread = self._relay_listener = self._relay_authkey = None
+        self.address = None  # (host, port) of the stream, served here or, when relaying, by the hub process.
+
+    # --- PUBLISHING (any thread) ---
+
+    def publish(self, company_id, event, data):
+        """Buffers an event for the company and queues it for delivery; never blocks or raises."""
+        if self._relay is not None:
+            return self._forward(("publish", company_id, event, data))
+        try:
+            payload = json.dumps(data, default=str, separators=(",", ":"))
+            with self._lock:
+                self._seq += 1
+                entry = (self._seq, event, payload)
+                self._buffers.setdefault(company_id, deque(maxlen=BUFFER_SIZE)).append(entry)
+                loop = self._loop
+            metrics.inc("events_published_total", event=event)
+            if loop is not None:
+                loop.call_soon_threadsafe(self._fan_out, company_id, entry)
+        except RuntimeError:
+            pass  # Event loop shut down between the check and the call.
+        except Exception:
+            logger.exception(f"Events: could not publish '{event}' for company {company_id}")
+
+    def bump_catalog(self, company_id, catalog, reason):
+        if self._relay is not None:
+            return self._forward(("bump_catalog", company_id, catalog, reason))  # The hub process owns the versions.
+        with self._lock:
+            version = self._catalog_versions[(company_id, catalog)] = self._catalog_versions.get((company_id, catalog), 0) + 1
+        self.publish(company_id, "catalog", {"catalog": catalog, "version": version, "reason": reason})
+
+    # --- RELAY (between worker processes) ---
+
+    def _forward(self, message):
+        relay = self._relay
+        try:
+            if relay is not None: relay.put_nowait(message)
+        except queue.Full:
+            metrics.inc("event_stream_dropped_total", reason="relay")
+
+    def _run_relay_client(self, relay, address, authkey):
+        """Sends queued publishes to the hub process, reconnecting once per message if it went away."""
+        conn = None
+        while True:
+            message = relay.get()
+            if message is None: break
+            for attempt in range(2):
+                try:
+                    if conn is None: conn = Client(address, authkey=authkey)
+                    conn.send(message); break
+                except (OSError, EOFError) as e:
+                    conn = None
+                    if attempt:
+                        metrics.inc("event_stream_dropped_total", reason="relay")
+                        logger.warning(f"Events: hub process unreachable at {address}: {e}")
+        if conn is not None: conn.close()
+
+    def _serve_relay(self, listener):
+        while True:
+            try:
+                conn = listener.accept()
+            except OSError:
+                return
+            except Exception as e:
+                logger.warning(f"Events: rejected relay connection: {e}"); continue
+            if self._relay_listener is not listener:
+                conn.close(); return  # Woken by stop().
+            threading.Thread(target=self._handle_relay, args=(conn,), name="event-relay-conn", daemon=True).start()
+
+    def _handle_relay(self, conn):
+        try:
+            while True:
+                try: op, *args = conn.recv()
+                except (EOFError, OSError): break
+                if op == "publish": self.publish(*args)
+                elif op == "bump_catalog": self.bump_catalog(*args)
+        finally:
+            conn.close()
+
+    # --- DELIVERY (event loop thread) ---
+
+    def _fan_out(self, company_id, entry):
+        for sub in list(self._subscribers.get(company_id, ())):
+            try:
+                sub.queue.put_nowait(entry)
+            except asyncio.QueueFull:
+                metrics.inc("event_stream_dropped_total", reason="slow_consumer")
+                self._subscribers[company_id].discard(sub); sub.task.cancel()
+
+    def _replay(self, company_id, last_event_id):
+        """(events after `last_event_id`, whether the client must reset); call under the publish lock."""
+        if not last_event_id:
+            return [], False
+        epoch, _, seq = last_event_id.partition("-")
+        try: seq = int(seq)
+        except ValueError: return [], True
+        buffer = self._buffers.get(company_id, ())
+        # Sequence numbers are shared by all companies; events were lost only if the buffer has evicted some.
+        if epoch != self.epoch or (len(buffer) == BUFFER_SIZE and seq < buffer[0][0]):
+            return [], True
+        return [entry for entry in buffer if entry[0] > seq], False
+
+    async def _read_request(self, reader):
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), REQUEST_TIMEOUT)
+        lines = head.decode("latin-1").split("\r\n")
+        method, target, _ = lines[0].split(" ", 2)
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(":")
+            if sep: headers[name.strip().lower()] = value.strip()
+        return method, urlsplit(target), headers
+
+    async def _handle(self, reader, writer):
+        sub = None
+        try:
+            try:
+                method, url, headers = await self._read_request(reader)
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ValueError):
+                writer.write(_http_error("400 Bad Request", "Malformed request.")); return
+            if method == "OPTIONS":
+                writer.write(f"HTTP/1.1 204 No Content\r\n{CORS_HEADERS}Content-Length: 0\r\nConnection: close\r\n\r\n".encode("ascii")); return
+            if method != "GET" or url.path.rstrip("/") != "/events":
+                writer.write(_http_error("404 Not Found", "Only GET /events is served here.")); return
+            query = parse_qs(url.query)
+            auth = headers.get("authorization", "")
+            token = auth.split(" ", 1)[1] if auth.lower().startswith("bearer ") else (query.get("token") or [None])[0]
+            try:
+                if not token: raise AuthError("Token is missing!")
+                company_id, expires_at = self.authenticate(token)
+            except AuthError as e:
+                writer.write(_http_error("401 Unauthorized", str(e))); return
+            if sum(len(subs) for subs in self._subscribers.values()) >= MAX_SUBSCRIBERS:
+                metrics.inc("event_stream_rejected_total", reason="subscribers")
+                writer.write(_http_error("503 Service Unavailable", "Too many event stream subscribers.")); return
+
+            with self._lock:
+                backlog, reset = self._replay(company_id, headers.get("last-event-id") or (query.get("last_event_id") or [None])[0])
+                # Everything up to here is either in the backlog or was published before the client asked.
+                sub = _Subscriber(company_id, self._seq)
+            self._subscribers.setdefault(company_id, set()).add(sub)
+            writer.write((f"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream; charset=utf-8\r\nCache-Control: no-cache\r\n"
+                          f"X-Accel-Buffering: no\r\n{CORS_HEADERS}Connection: keep-alive\r\n\r\nretry: {RECONNECT_MS}\n\n").encode("ascii"))
+            if reset:
+                writer.write(_frame(f"{self.epoch}-{sub.last_seq}", "reset", '{"reason":"history_unavailable"}'))
+            for entry in backlog:
+                writer.write(_frame(f"{self.epoch}-{entry[0]}", entry[1], entry[2]))
+            await writer.drain()
+            deadline = expires_at - time.time() if expires_at else None
+            started = time.monotonic()
+            # Clients send nothing after the request, so a completed read means they hung up.
+            closed = asyncio.ensure_future(reader.read(1))
+            try:
+                while True:
+                    timeout = HEARTBEAT_SECONDS
+                    if deadline is not None:
+                        timeout = min(timeout, deadline - (time.monotonic() - started))
+                        if timeout <= 0:
+                            writer.write(_frame(f"{self.epoch}-{sub.last_seq}", "expired", '{"reason":"token_expired"}')); break
+                    get = asyncio.ensure_future(sub.queue.get())
+                    await asyncio.wait((get, closed), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                    if closed.done():
+                        get.cancel(); break
+                    if not get.done():
+                        get.cancel(); writer.write(b": keep-alive\n\n")
+                    else:
+                        entry = get.result()
+                        if entry[0] <= sub.last_seq: continue  # Covered by the replay, or older than the subscription.
+                        writer.write(_frame(f"{self.epoch}-{entry[0]}", entry[1], entry[2])); sub.last_seq = entry[0]
+                    await writer.drain()
+            finally:
+                closed.cancel()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        except Exception:
+            logger.exception("Events: stream failed")
+        finally:
+            if sub is not None:
+                subs = self._subscribers.get(sub.company)
+                if subs is not None:
+                    subs.discard(sub)
+                    if not subs: del self._subscribers[sub.company]
+            try:
+                writer.close()
+            except Exception:
+                pass
+
+    # --- LIFECYCLE ---
+
+    def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT, relay_address=None, authkey=None):
+        """
+        Serves the stream on a daemon thread and, with `relay_address`, accepts
+        publishes from other processes there. If the port is taken and a relay
+        address is given, forwards this process's events to it instead.
+        Returns whether this process serves the stream.
+        """
+        self.stop()
+        started, result = threading.Event(), {}
+        def run():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                self._server = loop.run_until_complete(asyncio.start_server(self._handle, host, port, limit=MAX_REQUEST_BYTES))
+            except OSError as e:
+                result["error"] = e; started.set(); loop.close(); return
+            with self._lock: self._loop = loop
+            self.address = (host, port)
+            started.set()
+            try:
+                loop.run_forever()
+            finally:
+                tasks = asyncio.all_tasks(loop)
+                for task in tasks: task.cancel()
+                loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+                loop.close()
+        self._thread = threading.Thread(target=run, name="event-stream", daemon=True)
+        self._thread.start()
+        started.wait()
+        if "error" in result:
+            self._thread = None
+            if relay_address:
+                logger.info(f"Events: {host}:{port} is served by another process; forwarding events to it at {relay_address}")
+                self._relay = queue.Queue(RELAY_QUEUE_SIZE)
+                self._relay_thread = threading.Thread(target=self._run_relay_client, args=(self._relay, relay_address, authkey),
+                                                      name="event-relay", daemon=True)
+                self._relay_thread.start()
+                self.address = (host, port)
+            else:
+                logger.error(f"Events: could not listen on {host}:{port}: {result['error']}; the event stream is disabled.")
+            return False
+        if relay_address:
+            try:
+                if not relay_address.startswith("\\\\") and os.path.exists(relay_address):
+                    os.remove(relay_address)  # Stale socket; the process holding the port owns the relay.
+                self._relay_listener, self._relay_authkey = Listener(relay_address, authkey=authkey), authkey
+                threading.Thread(target=self._serve_relay, args=(self._relay_listener,), name="event-relay", daemon=True).start()
+            except OSError as e:
+                logger.error(f"Events: could not listen for other processes on {relay_address}: {e}")
+        logger.info(f"Events: serving the event stream on {host}:{port}")
+        return True
+
+    def stop(self):
+        """Closes the listener and every open stream; clients reconnect to the new listener."""
+        with self._lock:
+            loop, self._loop = self._loop, None
+        relay, self._relay = self._relay, None
+        if relay is not None:
+            try: relay.put(None, timeout=1)
+            except queue.Full: pass
+            self._relay_thread.join(5)
+            self._relay_thread = self.address = None
+        listener, self._relay_listener = self._relay_listener, None
+        if listener is not None:
+            try: Client(listener.address, authkey=self._relay_authkey).close()  # Wakes the accepting thread.
+            except (OSError, EOFError): pass
+            listener.close()
+        if loop is None:
+            return
+        def shutdown():
+            self._server.close()
+            loop.stop()  # run() cancels the open streams.
+        loop.call_soon_threadsafe(shutdown)
+        self._thread.join(5)
+        self._thread = self.address = None
+
+    def subscriber_counts(self):
+        return {company: len(subs) for company, subs in list(self._subscribers.items())}
@@ -0,0 +1,440 @@
+# file_share.py
+"""
+Server share browsing helpers.
+
+Listings are built on os.scandir, which gets entry types from the directory
+read itself, so each file costs at most one stat (for its size and mtime).
+Recursive directory sizes come from `DirectorySizeIndex`, a cache that upload
+paths invalidate together with every ancestor directory. `ListingCache` keeps
+scanned listings and their sort orders the same way, so paging through a
+folder of tens of thousands of files scans and sorts it once.
+
+Large files can be uploaded in chunks: an upload is registered, its chunks
+are streamed into a part file at the given offsets (re-sending a chunk is
+harmless), and finalizing checks the size and SHA-256 before renaming the
+part file into place. Abandoned uploads are garbage-collected.
+
+Folders download as a zip streamed while it is produced. The archive bytes
+are deterministic for a given set of files, which makes them resumable with
+Range/If-Range like plain files.
+"""
+import os
+import re
+import json
+import time
+import uuid
+import base64
+import hashlib
+import bisect
+import zipfile
+import threading
+from collections import OrderedDict
+
+import metrics
+
+SORT_FIELDS = ("name", "size", "mtime")
+DEFAULT_PAGE_SIZE = 200
+MAX_PAGE_SIZE = 1000
+MAX_LIST_DEPTH = 32
+
+class DirectorySizeIndex:
+    """
+    Caches recursive directory sizes (bytes, file count). Entries are dropped
+    when something is written below them through the server, and expire after
+    `ttl_seconds` to pick up changes made to the share by other means.
+    """
+    def __init__(self, ttl_seconds=300):
+        self.ttl_seconds = ttl_seconds
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        path = os.path.abspath(path)
+        with self._lock:
+            cached = self._sizes.get(path)
+        hit = bool(cached and time.monotonic() - cached[2] < self.ttl_seconds)
+        metrics.cache_lookup("share_dir_sizes", hit)
+        if hit:
+            return cached[0], cached[1]
+        total_bytes, file_count = 0, 0
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.name == UPLOAD_DIR:
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        sub_bytes, sub_count = self.get(entry.path)
+                        total_bytes += sub_bytes; file_count += sub_count
+                    elif entry.is_file(follow_symlinks=False):
+                        total_bytes += entry.stat(follow_symlinks=False).st_size; file_count += 1
+        except (FileNotFoundError, PermissionError, NotADirectoryError):
+            return 0, 0
+        with self._lock:
+            self._sizes[path] = (total_bytes, file_count, time.monotonic())
+        return total_bytes, file_count
+
+    def invalidate(self, path, root=None):
+        """Forgets `path` and all of its ancestors (up to `root`, if given)."""
+        path = os.path.abspath(path)
+        root = os.path.abspath(root) if root else None
+        with self._lock:
+            while True:
+                self._sizes.pop(path, None)
+                parent = os.path.dirname(path)
+                if parent == path or (root and path == root):
+                    break
+                path = parent
+
+def scan_entries(base_path, depth, dir_sizes=None, _rel_dir=""):
+    """
+    Lists entries below `base_path` down to `depth` levels (1 = direct
+    children). Each entry has name, path (relative to base_path), type, size
+    and mtime; directory sizes are filled from `dir_sizes` when given.
+    """
+    entries = []
+    with os.scandir(os.path.join(base_path, _rel_dir)) as it:
+        for entry in it:
+            if entry.name == UPLOAD_DIR:
+                continue
+            rel_path = f"{_rel_dir}/{entry.name}" if _rel_dir else entry.name
+            is_dir = entry.is_dir(follow_symlinks=False)
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue  # Removed between the directory read and the stat.
+            item = {"name": entry.name, "path": rel_path, "type": "dir" if is_dir else "file",
+                    "size": 0 if is_dir else st.st_size, "mtime": st.st_mtime}
+            if is_dir and dir_sizes is not None:
+                item["size"], item["file_count"] = dir_sizes.get(entry.path)
+            entries.append(item)
+            if is_dir and depth > 1:
+                entries.extend(scan_entries(base_path, depth - 1, dir_sizes, rel_path))
+    return entries
+
+class ListingCache:
+    """
+    Caches scanned listings by (folder, depth, with directory sizes) together
+    with their order for each sort field, least recently used first out.
+    Invalidated like `DirectorySizeIndex` (a write below a folder drops the
+    listings of it and its ancestors) and expiring after `ttl_seconds`.
+    """
+    def __init__(self, ttl_seconds=60, max_listings=32):
+        self.ttl_seconds, self.max_listings = ttl_seconds, max_listings
+        self._listings = OrderedDict()  # (path, depth, dir_sizes) -> {"entries", "created", "orders": {sort: (keys, items)}}
+        self._lock = threading.Lock()
+
+    def _listing(self, path, depth, dir_sizes):
+        key = (os.path.abspath(path), depth, dir_sizes is not None)
+        with self._lock:
+            listing = self._listings.get(key)
+            if listing and time.monotonic() - listing["created"] < self.ttl_seconds:
+                self._listings.move_to_end(key)
+            else:
+                listing = None
+        metrics.cache_lookup("share_listings", listing is not None)
+        if listing is None:
+            listing = {"entries": scan_entries(path, depth, dir_sizes), "created": time.monotonic(), "orders": {}}
+            with self._lock:
+                self._listings[key] = listing
+                while len(self._listings) > self.max_listings: self._listings.popitem(last=False)
+        return listing
+
+    def entries(self, path, depth, dir_sizes=None):
+        return self._listing(path, depth, dir_sizes)["entries"]
+
+    def paginate(self, path, depth, dir_sizes=None, sort="name", descending=False, limit=DEFAULT_PAGE_SIZE, cursor=None):
+        """Like `paginate` over the folder's listing; returns (page, next_cursor, total)."""
+        if sort not in SORT_FIELDS:
+            raise ValueError(f"sort must be one of {', '.join(SORT_FIELDS)}")
+        listing = self._listing(path, depth, dir_sizes)
+        orders = listing["orders"]
+        if sort not in orders:
+            orders[sort] = _order(listing["entries"], sort)  # Racing requests compute the same order.
+        page, next_cursor = _page(orders[sort], sort, descending, limit, cursor)
+        return page, next_cursor, len(listing["entries"])
+
+    def invalidate(self, path, root=None):
+        """Forgets listings of `path` and of every folder above it (recursive listings include it)."""
+        path = os.path.abspath(path)
+        with self._lock:
+            for key in [k for k in self._listings if path == k[0] or path.startswith(k[0].rstrip(os.sep) + os.sep)]:
+                del self._listings[key]
+
+def _sort_key(item, sort):
+    value = item["name"].lower() if sort == "name" else item[sort]
+    # Directories first (in ascending order), then the requested field, then path as a unique tie-breaker.
+    return (0 if item["type"] == "dir" else 1, value, item["path"])
+
+def encode_cursor(key, sort, descending):
+    return base64.urlsafe_b64encode(json.dumps({"sort": sort, "desc": descending, "key": list(key)}).encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor, sort, descending):
+    """The sort key in `cursor`; ValueError if it is malformed or was issued for another sort or order."""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        key = tuple(data["key"])
+        valid = len(key) == 3 and all(isinstance(v, t) for v, t in zip(key, (int, str if sort == "name" else (int, float), str)))
+    except (ValueError, TypeError, KeyError, AttributeError):
+        raise ValueError("Invalid cursor")
+    if (data.get("sort"), data.get("desc")) != (sort, descending) or not valid:
+        raise ValueError("Cursor belongs to a different sort or order; start again without a cursor")
+    return key
+
+def _order(entries, sort):
+    if sort not in SORT_FIELDS:
+        raise ValueError(f"sort must be one of {', '.join(SORT_FIELDS)}")
+    keyed = sorted(((_sort_key(item, sort), item) for item in entries), key=lambda pair: pair[0])
+    return [k for k, _ in keyed], [item for _, item in keyed]
+
+def _page(ordered, sort, descending, limit, cursor):
+    keys, items = ordered
+    if descending:
+        end = bisect.bisect_left(keys, decode_cursor(cursor, sort, descending)) if cursor else len(items)
+        page = list(reversed(items[max(end - limit, 0):end]))
+        more = end - limit > 0
+    else:
+        start = bisect.bisect_right(keys, decode_cursor(cursor, sort, descending)) if cursor else 0
+        page = items[start:start + limit]
+        more = start + limit < len(items)
+    next_cursor = encode_cursor(_sort_key(page[-1], sort), sort, descending) if page and more else None
+    return page, next_cursor
+
+def paginate(entries, sort="name", descending=False, limit=DEFAULT_PAGE_SIZE, cursor=None):
+    """
+    Sorts entries and returns (page, next_cursor). The cursor encodes the sort
+    field, order and the last item's sort key, so pages stay consistent while
+    files are added or removed.
+    """
+    if sort not in SORT_FIELDS:
+        raise ValueError(f"sort must be one of {', '.join(SORT_FIELDS)}")
+    return _page(_order(entries, sort), sort, descending, limit, cursor)
+
+# --- RESUMABLE UPLOADS ---
+
+# Partial uploads live inside the share so finalizing is a same-filesystem rename.
+UPLOAD_DIR = ".partial_uploads"
+UPLOAD_MAX_AGE = 24 * 3600
+COPY_BLOCK = 1024 * 1024
+_UPLOAD_ID = re.compile(r'^[0-9a-f]{32}$')
+
+def _upload_paths(share_dir, upload_id):
+    if not _UPLOAD_ID.match(upload_id or ""):
+        return None, None
+    base = os.path.join(share_dir, UPLOAD_DIR, upload_id)
+    return base + ".json", base + ".part"
+
+def create_upload(share_dir, dest_dir, filename, size, sha256=None):
+    """Registers an upload of `size` bytes to `dest_dir`/`filename` (dest_dir relative to the share)."""
+    os.makedirs(os.path.join(share_dir, UPLOAD_DIR), exist_ok=True)
+    upload_id = uuid.uuid4().hex
+    state_path, part_path = _upload_paths(share_dir, upload_id)
+    state = {"id": upload_id, "dest_dir": dest_dir, "filename": filename, "size": int(size),
+             "sha256": sha256.lower() if sha256 else None, "created_at": time.time()}
+    open(part_path, 'wb').close()
+    with open(state_path, 'w') as f: json.dump(state, f)
+    return dict(state, received=0)
+
+def get_upload(share_dir, upload_id):
+    state_path, part_path = _upload_paths(share_dir, upload_id)
+    if not state_path or not os.path.exists(state_path):
+        return None
+    with open(state_path) as f: state = json.load(f)
+    state["received"] = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    return state
+
+def write_chunk(share_dir, upload_id, offset, stream):
+    """
+    Streams a chunk into the part file at `offset`. Chunks may be re-sent
+    (offset below what was received) but may not leave gaps or run past the
+    declared size. Returns the number of bytes received so far.
+    """
+    state = get_upload(share_dir, upload_id)
+    if state is None:
+        raise KeyError(upload_id)
+    if offset < 0 or offset > state["received"]:
+        raise ValueError(f"offset must be between 0 and {state['received']}")
+    _, part_path = _upload_paths(share_dir, upload_id)
+    position = offset
+    with open(part_path, 'r+b') as f:
+        f.seek(offset)
+        while True:
+            block = stream.read(COPY_BLOCK)
+            if not block:
+                break
+            if position + len(block) > state["size"]:
+                raise ValueError(f"chunk runs past the declared size of {state['size']} bytes")
+            f.write(block); position += len(block)
+    return max(state["received"], position)
+
+def complete_upload(share_dir, upload_id, sha256=None):
+    """Verifies size and checksum, then moves the file into place. Returns its final path."""
+    state = get_upload(share_dir, upload_id)
+    if state is None:
+        raise KeyError(upload_id)
+    if state["received"] != state["size"]:
+        raise ValueError(f"received {state['received']} of {state['size']} bytes")
+    state_path, part_path = _upload_paths(share_dir, upload_id)
+    expected = (sha256 or state["sha256"] or "").lower()
+    if expected:
+        digest = hashlib.sha256()
+        with open(part_path, 'rb') as f:
+            for block in iter(lambda: f.read(COPY_BLOCK), b""):
+                digest.update(block)
+        if digest.hexdigest() != expected:
+            raise ValueError("checksum mismatch")
+    final_path = os.path.join(share_dir, state["dest_dir"], state["filename"])
+    os.makedirs(os.path.dirname(final_path), exist_ok=True)
+    os.replace(part_path, final_path)
+    os.remove(state_path)
+    return final_path
+
+def abort_upload(share_dir, upload_id):
+    state_path, part_path = _upload_paths(share_dir, upload_id)
+    if not state_path or not os.path.exists(state_path):
+        return False
+    for path in (part_path, state_path):
+        try: os.remove(path)
+        except FileNotFoundError: pass
+    return True
+
+def collect_stale_uploads(share_dir, max_age=UPLOAD_MAX_AGE):
+    """Removes partial uploads with no activity (part file writes) for `max_age` seconds."""
+    upload_dir = os.path.join(share_dir, UPLOAD_DIR)
+    if not os.path.isdir(upload_dir):
+        return 0
+    cutoff, removed = time.time() - max_age, 0
+    with os.scandir(upload_dir) as entries:
+        for entry in entries:
+            upload_id, ext = os.path.splitext(entry.name)
+            if ext != ".json":
+                continue
+            _, part_path = _upload_paths(share_dir, upload_id)
+            try:
+                last_activity = os.path.getmtime(part_path) if part_path and os.path.exists(part_path) else entry.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            if last_activity < cutoff and abort_upload(share_dir, upload_id):
+                removed += 1
+    return removed
+
+# --- FOLDER ARCHIVES ---
+
+# Formats that are already compressed are stored as-is; everything else is deflated.
+STORED_EXTENSIONS = {".zip", ".3mf", ".gz", ".tgz", ".bz2", ".xz", ".7z", ".rar", ".png", ".jpg", ".jpeg",
+                     ".webp", ".gif", ".mp4", ".mov", ".mkv", ".webm", ".mp3", ".pdf", ".xlsx", ".docx", ".bgcode"}
+ARCHIVE_LAYOUT_CACHE_SIZE = 32
+_archive_layouts = {}  # etag -> (total length, [(entry index, ZipInfo with header offset and sizes)])
+_archive_layouts_lock = threading.Lock()
+
+def archive_entries(dir_path):
+    """Files below `dir_path` as (path, archive name) in a stable order."""
+    entries = []
+    for root, dirnames, filenames in os.walk(dir_path):
+        dirnames[:] = sorted(d for d in dirnames if d != UPLOAD_DIR)
+        rel_root = os.path.relpath(root, dir_path)
+        for filename in sorted(filenames):
+            arcname = filename if rel_root == "." else f"{rel_root}/{filename}".replace(os.sep, "/")
+            entries.append((os.path.join(root, filename), arcname))
+    return entries
+
+def archive_etag(entries):
+    """Identifies the archive's exact bytes: the same files, sizes and mtimes always produce the same zip."""
+    digest = hashlib.sha1()
+    for path, arcname in entries:
+        try: st = os.stat(path)
+        except FileNotFoundError: continue
+        digest.update(f"{arcname}\0{st.st_size}\0{st.st_mtime_ns}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+class _ZipSink:
+    """
+    Write-only, unseekable target for ZipFile; the archive is drained as it is
+    produced. `tell` lets ZipFile continue an archive from `offset`.
+    """
+    def __init__(self, offset=0):
+        self._chunks, self._offset = [], offset
+    def write(self, data):
+        self._chunks.append(bytes(data)); self._offset += len(data); return len(data)
+    def tell(self):
+        return self._offset
+    def flush(self):
+        pass
+    def take(self):
+        data = b"".join(self._chunks); self._chunks = []
+        return data
+
+def iter_archive(entries, start=0, end=None, etag=None):
+    """
+    Yields the zip of `entries`, optionally only bytes start..end (inclusive).
+    Memory use is bounded by one read block. The output is deterministic, so a
+    byte range is served by regenerating the archive. Once the layout of `etag`
+    is known (from any complete pass) members before the one holding `start`
+    are not compressed again: their cached headers go straight into the
+    central directory and generation begins at that member.
+    """
+    first, offset, done = 0, 0, []
+    layout = _cached_layout(etag) if etag and start else None
+    if layout:
+        members = layout[1]
+        k = bisect.bisect_right([info.header_offset for _, info in members], start) - 1
+        if k > 0:
+            first, offset, done = members[k][0], members[k][1].header_offset, [info for _, info in members[:k]]
+    sink, position, written = _ZipSink(offset), offset, []
+
+    def drain():
+        nonlocal position
+        data = sink.take()
+        chunk_start = position; position += len(data)
+        lo = max(start - chunk_start, 0)
+        hi = len(data) if end is None else min(end + 1 - chunk_start, len(data))
+        return data[lo:hi] if lo < hi else b""
+
+    with zipfile.ZipFile(sink, 'w') as archive:
+        for info in done:
+            archive.filelist.append(info); archive.NameToInfo[info.filename] = info
+        for index in range(first, len(entries)):
+            path, arcname = entries[index]
+            if end is not None and position > end:
+                return
+            try:
+                zinfo = zipfile.ZipInfo.from_file(path, arcname)
+                src = open(path, 'rb')
+            except FileNotFoundError:
+                continue  # Deleted since the listing was taken.
+            ext = os.path.splitext(arcname)[1].lower()
+            zinfo.compress_type = zipfile.ZIP_STORED if ext in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+            with src, archive.open(zinfo, 'w') as dst:
+                for block in iter(lambda: src.read(COPY_BLOCK), b""):
+                    dst.write(block)
+                    out = drain()
+                    if out: yield out
+            written.append(index)
+            out = drain()
+            if out: yield out
+    out = drain()
+    if out: yield out
+    if etag and not done:
+        _remember_layout(etag, position, list(zip(written, archive.filelist)))
+
+def _remember_layout(etag, length, members):
+    with _archive_layouts_lock:
+        if len(_archive_layouts) >= ARCHIVE_LAYOUT_CACHE_SIZE:
+            _archive_layouts.pop(next(iter(_archive_layouts)))
+        _archive_layouts[etag] = (length, members)
+
+def _cached_layout(etag):
+    with _archive_layouts_lock:
+        return _archive_layouts.get(etag)
+
+def archive_length(entries, etag):
+    """Total archive size: known once any complete pass over this etag finished, otherwise measured by one."""
+    layout = _cached_layout(etag)
+    metrics.cache_lookup("archive_layouts", layout is not None)
+    if layout is None:
+        for _ in iter_archive(entries, etag=etag): pass  # Also records the member layout for range requests.
+        layout = _cached_layout(etag)
+    return layout[0]
+
+def cached_archive_length(etag):
+    layout = _cached_layout(etag)
+    return layout[0] if layout else None
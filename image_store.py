@@ -0,0 +1,256 @@
+# image_store.py
+"""
+Content-addressed storage for job screenshots.
+
+Blobs live under data/<company_id>/image_blobs/<aa>/<bb>/<sha256><ext>, so
+identical uploads are stored once whatever part name they were saved under.
+The `image_refs` table maps the user-facing filename to the current blob and
+`image_blobs.refcount` counts the names and job records pointing at each blob;
+`collect_garbage` removes blobs nothing points to any more. Old blobs may
+have been recompressed by archival.py to <sha256><archived_ext>; the hash
+stays the blob's identity and `stored_path` finds whichever file exists.
+"""
+import os
+import time
+import hashlib
+import argparse
+import threading
+from datetime import datetime
+from PIL import Image
+
+import metrics
+
+# Longest-edge pixel sizes clients may request through /images/<file>?size=...
+VARIANT_SIZES = {"128": 128, "512": 512}
+VARIANT_DIR = "_variants"
+VARIANT_EXT = ".webp"
+BLOB_DIR = "image_blobs"
+LEGACY_DIR = "local_log_images"
+# Files on disk without a database row are only collected after this grace
+# period, so uploads still inside their processing transaction are left alone.
+ORPHAN_GRACE_SECONDS = 3600
+_CHUNK_SIZE = 1024 * 1024
+
+def _tmp_suffix():
+    return f"{os.getpid()}.{threading.get_ident()}.tmp"
+
+# --- BLOB FILES ---
+
+def blob_path(blob_root, digest, ext):
+    return os.path.join(blob_root, digest[:2], digest[2:4], f"{digest}{ext}")
+
+def stored_path(blob_root, blob):
+    """Path of a blob row's file: the original, or its archived recompression once the original is gone."""
+    path = blob_path(blob_root, blob['hash'], blob['ext'])
+    if blob['archived_ext'] and not os.path.exists(path):
+        return blob_path(blob_root, blob['hash'], blob['archived_ext'])
+    return path
+
+def save_blob(blob_root, stream, ext):
+    """
+    Streams an upload into the blob store while hashing it. Returns
+    (digest, path, size); an existing blob with the same content is reused.
+    """
+    os.makedirs(blob_root, exist_ok=True)
+    tmp_path = os.path.join(blob_root, f"upload.{_tmp_suffix()}")
+    hasher, size = hashlib.sha256(), 0
+    try:
+        with open(tmp_path, 'wb') as f:
+            while True:
+                chunk = stream.read(_CHUNK_SIZE)
+                if not chunk: break
+                hasher.update(chunk); f.write(chunk); size += len(chunk)
+        digest = hasher.hexdigest()
+        path = blob_path(blob_root, digest, ext)
+        if os.path.exists(path):
+            # Refresh the mtime so a concurrent garbage collection leaves it alone.
+            os.remove(tmp_path); os.utime(path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+        return digest, path, size
+    except Exception:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        raise
+
+# --- DATABASE REFERENCES (run inside the caller's transaction) ---
+
+def _adjust_refcount(conn, company_id, digest, delta):
+    conn.execute("UPDATE image_blobs SET refcount = refcount + ? WHERE company_id = ? AND hash = ?",
+                 (delta, company_id, digest))
+
+def link_name(conn, company_id, name, digest, ext, size):
+    """Points `name` at a blob, registering the blob and moving the name's reference."""
+    conn.execute("""
+        INSERT OR IGNORE INTO image_blobs (company_id, hash, ext, size, refcount, created_at)
+        VALUES (?, ?, ?, ?, 0, ?)""", (company_id, digest, ext, size, datetime.utcnow().isoformat()))
+    old = conn.execute("SELECT hash FROM image_refs WHERE company_id = ? AND name = ?", (company_id, name)).fetchone()
+    if old and old['hash'] == digest:
+        return
+    if old:
+        _adjust_refcount(conn, company_id, old['hash'], -1)
+    conn.execute("INSERT OR REPLACE INTO image_refs (company_id, name, hash) VALUES (?, ?, ?)", (company_id, name, digest))
+    _adjust_refcount(conn, company_id, digest, 1)
+
+def add_reference(conn, company_id, digest):
+    """Records one more holder (e.g. a job record) of a blob."""
+    _adjust_refcount(conn, company_id, digest, 1)
+
+def resolve_name(conn, company_id, name):
+    """Returns the blob row (hash, ext, size, archived_ext) the filename currently points at, or None."""
+    return conn.execute("""
+        SELECT b.hash, b.ext, b.size, b.archived_ext FROM image_refs r
+        JOIN image_blobs b ON b.company_id = r.company_id AND b.hash = r.hash
+        WHERE r.company_id = ? AND r.name = ?""", (company_id, name)).fetchone()
+
+# --- VARIANTS ---
+
+def parse_variant_size(size_param):
+    """Maps the `size` query parameter to a pixel size; None means the original."""
+    if size_param in (None, "", "orig", "original"):
+        return None
+    if size_param not in VARIANT_SIZES:
+        raise ValueError(f"Unsupported size '{size_param}'. Use one of: {', '.join(VARIANT_SIZES)} or 'orig'.")
+    return VARIANT_SIZES[size_param]
+
+def get_variant_path(original_path, pixels):
+    """
+    Returns the path of the resized WebP variant of an image, generating it on
+    first request. Variants are cached in a `_variants` folder next to the
+    original and regenerated whenever the original is newer than the cache.
+    """
+    variant_dir = os.path.join(os.path.dirname(original_path), VARIANT_DIR)
+    variant_path = os.path.join(variant_dir, f"{os.path.basename(original_path)}.{pixels}{VARIANT_EXT}")
+    try:
+        if os.stat(variant_path).st_mtime_ns >= os.stat(original_path).st_mtime_ns:
+            metrics.cache_lookup("image_variants", True)
+            return variant_path
+    except FileNotFoundError:
+        pass
+    metrics.cache_lookup("image_variants", False)
+
+    os.makedirs(variant_dir, exist_ok=True)
+    with Image.open(original_path) as img:
+        img.thumbnail((pixels, pixels))
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "transparency" in img.info else "RGB")
+        # Write to a temp name first so concurrent requests never see a partial file.
+        tmp_path = f"{variant_path}.{_tmp_suffix()}"
+        img.save(tmp_path, "WEBP", quality=80, method=4)
+    os.replace(tmp_path, variant_path)
+    return variant_path
+
+def image_etag(original_path, pixels, digest=None, archived=False):
+    """Blobs use their content hash (plus a marker once recompressed); legacy files fall back to mtime and size."""
+    if digest:
+        return f"{digest}-{'a' if archived else ''}{pixels or 'orig'}"
+    st = os.stat(original_path)
+    return f"{st.st_mtime_ns:x}-{st.st_size:x}-{pixels or 'orig'}"
+
+# --- MAINTENANCE ---
+
+def remove_variants(blob_root, digest, ext):
+    variant_dir = os.path.join(os.path.dirname(blob_path(blob_root, digest, ext)), VARIANT_DIR)
+    removed = 0
+    for candidate in [os.path.join(variant_dir, f"{digest}{ext}.{p}{VARIANT_EXT}") for p in VARIANT_SIZES.values()]:
+        try: os.remove(candidate); removed += 1
+        except FileNotFoundError: pass
+    return removed
+
+def _remove_blob_files(blob_root, digest, ext, archived_ext=None):
+    removed = 0
+    for file_ext in filter(None, {ext, archived_ext}):
+        removed += remove_variants(blob_root, digest, file_ext)
+        try: os.remove(blob_path(blob_root, digest, file_ext)); removed += 1
+        except FileNotFoundError: pass
+    return removed
+
+def collect_garbage(conn, company_id, blob_root, grace_seconds=ORPHAN_GRACE_SECONDS):
+    """
+    Deletes blobs with no remaining references, plus files left on disk by
+    uploads whose job never committed. Returns counts for reporting.
+    """
+    stats = {"blobs_removed": 0, "orphan_files_removed": 0}
+    cutoff = time.time() - grace_seconds
+    dead = conn.execute("SELECT hash, ext, archived_ext FROM image_blobs WHERE company_id = ? AND refcount <= 0",
+                        (company_id,)).fetchall()
+    for row in dead:
+        path = stored_path(blob_root, row)
+        if os.path.exists(path) and os.path.getmtime(path) > cutoff:
+            continue
+        conn.execute("DELETE FROM image_blobs WHERE company_id = ? AND hash = ? AND refcount <= 0", (company_id, row['hash']))
+        conn.commit()
+        _remove_blob_files(blob_root, row['hash'], row['ext'], row['archived_ext'])
+        stats["blobs_removed"] += 1
+
+    if not os.path.isdir(blob_root):
+        return stats
+    # A blob row owns its original and archived file only: the same content uploaded under another
+    # extension is written as a second file that no row points at.
+    known = set()
+    for row in conn.execute("SELECT hash, ext, archived_ext FROM image_blobs WHERE company_id = ?", (company_id,)):
+        known.add((row['hash'], row['ext']))
+        if row['archived_ext']: known.add((row['hash'], row['archived_ext']))
+    for dirpath, dirnames, filenames in os.walk(blob_root):
+        dirnames[:] = [d for d in dirnames if d != VARIANT_DIR]
+        for fname in filenames:
+            full_path = os.path.join(dirpath, fname)
+            digest = fname.split('.', 1)[0]; ext = fname[len(digest):]
+            if (digest, ext) in known or os.path.getmtime(full_path) > cutoff:
+                continue
+            if fname.startswith("upload.") or ext.endswith(".tmp"):
+                os.remove(full_path); stats["orphan_files_removed"] += 1
+            else:
+                stats["orphan_files_removed"] += _remove_blob_files(blob_root, digest, ext)
+    return stats
+
+def migrate_legacy_images(conn, company_id, company_dir):
+    """Moves files from local_log_images into the blob store and links their names."""
+    legacy_dir = os.path.join(company_dir, LEGACY_DIR)
+    blob_root = os.path.join(company_dir, BLOB_DIR)
+    if not os.path.isdir(legacy_dir):
+        return 0
+    migrated = 0
+    for entry in os.scandir(legacy_dir):
+        if not entry.is_file() or resolve_name(conn, company_id, entry.name):
+            continue
+        with open(entry.path, 'rb') as f:
+            digest, _, size = save_blob(blob_root, f, os.path.splitext(entry.name)[1].lower())
+        try:
+            link_name(conn, company_id, entry.name, digest, os.path.splitext(entry.name)[1].lower(), size)
+            jobs = conn.execute("SELECT id FROM jobs WHERE company_id = ? AND image_path = ? AND image_hash IS NULL",
+                                (company_id, entry.name)).fetchall()
+            for job in jobs:
+                conn.execute("UPDATE jobs SET image_hash = ? WHERE id = ?", (digest, job['id']))
+                add_reference(conn, company_id, digest)
+            conn.commit()
+        except Exception:
+            conn.rollback(); raise
+        os.remove(entry.path)
+        migrated += 1
+    return migrated
+
+if __name__ == "__main__":
+    from database import get_db_connection, get_company_db_connection, init_db
+    parser = argparse.ArgumentParser(description="Maintenance for the content-addressed image store.")
+    parser.add_argument("command", choices=["gc", "migrate"])
+    parser.add_argument("--company", help="Limit to one company id (default: all companies)")
+    args = parser.parse_args()
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    os.chdir(script_dir)
+    init_db(script_dir)
+    data_dir = os.path.join(script_dir, "data")
+    directory = get_db_connection()
+    company_ids = [args.company] if args.company else [row['id'] for row in directory.execute("SELECT id FROM companies")]
+    directory.close()
+    for cid in company_ids:
+        company_dir = os.path.join(data_dir, cid)
+        conn = get_company_db_connection(cid)
+        try:
+            if args.command == "migrate":
+                print(f"{cid}: migrated {migrate_legacy_images(conn, cid, company_dir)} legacy image(s)")
+            else:
+                print(f"{cid}: {collect_garbage(conn, cid, os.path.join(company_dir, BLOB_DIR))}")
+        finally:
+            conn.close()
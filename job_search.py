@@ -0,0 +1,192 @@
+# job_search.py
+"""
+Full-text search over processed jobs with SQLite FTS5.
+
+`jobs_fts` holds one row per job: filename, printer, material, brand, the
+OCR text of the slicer screenshot and date terms (year, month, season and
+ISO date, so "petg march 2025" or "spring" match). Its rowid is the job's
+rowid in `jobs`, so results join back through the integer key; the stored
+job_id detects rows whose rowid no longer matches (e.g. after a VACUUM).
+`index_job` runs inside the job-processing transaction; `sync_index`
+catches up on jobs created any other way (legacy imports, sharding) and
+`backfill` rebuilds a company from the jobs table.
+
+Queries are tokenized and every term is matched as a prefix ("lab plat"
+finds "labubu_plate_v2", as the tokenizer splits on punctuation); results
+are ranked with BM25, filename matches weighing most.
+
+    python job_search.py backfill [--company ID]
+
+History from before the jobs table existed (app_logs.json) is imported by
+`python analytics.py rebuild`; run that first so the backfill covers it.
+"""
+import os
+import re
+import argparse
+import unicodedata
+from datetime import datetime
+
+from database import is_sharded
+
+FTS_COLUMNS = ("filename", "printer", "material", "brand", "ocr_text", "date_terms")
+# bm25() weights in FTS_COLUMNS order.
+RANK_WEIGHTS = (10.0, 2.0, 4.0, 3.0, 1.0, 1.0)
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+MAX_QUERY_TERMS = 12
+SNIPPET_TOKENS = 10
+SORTS = ("relevance", "recent")
+WORD = re.compile(r"[^\W_]+")  # Letters and digits, as the unicode61 tokenizer splits them.
+FILTERS = {"material": "j.material", "brand": "j.brand", "printer_id": "j.printer_id"}
+# Words that only make sense in natural phrasing; requiring them would match nothing.
+STOPWORDS = {"a", "an", "and", "at", "for", "from", "in", "last", "of", "on", "that", "the", "this", "with"}
+SEASONS = {12: "winter", 1: "winter", 2: "winter", 3: "spring", 4: "spring", 5: "spring",
+           6: "summer", 7: "summer", 8: "summer", 9: "autumn fall", 10: "autumn fall", 11: "autumn fall"}
+
+# --- INDEXING (run inside the caller's transaction) ---
+
+def date_terms(timestamp):
+    try:
+        dt = datetime.fromisoformat(str(timestamp).replace('Z', ''))
+    except ValueError:
+        return ""
+    return (f"{dt.year} {dt:%Y-%m} {dt:%Y-%m-%d} {dt:%B} {dt:%b} {SEASONS[dt.month]} "
+            f"q{(dt.month - 1) // 3 + 1}").lower()
+
+def _fts_row(job):
+    return (job["id"], job.get("filename") or "", job.get("printer_name") or "", job.get("material") or "", job.get("brand") or "",
+            job.get("ocr_text") or "", date_terms(job.get("timestamp")))
+
+_INSERT = f"INSERT INTO jobs_fts (rowid, job_id, {', '.join(FTS_COLUMNS)}) VALUES (?, ?, {', '.join('?' * len(FTS_COLUMNS))})"
+
+def index_job(conn, job):
+    """Adds a job (a dict with the jobs table's columns, already inserted) to the index. Does not commit."""
+    rowid = conn.execute("SELECT rowid FROM jobs WHERE id = ?", (job["id"],)).fetchone()[0]
+    conn.execute(_INSERT, (rowid,) + _fts_row(job))
+
+def sync_index(conn, company_id=None):
+    """
+    Drops index rows that no longer point at their job and indexes jobs that
+    are missing (all companies when `company_id` is None). Returns the number
+    of jobs indexed. Does not commit.
+    """
+    conn.execute("""DELETE FROM jobs_fts WHERE rowid IN (
+                        SELECT f.rowid FROM jobs_fts f LEFT JOIN jobs j ON j.rowid = f.rowid
+                        WHERE j.id IS NULL OR j.id != f.job_id)""")
+    where, params = ("AND j.company_id = ?", (company_id,)) if company_id else ("", ())
+    rows = conn.execute(f"""SELECT j.rowid AS job_rowid, j.* FROM jobs j LEFT JOIN jobs_fts f ON f.rowid = j.rowid
+                            WHERE f.rowid IS NULL {where}""", params).fetchall()
+    conn.executemany(_INSERT, [(row['job_rowid'],) + _fts_row(dict(row)) for row in rows])
+    return len(rows)
+
+def backfill(conn, company_id):
+    """Rebuilds a company's index entries from its job records. Does not commit."""
+    conn.execute("DELETE FROM jobs_fts WHERE rowid IN (SELECT rowid FROM jobs WHERE company_id = ?)", (company_id,))
+    return sync_index(conn, company_id)
+
+# --- QUERIES ---
+
+def _fold(word):
+    """Lower-cased without diacritics, like the index's tokenizer."""
+    return "".join(ch for ch in unicodedata.normalize("NFKD", word.lower()) if not unicodedata.combining(ch))
+
+def query_terms(text):
+    return [t for t in (_fold(w) for w in WORD.findall(text or "")) if t not in STOPWORDS][:MAX_QUERY_TERMS]
+
+def build_match(terms):
+    """FTS5 MATCH expression: every term as a quoted prefix, all required."""
+    return " ".join(f'"{t}"*' for t in terms)
+
+def highlight(text, terms, window=SNIPPET_TOKENS):
+    """Up to `window` words of `text` around its first match, matches in [brackets]; None if nothing matches."""
+    tokens = list(WORD.finditer(text or ""))
+    hits = {i for i, m in enumerate(tokens) if any(_fold(m.group()).startswith(t) for t in terms)}
+    if not hits:
+        return None
+    first = max(0, min(hits) - 2)
+    last = min(len(tokens), first + window)
+    out, pos = [], tokens[first].start()
+    for i in range(first, last):
+        m = tokens[i]
+        out.append(text[pos:m.start()])
+        out.append(f"[{m.group()}]" if i in hits else m.group())
+        pos = m.end()
+    return ("…" if first else "") + "".join(out) + ("…" if last < len(tokens) else "")
+
+def _snippet(row, terms):
+    """Highlight from the most specific field that matched: filename first, date words last."""
+    for field in ("filename", "printer", "material", "brand", "ocr_text"):
+        snippet = highlight(row[field], terms)
+        if snippet: return snippet
+    return highlight(date_terms(row["timestamp"]), terms)
+
+def search(conn, company_id, text, filters=None, start=None, end=None, sort="relevance", limit=DEFAULT_PAGE_SIZE, offset=0):
+    """
+    Ranked, paginated search. `filters` may hold material, brand and
+    printer_id; `start`/`end` bound the job timestamp (ISO dates, inclusive).
+    Returns (results, next_offset). Raises ValueError for invalid arguments.
+    """
+    if sort not in SORTS:
+        raise ValueError(f"sort must be one of {', '.join(SORTS)}")
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    if offset < 0:
+        raise ValueError("offset must not be negative")
+    terms = query_terms(text)
+    where, params = ["j.company_id = ?"], [company_id]
+    for key, value in (filters or {}).items():
+        if key not in FILTERS: raise ValueError(f"Unknown filter '{key}'")
+        if value: where.append(f"{FILTERS[key]} = ? COLLATE NOCASE"); params.append(value)
+    if start: where.append("j.timestamp >= ?"); params.append(start)
+    if end: where.append("j.timestamp < ?"); params.append(end + "\uffff")  # Inclusive of the whole end day.
+
+    columns = ("j.id AS job_id, j.filename, j.timestamp, j.printer_id, j.printer_name AS printer, j.material, j.brand, "
+               "j.filament_g, j.time_str AS time, j.user_cogs, j.default_cogs, j.image_path, j.ocr_text")
+    bm25 = f"bm25(jobs_fts, {', '.join(map(str, RANK_WEIGHTS))})"
+    if terms and sort == "relevance" and len(where) == 1 and is_sharded():
+        # A shard's index holds only this company: rank inside it and join just the requested page.
+        sql = (f"SELECT {columns} FROM (SELECT rowid, {bm25} AS score FROM jobs_fts WHERE jobs_fts MATCH ? "
+               f"ORDER BY score LIMIT ? OFFSET ?) page JOIN jobs j ON j.rowid = page.rowid "
+               f"WHERE {where[0]} ORDER BY page.score, j.timestamp DESC")
+        params = [build_match(terms), limit + 1, offset] + params
+    elif terms:
+        # CROSS JOIN keeps the index as the outer loop; otherwise SQLite may walk every job by timestamp.
+        order = f"{bm25}, j.timestamp DESC" if sort == "relevance" else "j.timestamp DESC"
+        sql = (f"SELECT {columns} FROM jobs_fts CROSS JOIN jobs j ON j.rowid = jobs_fts.rowid "
+               f"WHERE jobs_fts MATCH ? AND {' AND '.join(where)} ORDER BY {order} LIMIT ? OFFSET ?")
+        params = [build_match(terms)] + params + [limit + 1, offset]
+    else:
+        sql = f"SELECT {columns} FROM jobs j WHERE {' AND '.join(where)} ORDER BY j.timestamp DESC LIMIT ? OFFSET ?"
+        params = params + [limit + 1, offset]
+    rows = conn.execute(sql, params).fetchall()
+    results = []
+    for row in rows[:limit]:
+        result = dict(row)
+        ocr_text = result.pop("ocr_text")
+        if terms: result["snippet"] = _snippet({**result, "ocr_text": ocr_text}, terms)
+        results.append(result)
+    return results, (offset + limit if len(rows) > limit else None)
+
+if __name__ == "__main__":
+    from database import get_db_connection, get_company_db_connection, init_db
+    parser = argparse.ArgumentParser(description="Maintenance for the job search index (run `analytics.py rebuild` first for legacy history).")
+    parser.add_argument("command", choices=["backfill"])
+    parser.add_argument("--company", help="Limit to one company id (default: all companies)")
+    args = parser.parse_args()
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    os.chdir(script_dir)
+    init_db(script_dir)
+    directory = get_db_connection()
+    company_ids = [args.company] if args.company else [row['id'] for row in directory.execute("SELECT id FROM companies")]
+    directory.close()
+    for cid in company_ids:
+        conn = get_company_db_connection(cid)
+        try:
+            count = backfill(conn, cid)
+            conn.commit()
+            print(f"{cid}: indexed {count} job(s)")
+        except Exception:
+            conn.rollback(); raise
+        finally:
+            conn.close()
@@ -0,0 +1,171 @@
+# logging_setup.py
+"""
+Structured, non-blocking logging for the server.
+
+Callers only enqueue records (QueueHandler); a single QueueListener thread
+formats them as JSON lines and does all console and disk I/O, so request
+threads never wait on a slow console or file. Each record carries the id of
+the request that produced it. Repeats of an identical warning or error are
+sampled: the first few in a window are written, the rest are counted and
+reported on the next record that gets through.
+
+    logs/server.log        every record, JSON lines
+    logs/server_error.log  ERROR and above, JSON lines
+Both rotate by size and at midnight.
+"""
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+import contextvars
+import logging.handlers
+from datetime import datetime, timezone
+
+request_id_var = contextvars.ContextVar("request_id", default=None)
+
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_BACKUP_COUNT = 10
+SAMPLE_WINDOW_SECONDS = 60
+SAMPLE_BURST = 5
+
+_listener = None
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+                 "level": record.levelname, "logger": record.name, "msg": record.getMessage(),
+                 "module": record.module, "line": record.lineno, "thread": record.threadName}
+        for key in ("request_id", "repeated"):
+            value = getattr(record, key, None)
+            if value is not None: entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text: entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class ConsoleFormatter(logging.Formatter):
+    def format(self, record):
+        line = f"{self.formatTime(record)} {record.levelname} [{getattr(record, 'request_id', None) or '-'}] {record.name}: {record.getMessage()}"
+        # The console handler runs first; the traceback is cached on the record for the file handlers.
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text: line += "\n" + record.exc_text
+        return line
+
+class SizeAndTimeRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Numbered backups (like RotatingFileHandler), rolled over by size and additionally at local midnight."""
+    def __init__(self, filename, max_bytes, backup_count):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8", delay=True)
+        self._next_rollover = self._next_midnight()
+
+    @staticmethod
+    def _next_midnight():
+        t = time.localtime()
+        return time.mktime((t.tm_year, t.tm_mon, t.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+
+    def shouldRollover(self, record):
+        if time.time() >= self._next_rollover:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self._next_rollover = self._next_midnight()
+
+class RequestContextFilter(logging.Filter):
+    """Tags records with the current request id; runs on the calling thread."""
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+class RepeatSamplingFilter(logging.Filter):
+    """
+    Lets through the first `burst` identical warnings/errors (same logger,
+    level, call site and exception type/location) per `window`; the rest are
+    dropped and counted in `repeated` on the next one let through. Messages
+    here are f-strings with their values inlined, so the call site rather
+    than the message text identifies a repeat.
+    """
+    def __init__(self, window=SAMPLE_WINDOW_SECONDS, burst=SAMPLE_BURST):
+        super().__init__()
+        self.window, self.burst = window, burst
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def _key(self, record):
+        exc_key = None
+        if record.exc_info and record.exc_info[1] is not None:
+            tb = record.exc_info[2]
+            while tb is not None and tb.tb_next is not None: tb = tb.tb_next
+            exc_key = (type(record.exc_info[1]).__name__, tb.tb_frame.f_code.co_filename if tb else None, tb.tb_lineno if tb else None)
+        return (record.name, record.levelno, record.pathname, record.lineno, exc_key)
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            return True
+        key, now = self._key(record), time.monotonic()
+        with self._lock:
+            window_start, count, suppressed = self._seen.get(key, (now, 0, 0))
+            if now - window_start >= self.window:
+                window_start, count = now, 0
+            if count < self.burst:
+                self._seen[key] = (window_start, count + 1, 0)
+                if suppressed: record.repeated = suppressed
+                return True
+            self._seen[key] = (window_start, count, suppressed + 1)
+            if len(self._seen) > 10000: self._seen.clear()
+            return False
+
+class _StructuredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Records stay in-process, so no copy or pickling is needed; message args are
+        # bound now, and tracebacks are formatted later on the listener thread.
+        record.msg = record.getMessage(); record.args = None
+        return record
+
+def configure_logging(log_dir, level="INFO", max_bytes=DEFAULT_MAX_BYTES, backup_count=DEFAULT_BACKUP_COUNT):
+    """Routes the root logger through a queue to the console and rotating JSON files. Safe to call again."""
+    global _listener
+    os.makedirs(log_dir, exist_ok=True)
+
+    all_file = SizeAndTimeRotatingFileHandler(os.path.join(log_dir, "server.log"), max_bytes, backup_count)
+    all_file.setFormatter(JsonFormatter())
+    error_file = SizeAndTimeRotatingFileHandler(os.path.join(log_dir, "server_error.log"), max_bytes, backup_count)
+    error_file.setLevel(logging.ERROR); error_file.setFormatter(JsonFormatter())
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(ConsoleFormatter())
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _StructuredQueueHandler(log_queue)
+    queue_handler.addFilter(RequestContextFilter())
+    queue_handler.addFilter(RepeatSamplingFilter())
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, _StructuredQueueHandler): root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    old, _listener = _listener, logging.handlers.QueueListener(log_queue, console, all_file, error_file, respect_handler_level=True)
+    _listener.start()
+    if old is not None:
+        _stop_listener(old)  # After the swap, so no record lands on a queue nobody drains.
+    return _listener
+
+def _stop_listener(listener):
+    """Drains the listener's queue, then closes its handlers (releasing the log files for rotation)."""
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+
+def shutdown_logging():
+    """Flushes queued records; registered with atexit."""
+    global _listener
+    if _listener is not None:
+        _stop_listener(_listener); _listener = None
+
+atexit.register(shutdown_logging)
@@ -0,0 +1,202 @@
+# metrics.py
+"""
+In-process metrics rendered in the Prometheus text format.
+
+Counters and histograms are recorded into a per-thread shard that only its
+own thread writes, so the hot path takes no lock. When a thread exits its
+shard is folded into a base shard, so short-lived threads do not accumulate.
+A scrape sums the base and the shards of live threads. Gauges are either set
+directly or computed by a callback at scrape time.
+
+    metrics.inc("jobs_processed_total", company="3")
+    with metrics.timer("job_stage_duration_seconds", stage="excel"): ...
+"""
+import time
+import logging
+import weakref
+import threading
+from contextlib import contextmanager
+
+PREFIX = "fabraforma_"
+logger = logging.getLogger(__name__)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_local = threading.local()
+_shards = {}      # id -> shard of a live thread
+_base_shard = {}  # Totals of threads that have exited.
+_shards_lock = threading.Lock()
+_gauges = {}
+_gauge_callbacks = {}
+_lru_caches = {}
+_meta = {}
+
+def describe(name, kind, help_text, buckets=None):
+    """Declares a metric's type ('counter', 'histogram' or 'gauge') and help text."""
+    _meta[name] = (kind, help_text, tuple(buckets or LATENCY_BUCKETS))
+
+class _ShardOwner:
+    """Lives in the thread-local, so it is released when its thread exits."""
+    __slots__ = ("shard", "__weakref__")
+
+def _shard():
+    owner = getattr(_local, "owner", None)
+    if owner is None:
+        owner = _local.owner = _ShardOwner()
+        owner.shard = {}
+        with _shards_lock:
+            _shards[id(owner.shard)] = owner.shard
+        weakref.finalize(owner, _fold, owner.shard)
+    return owner.shard
+
+def _merge(totals, shard):
+    for key, value in shard.copy().items():
+        if isinstance(value, list):
+            current = totals.get(key)
+            totals[key] = list(value) if current is None else [a + b for a, b in zip(current, value)]
+        else:
+            totals[key] = totals.get(key, 0) + value
+
+def _fold(shard):
+    with _shards_lock:
+        _merge(_base_shard, shard)
+        _shards.pop(id(shard), None)
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+def inc(name, value=1, **labels):
+    shard = _shard(); key = _key(name, labels)
+    shard[key] = shard.get(key, 0) + value
+
+def observe(name, value, **labels):
+    """Adds one observation to a histogram; bucket counts are stored non-cumulatively."""
+    shard = _shard(); key = _key(name, labels)
+    series = shard.get(key)
+    buckets = _meta.get(name, (None, None, LATENCY_BUCKETS))[2]
+    if series is None:
+        series = shard[key] = [0] * (len(buckets) + 3)  # buckets..., +Inf, sum, count
+    for i, bound in enumerate(buckets):
+        if value <= bound:
+            series[i] += 1; break
+    else:
+        series[len(buckets)] += 1
+    series[-2] += value; series[-1] += 1
+
+@contextmanager
+def timer(name, **labels):
+    """Observes the duration of the block (in seconds), also when it raises."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - t0, **labels)
+
+def set_gauge(name, value, **labels):
+    _gauges[_key(name, labels)] = value
+
+def gauge_callback(name, fn):
+    """`fn()` returns a number, or a list of (labels dict, number), evaluated at scrape time."""
+    _gauge_callbacks[name] = fn
+
+def snapshot():
+    """Sums the base and all thread shards: {(name, labels): value or histogram list}."""
+    totals = {}
+    with _shards_lock:
+        shards = list(_shards.values())
+        _merge(totals, _base_shard)
+    for shard in shards:
+        _merge(totals, shard)
+    return totals
+
+def _labels_text(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def render():
+    """All metrics in the Prometheus text exposition format (version 0.0.4)."""
+    series = {}
+    for (name, labels), value in snapshot().items():
+        series.setdefault(name, []).append((labels, value))
+    for (name, labels), value in list(_gauges.items()):
+        series.setdefault(name, []).append((labels, value))
+    for name, fn in list(_gauge_callbacks.items()):
+        try: result = fn()
+        except Exception as e:
+            logger.warning(f"Metrics: gauge '{name}' failed: {e}"); continue
+        if isinstance(result, list):
+            series.setdefault(name, []).extend((tuple(sorted(labels.items())), value) for labels, value in result)
+        else:
+            series.setdefault(name, []).append(((), result))
+
+    lines = []
+    for name in sorted(series):
+        kind, help_text, buckets = _meta.get(name, ("untyped", "", LATENCY_BUCKETS))
+        full_name = PREFIX + name
+        if help_text: lines.append(f"# HELP {full_name} {help_text}")
+        lines.append(f"# TYPE {full_name} {kind}")
+        for labels, value in sorted(series[name], key=lambda item: item[0]):
+            if isinstance(value, list):
+                cumulative = 0
+                for bound, count in zip(list(buckets) + ["+Inf"], value[:len(buckets) + 1]):
+                    cumulative += count
+                    lines.append(f"{full_name}_bucket{_labels_text(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{full_name}_sum{_labels_text(labels)} {_number(value[-2])}")
+                lines.append(f"{full_name}_count{_labels_text(labels)} {value[-1]}")
+            else:
+                lines.append(f"{full_name}{_labels_text(labels)} {_number(value)}")
+    return "\n".join(lines) + "\n"
+
+# --- METRIC DEFINITIONS ---
+
+describe("http_requests_total", "counter", "HTTP requests by endpoint, method and status.")
+describe("http_request_duration_seconds", "histogram", "HTTP request latency by endpoint.")
+describe("job_stage_duration_seconds", "histogram", "Time spent in each stage of /process_image.")
+describe("ocr_inference_duration_seconds", "histogram", "OCR readtext latency, including any wait for the model.")
+describe("ocr_requests_started_total", "counter", "OCR requests started.")
+describe("ocr_requests_finished_total", "counter", "OCR requests finished.")
+describe("ocr_queue_depth", "gauge", "OCR requests waiting for or running on the model in this process.")
+describe("db_connection_wait_seconds", "histogram", "Time to open a request's database connection.",
+         buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0))
+describe("cache_requests_total", "counter", "Cache lookups by cache and result (hit/miss).")
+describe("cache_hit_ratio", "gauge", "Hits / lookups per cache since start.")
+describe("admission_queue_depth", "gauge", "Requests waiting for an admission slot, by endpoint class.")
+describe("admission_in_flight", "gauge", "Requests holding an admission slot, by endpoint class.")
+describe("admission_wait_seconds", "histogram", "Time admitted requests waited for a slot, by endpoint class.")
+describe("admission_rejected_total", "counter", "Requests rejected by admission control, by endpoint class and reason.")
+describe("events_published_total", "counter", "Events published to company event streams, by event.")
+describe("event_stream_subscribers", "gauge", "Open event stream connections.")
+describe("event_stream_rejected_total", "counter", "Event stream connections refused, by reason.")
+describe("event_stream_dropped_total", "counter", "Event stream subscribers disconnected for falling behind.")
+
+def _cache_hit_ratios():
+    lookups = {}
+    for (name, labels), value in snapshot().items():
+        if name == "cache_requests_total":
+            label_map = dict(labels)
+            hits_total = lookups.setdefault(label_map.get("cache"), [0, 0])
+            hits_total[1] += value
+            if label_map.get("result") == "hit": hits_total[0] += value
+    for cache, cached_fn in list(_lru_caches.items()):
+        info = cached_fn.cache_info()
+        lookups[cache] = [info.hits, info.hits + info.misses]
+    return [({"cache": cache}, hits / total) for cache, (hits, total) in lookups.items() if total]
+
+def _ocr_queue_depth():
+    totals = snapshot()
+    return totals.get(("ocr_requests_started_total", ()), 0) - totals.get(("ocr_requests_finished_total", ()), 0)
+
+gauge_callback("cache_hit_ratio", _cache_hit_ratios)
+gauge_callback("ocr_queue_depth", _ocr_queue_depth)
+
+def cache_lookup(cache, hit):
+    inc("cache_requests_total", cache=cache, result="hit" if hit else "miss")
+
+def track_lru_cache(cache, cached_fn):
+    """Reports a functools.lru_cache's own hit/miss statistics under `cache`."""
+    _lru_caches[cache] = cached_fn
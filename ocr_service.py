@@ -0,0 +1,157 @@
+# ocr_service.py
+"""
+Shared OCR inference service.
+
+One long-lived process owns the EasyOCR model and answers `readtext`
+requests over local IPC (a Unix socket, or a named pipe on Windows, via
+multiprocessing.connection with an auth key). Web workers use `OCRClient`,
+which has the same `readtext` interface as `easyocr.Reader`, so any number of
+worker processes share a single copy of the model.
+
+    python ocr_service.py serve [--address PATH] [--cpu]
+
+server.py uses the service when "OCR_SERVICE_ADDRESS" is set in
+server_config.json; otherwise it loads the model in-process as before.
+"""
+import os
+import sys
+import json
+import time
+import threading
+import traceback
+from multiprocessing.connection import Listener, Client
+
+DEFAULT_ADDRESS = r"\\.\pipe\fabraforma-ocr" if sys.platform == "win32" else "ocr_service.sock"
+DEFAULT_AUTHKEY = "a_default_super_secret_key_that_should_be_changed"
+CONNECT_RETRIES = 2
+
+def service_settings(config):
+    """(address, authkey) from the server config; the auth key defaults to the app's SECRET_KEY."""
+    address = config.get("OCR_SERVICE_ADDRESS") or DEFAULT_ADDRESS
+    authkey = config.get("OCR_SERVICE_AUTHKEY") or config.get("SECRET_KEY") or DEFAULT_AUTHKEY
+    return address, authkey.encode("utf-8")
+
+def _plain_results(results):
+    """EasyOCR results with numpy scalars turned into plain Python values."""
+    return [([[int(x), int(y)] for x, y in bbox] if bbox is not None else None, str(text), float(confidence))
+            for bbox, text, confidence in results]
+
+# --- SERVICE ---
+
+class OCRService:
+    def __init__(self, address, authkey, gpu=True):
+        self.address, self.authkey, self.gpu = address, authkey, gpu
+        self.reader = None
+        # EasyOCR is not safe to call concurrently on one model; requests queue on this lock.
+        self._model_lock = threading.Lock()
+
+    def load_model(self):
+        import easyocr
+        print("⏳ Loading EasyOCR model into memory...")
+        self.reader = easyocr.Reader(['en'], gpu=self.gpu)
+        print("✅ EasyOCR model loaded.")
+
+    def handle(self, conn):
+        try:
+            while True:
+                try: request = conn.recv()
+                except EOFError: break
+                op = request[0]
+                try:
+                    if op == "ping":
+                        conn.send(("ok", "pong"))
+                    elif op == "readtext":
+                        _, image_bytes, kwargs = request
+                        t0 = time.perf_counter()
+                        with self._model_lock:
+                            results = self.reader.readtext(image_bytes, **kwargs)
+                        conn.send(("ok", _plain_results(results)))
+                        print(f"OCR: {len(image_bytes)} bytes in {(time.perf_counter() - t0) * 1000:.0f} ms")
+                    else:
+                        conn.send(("error", f"Unknown operation '{op}'"))
+                except Exception as e:
+                    traceback.print_exc()
+                    conn.send(("error", str(e)))
+        finally:
+            conn.close()
+
+    def serve_forever(self):
+        if self.reader is None:
+            self.load_model()
+        if not self.address.startswith("\\\\") and os.path.exists(self.address):
+            os.remove(self.address)  # Stale socket from a previous run.
+        with Listener(self.address, authkey=self.authkey) as listener:
+            print(f"✅ OCR service listening on {self.address}")
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:
+                    print(f"⚠️ Rejected OCR client connection: {e}")
+                    continue
+                threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+# --- CLIENT ---
+
+class OCRClient:
+    """
+    Thin client used by the web workers. Each thread keeps its own
+    connection, reconnecting once if the service was restarted.
+    """
+    def __init__(self, address, authkey, timeout=120):
+        self.address, self.authkey, self.timeout = address, authkey, timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = Client(self.address, authkey=self.authkey)
+            self._local.conn = conn
+        return conn
+
+    def _drop_connection(self):
+        conn = getattr(self._local, "conn", None)
+        self._local.conn = None
+        if conn is not None:
+            try: conn.close()
+            except OSError: pass
+
+    def _call(self, *request):
+        for attempt in range(CONNECT_RETRIES):
+            try:
+                conn = self._connection()
+                conn.send(request)
+                if not conn.poll(self.timeout):
+                    self._drop_connection()
+                    raise TimeoutError(f"OCR service did not answer within {self.timeout}s")
+                status, payload = conn.recv()
+                break
+            except (EOFError, ConnectionError, FileNotFoundError, OSError) as e:
+                self._drop_connection()
+                if attempt == CONNECT_RETRIES - 1 or isinstance(e, TimeoutError):
+                    raise ConnectionError(f"OCR service unavailable at {self.address}: {e}")
+        if status != "ok":
+            raise RuntimeError(payload)
+        return payload
+
+    def ping(self):
+        return self._call("ping") == "pong"
+
+    def readtext(self, image_bytes, **kwargs):
+        return self._call("readtext", bytes(image_bytes), kwargs)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Shared OCR inference service.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    serve_p = sub.add_parser("serve", help="Load the OCR model and serve requests.")
+    serve_p.add_argument("--address", help="Socket path (or named pipe on Windows); defaults to the server config.")
+    serve_p.add_argument("--cpu", action="store_true", help="Run the model on the CPU.")
+    args = parser.parse_args()
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    os.chdir(script_dir)
+    try:
+        with open("server_config.json", 'r') as f: config = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError): config = {}
+    address, authkey = service_settings(config)
+    OCRService(args.address or address, authkey, gpu=not args.cpu).serve_forever()
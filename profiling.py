@@ -0,0 +1,97 @@
+# profiling.py
+"""
+Opt-in request profiling.
+
+A sampled fraction of requests (PROFILE_SAMPLE_RATE) and any admin request
+sent with `X-Profile: 1` run under cProfile. A profile is kept when the
+request was explicitly profiled or took longer than PROFILE_SLOW_MS; kept
+profiles go to a bounded on-disk ring buffer (oldest deleted first) as
+standard .prof files readable with pstats or snakeviz.
+"""
+import io
+import os
+import re
+import time
+import random
+import pstats
+import logging
+import cProfile
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SLOW_MS = 2000
+DEFAULT_MAX_PROFILES = 50
+PROFILE_HEADER = "X-Profile"
+_PROFILE_NAME = re.compile(r'^(\d{8}T\d{6}_\d{6})_([A-Za-z0-9_.-]+)_(\d+)ms_([A-Za-z0-9]+)\.prof$')
+
+def should_sample(rate):
+    return rate > 0 and random.random() < rate
+
+def start():
+    """Starts a profiler for the current thread; returns None if another profiler is already active."""
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        return None  # Python 3.12+ allows one active profiler per process.
+    return profiler
+
+def stop(profiler):
+    profiler.disable()
+
+def save(profiler, profile_dir, endpoint, duration_ms, request_id, max_profiles=DEFAULT_MAX_PROFILES):
+    """Writes the profile into the ring buffer and trims it to `max_profiles` files. Returns the file name."""
+    os.makedirs(profile_dir, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%dT%H%M%S_%f")
+    safe_endpoint = re.sub(r'[^A-Za-z0-9_.-]', '_', endpoint or "unmatched")
+    safe_request_id = re.sub(r'[^A-Za-z0-9]', '', request_id or "") or "none"
+    name = f"{stamp}_{safe_endpoint}_{round(duration_ms)}ms_{safe_request_id}.prof"
+    profiler.dump_stats(os.path.join(profile_dir, name))
+    for old in list_profiles(profile_dir)[max_profiles:]:
+        try: os.remove(os.path.join(profile_dir, old["name"]))
+        except FileNotFoundError: pass
+    return name
+
+def list_profiles(profile_dir):
+    """Saved profiles, newest first."""
+    if not os.path.isdir(profile_dir):
+        return []
+    profiles = []
+    with os.scandir(profile_dir) as entries:
+        for entry in entries:
+            match = _PROFILE_NAME.match(entry.name)
+            if not match:
+                continue
+            profiles.append({"name": entry.name, "endpoint": match.group(2), "duration_ms": int(match.group(3)),
+                             "request_id": match.group(4), "size": entry.stat().st_size,
+                             "created_at": datetime.strptime(match.group(1), "%Y%m%dT%H%M%S_%f").isoformat()})
+    profiles.sort(key=lambda p: p["name"], reverse=True)
+    return profiles
+
+def profile_path(profile_dir, name):
+    """Path of a saved profile, or None if the name is not one of ours."""
+    if not _PROFILE_NAME.match(name or ""):
+        return None
+    path = os.path.join(profile_dir, name)
+    return path if os.path.isfile(path) else None
+
+def summary(path, sort="cumulative", limit=40):
+    """pstats text report of a saved profile."""
+    out = io.StringIO()
+    pstats.Stats(path, stream=out).strip_dirs().sort_stats(sort).print_stats(limit)
+    return out.getvalue()
+
+class RequestProfile:
+    """Per-request state kept on flask.g between before_request and teardown."""
+    def __init__(self, profiler, forced):
+        self.profiler, self.forced, self.started = profiler, forced, time.perf_counter()
+
+    def finish(self, profile_dir, endpoint, request_id, slow_ms, max_profiles):
+        stop(self.profiler)
+        duration_ms = (time.perf_counter() - self.started) * 1000
+        if not self.forced and duration_ms < slow_ms:
+            return None
+        name = save(self.profiler, profile_dir, endpoint, duration_ms, request_id, max_profiles)
+        logger.log(logging.INFO if self.forced else logging.WARNING, f"Profiled request {endpoint} took {round(duration_ms)} ms; saved {name}")
+        return name
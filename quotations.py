@@ -0,0 +1,258 @@
+# quotations.py
+"""
+Quotation PDFs and their assets.
+
+Each company's logo is stored once under its content hash
+(data/<company_id>/assets/...) and referenced from `company_assets`;
+decoded, pre-scaled ImageReaders are kept in an in-memory LRU so repeated
+quotations do no image I/O.
+
+The static per-company layout (logo, company block, title, table chrome and
+footer) is drawn once per output document as a ReportLab form XObject and
+stamped onto every page, so batches and multi-page quotes only draw the
+per-quote content.
+"""
+import os
+import re
+import time
+import hashlib
+import logging
+import zipfile
+from io import BytesIO
+from datetime import datetime
+from functools import lru_cache
+from PIL import Image
+from reportlab.pdfgen import canvas
+from reportlab.lib.pagesizes import letter
+from reportlab.lib import utils
+
+import image_store
+import metrics
+
+ASSET_DIR = "assets"
+LOGO_KIND = "logo"
+# The logo is drawn 80pt wide; keep ~4x that in pixels so it stays sharp in print.
+LOGO_MAX_PIXELS = 320
+LOGO_CACHE_SIZE = 64
+logger = logging.getLogger(__name__)
+
+def store_logo(conn, company_id, company_dir, stream, ext):
+    """
+    Makes an uploaded logo the company's current logo, saved once per content
+    hash. Clients resend the same logo with every quotation, so it is hashed
+    in memory first; when it matches the stored logo nothing is written.
+    Commits on change.
+    """
+    data, ext = stream.read(), ext.lower()
+    digest = hashlib.sha256(data).hexdigest()
+    current = conn.execute("SELECT hash, ext FROM company_assets WHERE company_id = ? AND kind = ?",
+                           (company_id, LOGO_KIND)).fetchone()
+    if current and (current['hash'], current['ext']) == (digest, ext):
+        return digest
+    image_store.save_blob(os.path.join(company_dir, ASSET_DIR), BytesIO(data), ext)
+    conn.execute("""
+        INSERT INTO company_assets (company_id, kind, hash, ext, updated_at) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (company_id, kind) DO UPDATE SET hash = excluded.hash, ext = excluded.ext, updated_at = excluded.updated_at""",
+        (company_id, LOGO_KIND, digest, ext, datetime.utcnow().isoformat()))
+    conn.commit()
+    return digest
+
+def get_logo_path(conn, company_id, company_dir):
+    row = conn.execute("SELECT hash, ext FROM company_assets WHERE company_id = ? AND kind = ?",
+                       (company_id, LOGO_KIND)).fetchone()
+    if not row:
+        return None
+    return image_store.blob_path(os.path.join(company_dir, ASSET_DIR), row['hash'], row['ext'])
+
+@lru_cache(maxsize=LOGO_CACHE_SIZE)
+def get_logo_reader(path):
+    """
+    Decodes and downsamples a logo once. Paths are content-addressed, so a
+    cached entry can never go stale. Returns (ImageReader, aspect ratio).
+    """
+    with Image.open(path) as img:
+        img.thumbnail((LOGO_MAX_PIXELS, LOGO_MAX_PIXELS))
+        img = img.convert("RGBA" if img.mode in ("RGBA", "LA", "P") else "RGB")
+    width, height = img.size
+    return utils.ImageReader(img), height / float(width)
+
+metrics.track_lru_cache("quotation_logos", get_logo_reader)
+
+# --- PDF LAYOUT ---
+
+PAGE_WIDTH, PAGE_HEIGHT = letter
+TABLE_HEADER_Y = PAGE_HEIGHT - 260
+FIRST_ROW_Y = TABLE_HEADER_Y - 30
+ITEM_ROW_HEIGHT = 18
+# Rows stop above the footer; the last page also needs room for the totals block.
+ROWS_BOTTOM_Y = 90
+TOTALS_BLOCK_HEIGHT = 90
+
+def quotation_totals(data):
+    total_cogs = sum(part.get("cogs") or 0 for part in data["parts"])
+    margin_percent = data.get("margin_percent", 0)
+    subtotal = total_cogs / (1 - (margin_percent / 100.0)) if margin_percent < 100 else 0
+    tax_rate_percent = data.get("tax_rate_percent", 0)
+    tax_amount = subtotal * (tax_rate_percent / 100.0)
+    return {"margin_percent": margin_percent, "subtotal": subtotal, "tax_rate_percent": tax_rate_percent,
+            "tax_amount": tax_amount, "grand_total": subtotal + tax_amount}
+
+def _template_name(comp_details, logo_path):
+    key = "|".join([comp_details.get("name") or "", comp_details.get("address") or "", comp_details.get("contact") or "", logo_path or ""])
+    return "company_" + hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+def _ensure_company_template(c, comp_details, logo_path):
+    """Defines the company's static page layout as a form on this canvas (once) and returns its name."""
+    name = _template_name(comp_details, logo_path)
+    defined = getattr(c, "_company_templates", None)
+    if defined is None:
+        defined = set(); c._company_templates = defined
+    if name in defined:
+        return name
+    width, height = PAGE_WIDTH, PAGE_HEIGHT
+    c.beginForm(name)
+
+    # --- Company Details & Logo ---
+    if logo_path:
+        try:
+            # Decoded and pre-scaled once per logo, then served from the LRU cache.
+            img, aspect = get_logo_reader(logo_path)
+            c.drawImage(img, 40, height - 100, width=80, height=(80 * aspect), mask='auto')
+        except Exception as e:
+            logger.warning(f"Could not draw logo on PDF: {e}")
+
+    c.setFont("Helvetica-Bold", 16)
+    c.drawRightString(width - 50, height - 60, comp_details.get("name") or "Your Company")
+    c.setFont("Helvetica", 10)
+    c.drawRightString(width - 50, height - 75, comp_details.get("address") or "Company Address")
+    c.drawRightString(width - 50, height - 90, comp_details.get("contact") or "Contact Info")
+
+    # --- Document Title ---
+    c.setFont("Helvetica-Bold", 24)
+    c.drawString(50, height - 150, "Quotation")
+    c.line(50, height - 155, width - 50, height - 155)
+
+    # --- Table Header ---
+    c.setFont("Helvetica-Bold", 11)
+    c.drawString(60, TABLE_HEADER_Y, "Part Description")
+    c.drawRightString(width - 200, TABLE_HEADER_Y, "Unit Price")
+    c.drawRightString(width - 50, TABLE_HEADER_Y, "Total")
+    c.line(50, TABLE_HEADER_Y - 10, width - 50, TABLE_HEADER_Y - 10)
+
+    # --- Footer/Terms ---
+    c.setFont("Helvetica-Oblique", 9)
+    c.drawString(50, 50, "Thank you for your business! Prices are valid for 30 days.")
+
+    c.endForm()
+    defined.add(name)
+    return name
+
+def _paginate(rows):
+    """Splits table rows into pages, keeping room for the totals block on the last page."""
+    per_page = int((FIRST_ROW_Y - ROWS_BOTTOM_Y) // ITEM_ROW_HEIGHT) + 1
+    per_last_page = int((FIRST_ROW_Y - ROWS_BOTTOM_Y - TOTALS_BLOCK_HEIGHT) // ITEM_ROW_HEIGHT) + 1
+    pages = []
+    while len(rows) > per_last_page:
+        take = min(per_page, len(rows) - 1)
+        pages.append(rows[:take]); rows = rows[take:]
+    pages.append(rows)
+    return pages
+
+def draw_quotation(c, data, logo_path=None):
+    """Draws one quotation (one or more pages) onto a canvas, ending with showPage()."""
+    width, height = PAGE_WIDTH, PAGE_HEIGHT
+    template = _ensure_company_template(c, data.get("company_details") or {}, logo_path)
+    totals = quotation_totals(data)
+    subtotal = totals["subtotal"]
+
+    if data.get("itemized"):
+        # One row per part, priced at the same margin as the whole quote.
+        divisor = (1 - (totals["margin_percent"] / 100.0)) if totals["margin_percent"] < 100 else None
+        rows = [(part.get("name") or f"Part {i + 1}", ((part.get("cogs") or 0) / divisor) if divisor else 0)
+                for i, part in enumerate(data["parts"])]
+        row_height = ITEM_ROW_HEIGHT
+    else:
+        # For this simple quote, we'll list the parts as a single line item.
+        rows = [(f"{len(data['parts'])} Custom Manufactured Part(s)", subtotal)]
+        row_height = 30
+    pages = _paginate(rows)
+
+    for page_number, page_rows in enumerate(pages, start=1):
+        c.doForm(template)
+
+        # --- Customer and Date Info ---
+        c.setFont("Helvetica-Bold", 12)
+        c.drawString(50, height - 190, "BILLED TO:")
+        c.setFont("Helvetica", 12)
+        c.drawString(50, height - 205, data.get("customer_name", "Valued Customer"))
+        if data.get("customer_company"):
+            c.drawString(50, height - 220, data.get("customer_company"))
+        c.drawRightString(width - 50, height - 190, f"Date: {datetime.now().strftime('%Y-%m-%d')}")
+        if len(pages) > 1:
+            c.setFont("Helvetica", 9)
+            c.drawRightString(width - 50, height - 205, f"Page {page_number} of {len(pages)}")
+
+        # --- Table Items ---
+        y_position = FIRST_ROW_Y
+        c.setFont("Helvetica", 10)
+        for description, amount in page_rows:
+            c.drawString(60, y_position, description)
+            c.drawRightString(width - 200, y_position, f"Rs{amount:,.2f}")
+            c.drawRightString(width - 50, y_position, f"Rs{amount:,.2f}")
+            y_position -= row_height
+
+        if page_number < len(pages):
+            c.setFont("Helvetica-Oblique", 9)
+            c.drawRightString(width - 50, y_position, "Continued on next page")
+            c.showPage()
+            continue
+        # Keep the original 30pt gap between the last row and the totals rule.
+        if row_height != 30: y_position -= 30 - row_height
+
+        # --- Totals Section ---
+        c.line(width - 250, y_position, width - 50, y_position)
+        y_position -= 20
+        c.setFont("Helvetica", 11)
+        c.drawRightString(width - 200, y_position, "Subtotal:")
+        c.drawRightString(width - 50, y_position, f"Rs{subtotal:,.2f}")
+        y_position -= 20
+        c.drawRightString(width - 200, y_position, f"Tax ({totals['tax_rate_percent']}%):")
+        c.drawRightString(width - 50, y_position, f"Rs{totals['tax_amount']:,.2f}")
+        y_position -= 20
+        c.setFont("Helvetica-Bold", 12)
+        c.drawRightString(width - 200, y_position, "Grand Total:")
+        c.drawRightString(width - 50, y_position, f"Rs{totals['grand_total']:,.2f}")
+        c.showPage()
+
+def generate_quotation_pdf(buffer, data, logo_path=None):
+    """
+    Generates a quotation PDF and writes it to an in-memory buffer.
+    
+    Args:
+        buffer (BytesIO): The in-memory buffer to write the PDF to.
+        data (dict): The quotation data from the client.
+        logo_path (str): Content-addressed path of the company logo, if any.
+    """
+    c = canvas.Canvas(buffer, pagesize=letter)
+    draw_quotation(c, data, logo_path)
+    c.save()
+
+def generate_batch_pdf(buffer, quotes, logo_path=None):
+    """Writes many quotations into one PDF; each company layout is defined once and reused on every page."""
+    c = canvas.Canvas(buffer, pagesize=letter)
+    for data in quotes:
+        draw_quotation(c, data, logo_path)
+    c.save()
+
+def quotation_filename(data, index=None):
+    customer_name_safe = re.sub(r'[^a-zA-Z0-9_]', '', data.get('customer_name', 'Customer').replace(' ', '_'))
+    suffix = f"_{index}" if index is not None else ""
+    return f"Quotation_{customer_name_safe}_{int(time.time())}{suffix}.pdf"
+
+def generate_batch_zip(buffer, quotes, logo_path=None):
+    """Writes one PDF per quotation into a zip archive. PDFs are already compressed, so entries are stored."""
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for index, data in enumerate(quotes, start=1):
+            pdf = BytesIO()
+            generate_quotation_pdf(pdf, data, logo_path)
+            archive.writestr(quotation_filename(data, index), pdf.getvalue())
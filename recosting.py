@@ -0,0 +1,139 @@
+# recosting.py
+"""
+Background re-costing of processed jobs after printer or filament prices
+change.
+
+A run finds the affected jobs through the (company, printer) and
+(company, material, brand) job indexes, recomputes user/default COGS with the
+vectorized costing engine in batches, and commits each batch together with
+the matching rollup deltas and a journal row for the JSON/Excel logs.
+Progress is kept in `recost_runs`.
+"""
+import json
+import uuid
+import logging
+import threading
+from datetime import datetime
+import numpy as np
+
+import costing
+import analytics
+
+BATCH_SIZE = 500
+logger = logging.getLogger(__name__)
+
+def _now():
+    return datetime.utcnow().isoformat()
+
+def affected_job_ids(conn, company_id, printer_ids=None, filaments=None, since=None):
+    """Ids of jobs that used any of the given printers or filaments (all jobs when neither is given)."""
+    time_clause, time_params = ("AND timestamp >= ?", [since]) if since else ("", [])
+    if printer_ids is None and filaments is None:
+        rows = conn.execute(f"SELECT id FROM jobs WHERE company_id = ? {time_clause} ORDER BY timestamp",
+                            [company_id] + time_params).fetchall()
+        return [row['id'] for row in rows]
+    ids = set()
+    for printer_id in printer_ids or []:
+        ids.update(row['id'] for row in conn.execute(
+            f"SELECT id FROM jobs WHERE company_id = ? AND printer_id = ? {time_clause}", [company_id, printer_id] + time_params))
+    for material, brand in filaments or []:
+        ids.update(row['id'] for row in conn.execute(
+            f"SELECT id FROM jobs WHERE company_id = ? AND material = ? AND brand = ? {time_clause}",
+            [company_id, material, brand] + time_params))
+    return sorted(ids)
+
+def recost_jobs(jobs, printers_by_id, filaments_by_key):
+    """
+    Recomputes COGS for job rows against the current catalog. Returns
+    (costable_jobs, user_cogs, default_cogs); jobs whose printer or filament
+    no longer exists are left out.
+    """
+    printer_ids = list(printers_by_id)
+    printer_index = {pid: i for i, pid in enumerate(printer_ids)}
+    printer_rows = [printers_by_id[pid] for pid in printer_ids]
+    hourly = costing.printer_hourly_rates(printer_rows)
+    buffer = costing.float_column(printer_rows, 'buffer_factor', 1.0)
+
+    costable = [job for job in jobs
+                if job['printer_id'] in printer_index and (job['material'], job['brand']) in filaments_by_key]
+    p_idx = np.array([printer_index[job['printer_id']] for job in costable], dtype=np.intp)
+    filament_rows = [filaments_by_key[(job['material'], job['brand'])] for job in costable]
+    # Job columns may be NULL (e.g. jobs imported from legacy app logs); a missing quantity or rate costs 0.
+    job_column = lambda key: np.nan_to_num(costing.float_column(costable, key, 0))
+    user, default = costing.cogs_arrays(
+        job_column('filament_g'), job_column('time_h'), job_column('labour_time_min'), hourly[p_idx], buffer[p_idx],
+        costing.float_column(filament_rows, 'price', 0), costing.float_column(filament_rows, 'efficiency_factor', 1.0),
+        job_column('labour_rate_hr'))
+    return costable, user, default
+
+def start_run(conn, company_id, scope):
+    """Registers a run; returns its id, or None if the company already has one in progress. Commits."""
+    if conn.execute("SELECT 1 FROM recost_runs WHERE company_id = ? AND status IN ('queued', 'running')", (company_id,)).fetchone():
+        return None
+    run_id = str(uuid.uuid4())
+    conn.execute("INSERT INTO recost_runs (id, company_id, scope, status, started_at) VALUES (?, ?, ?, 'queued', ?)",
+                 (run_id, company_id, json.dumps(scope), _now()))
+    conn.commit()
+    return run_id
+
+def run(conn, run_id, company_id, scope, on_batch_committed=None, batch_size=BATCH_SIZE):
+    """Executes a registered run to completion on the given connection."""
+    try:
+        filaments = [tuple(f) for f in scope['filaments']] if scope.get('filaments') is not None else None
+        ids = affected_job_ids(conn, company_id, scope.get('printer_ids'), filaments, scope.get('since'))
+        conn.execute("UPDATE recost_runs SET status = 'running', total = ? WHERE id = ?", (len(ids), run_id)); conn.commit()
+
+        printers_by_id = {row['id']: dict(row) for row in conn.execute("SELECT * FROM printers WHERE company_id = ?", (company_id,))}
+        filaments_by_key = {(row['material'], row['brand']): dict(row)
+                            for row in conn.execute("SELECT * FROM filaments WHERE company_id = ?", (company_id,))}
+        done = changed = skipped = 0
+        for start in range(0, len(ids), batch_size):
+            chunk = ids[start:start + batch_size]
+            jobs = [dict(row) for row in conn.execute(f"SELECT * FROM jobs WHERE id IN ({','.join('?' * len(chunk))})", chunk)]
+            costable, user, default = recost_jobs(jobs, printers_by_id, filaments_by_key)
+            updates = {}
+            for job, new_user, new_default in zip(costable, user.tolist(), default.tolist()):
+                if new_user == job['user_cogs'] and new_default == job['default_cogs']:
+                    continue
+                conn.execute("UPDATE jobs SET user_cogs = ?, default_cogs = ? WHERE id = ?", (new_user, new_default, job['id']))
+                analytics.apply_cogs_delta(conn, job, new_user - (job['user_cogs'] or 0), new_default - (job['default_cogs'] or 0))
+                updates[job['id']] = {"filename": job['filename'], "timestamp": job['timestamp'],
+                                      "user_cogs": new_user, "default_cogs": new_default}
+            if updates:
+                conn.execute("INSERT INTO recost_outputs (run_id, company_id, payload, created_at) VALUES (?, ?, ?, ?)",
+                             (run_id, company_id, json.dumps({"cogs_updates": updates}), _now()))
+            done += len(chunk); changed += len(updates); skipped += len(jobs) - len(costable)
+            conn.execute("UPDATE recost_runs SET done = ?, changed = ?, skipped = ? WHERE id = ?", (done, changed, skipped, run_id))
+            conn.commit()
+            if updates and on_batch_committed:
+                on_batch_committed(conn, company_id)
+        conn.execute("UPDATE recost_runs SET status = 'completed', finished_at = ? WHERE id = ?", (_now(), run_id))
+        conn.commit()
+    except Exception as e:
+        logger.exception(f"Re-cost run {run_id} failed")
+        conn.rollback()
+        conn.execute("UPDATE recost_runs SET status = 'failed', error = ?, finished_at = ? WHERE id = ?", (str(e), _now(), run_id))
+        conn.commit()
+
+def run_in_background(connect, run_id, company_id, scope, on_batch_committed=None):
+    """Runs `run` on a daemon thread with its own connection from `connect()`."""
+    def target():
+        conn = connect()
+        try: run(conn, run_id, company_id, scope, on_batch_committed)
+        finally: conn.close()
+    thread = threading.Thread(target=target, name=f"recost-{run_id[:8]}", daemon=True)
+    thread.start()
+    return thread
+
+def get_run(conn, company_id, run_id):
+    row = conn.execute("SELECT * FROM recost_runs WHERE id = ? AND company_id = ?", (run_id, company_id)).fetchone()
+    if not row:
+        return None
+    result = dict(row); result['scope'] = json.loads(result['scope'])
+    result['progress'] = (result['done'] / result['total']) if result['total'] else (1.0 if result['status'] == 'completed' else 0.0)
+    return result
+
+def mark_interrupted(conn):
+    """Runs left queued/running by a previous process can never finish; flag them so new runs can start."""
+    conn.execute("UPDATE recost_runs SET status = 'interrupted', finished_at = ? WHERE status IN ('queued', 'running')", (_now(),))
+    conn.commit()
@@ -4,27 +4,44 @@ import json
 import time
 import shutil
 import sys
-import traceback
+import logging
 from datetime import datetime, timedelta
 from functools import wraps
 import uuid
 import secrets
-
-from database import get_db_connection, init_db
+import threading
+
+from database import get_db_connection, get_company_db_connection, iter_company_connections, is_sharded, init_db, insert_row
+import image_store
+import costing
+import analytics
+import stock_ledger
+import recosting
+import quotations
+import file_share
+import ocr_service
+import metrics
+import logging_setup
+import profiling
+import json_output
+import app_config
+import validators
+import admission
+import archival
+import job_search
+import event_stream
+from costing import parse_time_string, calculate_printer_hourly_rate, calculate_cogs_values
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
 import jwt
 from PIL import Image
-import easyocr
 from openpyxl import load_workbook, Workbook
 from openpyxl.styles import Font
 from openpyxl.utils import get_column_letter
-from flask import Flask, jsonify, request, send_from_directory, g
+from flask import Flask, Response, jsonify, request, send_from_directory, g, has_app_context
 from flask_cors import CORS
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter
 from reportlab.lib.units import inch
-from reportlab.lib import utils
 from reportlab.lib import colors
 from flask import send_file
 from io import BytesIO
@@ -36,34 +53,121 @@ except NameError:
     SCRIPT_DIR = os.getcwd()
 
 CONFIG_PATH = "server_config.json"
-APP_CONFIG = {}
+CONFIG_DEFAULTS = { "SERVER_SHARE_DIR": "server_share", "TEMPLATE_PATH": "FDM.xlsx", "cells": ["D4", "D9", "D10", "D11", "D12", "D13"],
+                    "headers": ["Sr. No", "Date", "Part Number", "Filename", "Material", "Filament Cost (₹/kg)", "Filament (g)", "Time (h)", "Labour Time (min)", "User COGS (₹)", "Default COGS (₹)", "Source Link"] }
+DEFAULT_SECRET_KEY = 'a_default_super_secret_key_that_should_be_changed'
+LOGGING_CONFIG_KEYS = ("LOG_DIR", "LOG_LEVEL", "LOG_MAX_BYTES", "LOG_BACKUP_COUNT")
+ADMISSION_CONFIG_KEYS = ("ADMISSION_WORKER_THREADS", "ADMISSION_RESERVED_THREADS", "ADMISSION_LIMITS")
+EVENT_STREAM_CONFIG_KEYS = ("EVENT_STREAM_HOST", "EVENT_STREAM_PORT", "EVENT_STREAM_RELAY_ADDRESS", "SECRET_KEY")
+config_store = app_config.ConfigStore(os.path.join(SCRIPT_DIR, CONFIG_PATH), CONFIG_DEFAULTS)
 ocr_reader = None
+share_size_index = file_share.DirectorySizeIndex()
+share_listings = file_share.ListingCache()
+admission_control = admission.AdmissionController()
+_company_file_locks = {}
+_company_file_locks_guard = threading.Lock()
+_written_job_outputs = set()  # (company_id, journal table, row id) written to files, marked applied by the company's next job commit
+OUTPUT_JOURNALS = ("job_outputs", "recost_outputs")  # Processed jobs, re-costing batches.
+_written_job_outputs_lock = threading.Lock()
+IMAGE_CACHE_MAX_AGE = 365 * 24 * 3600
+MAX_COSTING_MATRIX_CELLS = 250_000
+MAX_QUOTATION_BATCH = 500
+DEFAULT_ARCHIVE_INTERVAL_HOURS = 24
+# Printer fields that feed COGS; a change to any of them makes past jobs eligible for re-costing.
+PRINTER_COST_FIELDS = ("setup_cost", "maintenance_cost", "lifetime_years", "power_w", "price_kwh", "buffer_factor", "uptime_percent")
+PRINTER_COST_DEFAULTS = {"buffer_factor": 1.0, "uptime_percent": 50}
+logger = logging.getLogger("server")
 app = Flask(__name__)
+app.json = json_output.create_provider(app)
 CORS(app)
 
 # --- FLASK APP CONTEXT & DATABASE ---
 
 @app.before_request
 def before_request():
-    g.db = get_db_connection()
+    g.request_started = time.perf_counter()
+    g.config = config_store.current()  # One settings snapshot for the whole request.
+    start_request_profile()
+    # Correlate log records with the request; honour an id set by a proxy or client.
+    g.request_id = request.headers.get('X-Request-ID', '')[:64] or uuid.uuid4().hex[:16]
+    g.request_id_token = logging_setup.request_id_var.set(g.request_id)
+    with metrics.timer("db_connection_wait_seconds"):
+        g.db = get_db_connection()
+
+def record_request_metrics(status):
+    endpoint = request.endpoint or "unmatched"
+    metrics.inc("http_requests_total", endpoint=endpoint, method=request.method, status=str(status))
+    metrics.observe("http_request_duration_seconds", time.perf_counter() - g.request_started, endpoint=endpoint)
+
+@app.after_request
+def after_request(response):
+    record_request_metrics(response.status_code); g.request_recorded = True
+    response.headers['X-Request-ID'] = g.request_id
+    response = json_output.compress_response(response, request.accept_encodings,
+                                             get_config().get("COMPRESSION_MIN_BYTES", json_output.DEFAULT_MIN_COMPRESS_BYTES))
+    profile_name = finish_request_profile()
+    if profile_name: response.headers['X-Profile-Name'] = profile_name
+    return response
 
 @app.teardown_request
 def teardown_request(exception):
+    finish_request_profile()
+    # Unhandled exceptions skip after_request; count them as 500s here.
+    if 'request_started' in g and not g.get('request_recorded'):
+        record_request_metrics(500)
     db = g.pop('db', None)
     if db is not None:
         db.close()
+    if 'request_id_token' in g:
+        logging_setup.request_id_var.reset(g.pop('request_id_token'))
+
+# --- REQUEST PROFILING ---
+
+def get_profile_dir():
+    return os.path.join(SCRIPT_DIR, get_config().get("PROFILE_DIR", os.path.join("logs", "profiles")))
+
+def request_is_from_admin():
+    try:
+        token = request.headers.get('Authorization', '').split(" ")[1]
+        return jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"]).get('role') == 'admin'
+    except Exception:
+        return False
+
+def start_request_profile():
+    """Profiles sampled requests, and admin requests that ask for it with `X-Profile: 1`."""
+    g.request_profile = None
+    forced = request.headers.get(profiling.PROFILE_HEADER) == '1' and request_is_from_admin()
+    if forced or profiling.should_sample(float(get_config().get("PROFILE_SAMPLE_RATE", 0) or 0)):
+        profiler = profiling.start()
+        if profiler: g.request_profile = profiling.RequestProfile(profiler, forced)
+
+def finish_request_profile():
+    request_profile = g.pop('request_profile', None)
+    if request_profile is None: return None
+    try:
+        return request_profile.finish(get_profile_dir(), request.endpoint, g.get('request_id'),
+                                      get_config().get("PROFILE_SLOW_MS", profiling.DEFAULT_SLOW_MS),
+                                      get_config().get("PROFILE_MAX_FILES", profiling.DEFAULT_MAX_PROFILES))
+    except Exception:
+        logger.exception("Could not save request profile"); return None
 
 # --- HELPER FUNCTIONS (GENERAL) ---
 
 def get_ocr_reader():
     global ocr_reader
+    if ocr_reader is None and get_config().get("OCR_SERVICE_ADDRESS"):
+        # A shared OCR service owns the model; this worker only holds a client.
+        address, authkey = ocr_service.service_settings(get_config())
+        ocr_reader = ocr_service.OCRClient(address, authkey)
+        logger.info(f"✅ Using OCR service at {address}.")
     if ocr_reader is None:
-        print("⏳ Loading EasyOCR model into memory...")
+        logger.info("⏳ Loading EasyOCR model into memory...")
         try:
+            import easyocr  # Imported lazily so workers using the OCR service never load torch.
             ocr_reader = easyocr.Reader(['en'], gpu=True)
-            print("✅ EasyOCR model loaded.")
+            logger.info("✅ EasyOCR model loaded.")
         except Exception as e:
-            print(f"🛑 FATAL: Could not load EasyOCR model. Error: {e}")
+            logger.critical(f"🛑 FATAL: Could not load EasyOCR model. Error: {e}", exc_info=True)
             ocr_reader = None
     return ocr_reader
 
@@ -72,18 +176,34 @@ def get_company_data_path(company_id, *args):
     os.makedirs(base_path, exist_ok=True)
     return os.path.join(base_path, *args)
 
-def load_app_config():
-    try:
-        with open(CONFIG_PATH, 'r') as f: return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError): return {}
+def get_config():
+    """The settings snapshot of the current request, or the latest one outside a request."""
+    if has_app_context() and 'config' in g: return g.config
+    return config_store.current()
 
-def save_app_config(data):
-    with open(CONFIG_PATH, 'w') as f: json.dump(data, f, indent=4)
-    global APP_CONFIG
-    APP_CONFIG = data.copy()
+def apply_config(old, new):
+    """Pushes settings that live outside the snapshot into the app; `old` is None on startup."""
+    global ocr_reader
+    app.config['SECRET_KEY'] = new.get('SECRET_KEY') or DEFAULT_SECRET_KEY
+    if old is None or old.get("JSON_PROVIDER") != new.get("JSON_PROVIDER"):
+        app.json = json_output.create_provider(app, new.get("JSON_PROVIDER"))
+    if old is None or any(old.get(k) != new.get(k) for k in LOGGING_CONFIG_KEYS):
+        logging_setup.configure_logging(os.path.join(SCRIPT_DIR, new.get("LOG_DIR", "logs")), new.get("LOG_LEVEL", "INFO"),
+                                        new.get("LOG_MAX_BYTES", logging_setup.DEFAULT_MAX_BYTES),
+                                        new.get("LOG_BACKUP_COUNT", logging_setup.DEFAULT_BACKUP_COUNT))
+    if old is not None and any(old.get(k) != new.get(k) for k in ("OCR_SERVICE_ADDRESS", "OCR_SERVICE_AUTHKEY")):
+        ocr_reader = None  # Rebuilt for the new service settings on next use.
+    if old is None or any(old.get(k) != new.get(k) for k in ADMISSION_CONFIG_KEYS):
+        admission_control.configure(new.get("ADMISSION_WORKER_THREADS"), new.get("ADMISSION_RESERVED_THREADS"), new.get("ADMISSION_LIMITS"))
+    if old is None or any(old.get(k) != new.get(k) for k in EVENT_STREAM_CONFIG_KEYS):
+        port = new.get("EVENT_STREAM_PORT", event_stream.DEFAULT_PORT)
+        if port: event_hub.start(new.get("EVENT_STREAM_HOST") or event_stream.DEFAULT_HOST, port,
+                                 new.get("EVENT_STREAM_RELAY_ADDRESS"), app.config['SECRET_KEY'].encode("utf-8"))
+        else: event_hub.stop()
+    os.makedirs(new["SERVER_SHARE_DIR"], exist_ok=True)
 
 def get_safe_path(subpath):
-    share_dir = os.path.abspath(APP_CONFIG.get("SERVER_SHARE_DIR", "server_share"))
+    share_dir = os.path.abspath(get_config().get("SERVER_SHARE_DIR", "server_share"))
     target_path = os.path.abspath(os.path.join(share_dir, subpath))
     if not target_path.startswith(share_dir): return None
     return target_path
@@ -108,9 +228,17 @@ def token_required(f):
             return jsonify({'message': 'Token has expired!'}), 401
         except Exception as e:
             return jsonify({'message': 'Token is invalid!', 'error': str(e)}), 401
+        use_company_db(g.current_user['company_id'])
         return f(*args, **kwargs)
     return decorated
 
+def use_company_db(company_id):
+    """In sharded mode, points g.db at the company's shard; directory tables stay reachable through it."""
+    if not is_sharded(): return
+    directory = g.db
+    g.db = get_company_db_connection(company_id)
+    directory.close()
+
 def admin_required(f):
     @wraps(f)
     @token_required
@@ -120,6 +248,109 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated
 
+# --- REQUEST PAYLOAD VALIDATION ---
+
+def validate_body(schema, form_field=None, allow_empty=False):
+    """
+    Validates the JSON body (or a JSON-encoded multipart field) against a
+    validators.py schema before the view runs, so malformed requests are
+    rejected before any disk, OCR or workbook work. The parsed payload, with
+    values coerced and model defaults filled in, is in g.payload. GET
+    requests pass straight through.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if request.method == 'GET': return f(*args, **kwargs)
+            if form_field:
+                raw = request.form.get(form_field)
+                if raw is None:
+                    return jsonify({"status": "error", "message": f"Missing '{form_field}' form field.", "errors": [{"field": form_field, "message": "Field required"}]}), 400
+                try: data = app.json.loads(raw)
+                except ValueError:
+                    return jsonify({"status": "error", "message": f"'{form_field}' is not valid JSON.", "errors": [{"field": form_field, "message": "Invalid JSON"}]}), 400
+            else:
+                data = request.get_json(silent=True)
+                if data is None and (not allow_empty or request.get_data(cache=True)):
+                    return jsonify({"status": "error", "message": "Request body must be a JSON document.", "errors": [{"field": "", "message": "Invalid JSON"}]}), 400
+                if data is None: data = {}
+            try:
+                g.payload = validators.validate_payload(schema, data)
+            except validators.PayloadError as e:
+                return jsonify({"status": "error", "message": str(e), "errors": e.errors}), 400
+            return f(*args, **kwargs)
+        return decorated
+    return decorator
+
+# --- ADMISSION CONTROL ---
+
+def admission_controlled(endpoint_class, job_events=False):
+    """
+    Runs the view inside an admission slot of `endpoint_class` (see
+    admission.py). Goes below token_required and validate_body so the company
+    is known and malformed requests never occupy a slot. Over-limit requests
+    get 429/503 with Retry-After immediately or, at worst, after the class's
+    queue timeout. With `job_events`, the wait is announced as the job's
+    "queued" stage and a rejection as "failed".
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            company_id, t0 = g.current_user['company_id'], time.perf_counter()
+            if job_events: publish_job_stage("queued")
+            try:
+                with admission_control.admit(endpoint_class, company_id):
+                    metrics.observe("admission_wait_seconds", time.perf_counter() - t0, endpoint_class=endpoint_class)
+                    return f(*args, **kwargs)
+            except admission.Rejected as e:
+                metrics.inc("admission_rejected_total", endpoint_class=endpoint_class, reason=e.reason)
+                logger.warning(f"Admission: rejected {endpoint_class} request of company {company_id} ({e.reason})")
+                message = ("Too many requests from your company are queued." if e.status == 429
+                           else "The server is busy with other requests.") + f" Retry in {e.retry_after}s."
+                if job_events: publish_job_stage("failed", message=message, retry_after=e.retry_after)
+                response = jsonify({"status": "error", "message": message, "reason": e.reason, "retry_after": e.retry_after})
+                response.status_code, response.headers['Retry-After'] = e.status, str(e.retry_after)
+                return response
+        return decorated
+    return decorator
+
+def _admission_gauge(field):
+    return lambda: [({"endpoint_class": name}, limiter.snapshot()[field]) for name, limiter in admission_control.limiters.items()]
+
+metrics.gauge_callback("admission_queue_depth", _admission_gauge("waiting"))
+metrics.gauge_callback("admission_in_flight", _admission_gauge("running"))
+
+# --- EVENT STREAM ---
+
+def authenticate_stream_token(token):
+    """Checks an access token for the event stream (see event_stream.py); returns (company_id, expiry)."""
+    try:
+        data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
+    except jwt.ExpiredSignatureError:
+        raise event_stream.AuthError('Token has expired!')
+    except Exception:
+        raise event_stream.AuthError('Token is invalid!')
+    return data['company_id'], data.get('exp')
+
+event_hub = event_stream.EventHub(authenticate_stream_token)
+metrics.gauge_callback("event_stream_subscribers", lambda: sum(event_hub.subscriber_counts().values()))
+
+def publish_job_stage(stage, filename=None, **fields):
+    """
+    Announces a stage of the current request's job on the company's event
+    stream. Events carry the request id, so a client that sets X-Request-ID
+    can follow its own upload.
+    """
+    payload = g.get('payload')
+    if filename is None and isinstance(payload, dict): filename = payload.get("Filename")
+    event_hub.publish(g.current_user['company_id'], "job", {"request_id": g.request_id, "endpoint": request.endpoint,
+                                                            "stage": stage, "filename": filename, **fields})
+
+def job_failed(message, status):
+    """Error response of a job endpoint, announced as the job's "failed" stage."""
+    publish_job_stage("failed", message=message)
+    return jsonify({"status": "error", "message": message}), status
+
 # --- AUTHENTICATION & REGISTRATION ENDPOINTS ---
 
 @app.route('/auth/companies', methods=['GET'])
@@ -129,8 +360,9 @@ def get_companies():
     return jsonify([dict(row) for row in companies_cur])
 
 @app.route('/auth/login', methods=['POST'])
+@validate_body(validators.LoginModel)
 def login():
-    auth = request.json
+    auth = g.payload
     if not auth or not auth.get('identifier') or not auth.get('password'):
         return jsonify({'message': 'Identifier and password are required'}), 401
     
@@ -168,7 +400,7 @@ def login():
                 response_data['remember_token'] = remember_token
             except Exception as e:
                 g.db.rollback()
-                print(f"ERROR: Could not save remember token: {e}")
+                logger.error(f"Could not save remember token: {e}")
                 # Fail gracefully, user can still log in without remember me
         
         return jsonify(response_data)
@@ -176,8 +408,9 @@ def login():
     return jsonify({'message': 'Invalid credentials'}), 401
 
 @app.route('/auth/refresh', methods=['POST'])
+@validate_body(validators.RememberTokenModel, allow_empty=True)
 def refresh():
-    data = request.json
+    data = g.payload
     remember_token = data.get('remember_token')
     if not remember_token:
         return jsonify({'message': 'Remember token is missing'}), 401
@@ -217,8 +450,9 @@ def refresh():
 
 @app.route('/auth/logout', methods=['POST'])
 @token_required
+@validate_body(validators.RememberTokenModel, allow_empty=True)
 def logout():
-    data = request.json
+    data = g.payload
     remember_token = data.get('remember_token')
     if remember_token:
         all_tokens = g.db.execute("SELECT token_hash FROM auth_tokens WHERE user_id = ?", (g.current_user['user_id'],)).fetchall()
@@ -231,10 +465,9 @@ def logout():
 
 
 @app.route('/auth/register_company', methods=['POST'])
+@validate_body(validators.RegisterCompanyModel)
 def register_company():
-    data = request.json
-    if not all(k in data for k in ['company_name', 'admin_username', 'admin_email', 'admin_password']):
-        return jsonify({'message': 'Missing company name, admin username, email, or password'}), 400
+    data = g.payload
 
     if g.db.execute("SELECT id FROM companies WHERE lower(name) = lower(?)", (data['company_name'],)).fetchone():
         return jsonify({'message': 'A company with this name already exists'}), 409
@@ -256,14 +489,9 @@ def register_company():
 
 @app.route('/auth/create_user', methods=['POST'])
 @admin_required
+@validate_body(validators.CreateUserModel)
 def create_user():
-    data = request.json
-    if not all(k in data for k in ['username', 'email', 'password', 'role']):
-        return jsonify({'message': 'Missing username, email, password, or role'}), 400
-    
-    if data['role'] not in ['admin', 'user']:
-        return jsonify({'message': "Role must be 'admin' or 'user'"}), 400
-    
+    data = g.payload
     company_id = g.current_user['company_id']
     if g.db.execute("SELECT id FROM users WHERE lower(email) = lower(?)", (data['email'],)).fetchone():
         return jsonify({'message': 'This email is already registered'}), 409
@@ -285,6 +513,7 @@ def create_user():
 
 @app.route('/user/profile', methods=['GET', 'POST'])
 @token_required
+@validate_body(validators.UpdateProfileModel)
 def user_profile():
     user_id = g.current_user['user_id']
     if request.method == 'GET':
@@ -300,7 +529,7 @@ def user_profile():
         return jsonify(profile_data)
 
     if request.method == 'POST':
-        data = request.json
+        data = g.payload
         allowed_fields = {'username': data.get('username'), 'phone_number': data.get('phone_number'), 'dob': data.get('dob')}
         update_fields = {k: v for k, v in allowed_fields.items() if v is not None}
         
@@ -320,9 +549,10 @@ def user_profile():
 
 @app.route('/user/change_password', methods=['POST'])
 @token_required
+@validate_body(validators.ChangePasswordModel)
 def change_password():
     user_id = g.current_user['user_id']
-    data = request.json
+    data = g.payload
     if not data or not data.get('current_password') or not data.get('new_password'):
         return jsonify({'message': 'Current and new passwords are required'}), 400
     
@@ -381,27 +611,77 @@ def serve_profile_picture(filename):
 
 # --- CORE APPLICATION ENDPOINTS ---
 
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus scrape target; open to loopback clients, otherwise requires METRICS_TOKEN as a bearer token."""
+    token = get_config().get("METRICS_TOKEN")
+    is_local = request.remote_addr in ("127.0.0.1", "::1")
+    if not is_local and (not token or request.headers.get('Authorization') != f"Bearer {token}"):
+        return jsonify({"message": "Forbidden"}), 403
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route('/server/profiles')
+@admin_required
+def list_request_profiles():
+    return jsonify(profiling.list_profiles(get_profile_dir()))
+
+@app.route('/server/profiles/<name>')
+@admin_required
+def get_request_profile(name):
+    """Downloads a saved .prof file, or `?format=text` for a pstats report (`sort`, `limit`)."""
+    path = profiling.profile_path(get_profile_dir(), name)
+    if not path: return jsonify({"error": "Profile not found"}), 404
+    if request.args.get('format') == 'text':
+        try: limit = int(request.args.get('limit', 40))
+        except ValueError: return jsonify({"error": "limit must be an integer"}), 400
+        sort = request.args.get('sort', 'cumulative')
+        if sort not in ('cumulative', 'tottime', 'calls', 'ncalls', 'time'): return jsonify({"error": "Invalid sort"}), 400
+        return Response(profiling.summary(path, sort, limit), mimetype="text/plain")
+    return send_from_directory(get_profile_dir(), name, as_attachment=True)
+
+@app.route('/server/admission')
+@admin_required
+def admission_status():
+    """Current slots, queue depth per class and company, and rejection counts."""
+    return jsonify(admission_control.snapshot())
+
 @app.route('/server/settings', methods=['GET', 'POST'])
 @admin_required
 def handle_server_settings():
     if request.method == 'POST':
         try:
-            save_app_config(request.json); return jsonify({"status": "success", "message": "Settings saved."})
+            config_store.save(request.get_json(silent=True)); return jsonify({"status": "success", "message": "Settings saved."})
+        except app_config.ConfigError as e:
+            return jsonify({"status": "error", "message": str(e), "errors": e.errors}), 400
         except Exception as e:
             return jsonify({"status": "error", "message": f"Failed to save settings: {e}"}), 500
-    else: return jsonify(load_app_config())
+    else: return jsonify(app_config.thaw(config_store.current()))
 
 @app.route('/server/files/', defaults={'subpath': ''})
 @app.route('/server/files/<path:subpath>')
 @admin_required
 def list_files(subpath):
+    """
+    Lists a share folder. Without paging parameters the whole folder is
+    returned as a plain list (the original response). With `limit` or `cursor`
+    the response is a page: {"items", "next_cursor"}. Optional: sort=name|size|mtime,
+    order=asc|desc, recursive=1 with depth=N, dir_sizes=1 for recursive folder sizes.
+    """
     safe_path = get_safe_path(subpath)
     if not safe_path or not os.path.isdir(safe_path): return jsonify({"error": "Invalid path"}), 404
+    args = request.args
+    try:
+        depth = max(1, min(int(args.get('depth', file_share.MAX_LIST_DEPTH if args.get('recursive') == '1' else 1)), file_share.MAX_LIST_DEPTH))
+        limit = max(1, min(int(args.get('limit', file_share.DEFAULT_PAGE_SIZE)), file_share.MAX_PAGE_SIZE))
+    except ValueError: return jsonify({"error": "depth and limit must be integers"}), 400
     try:
-        file_list = [{"name": item, "type": "dir" if os.path.isdir(os.path.join(safe_path, item)) else "file",
-                      "size": os.path.getsize(os.path.join(safe_path, item)) if not os.path.isdir(os.path.join(safe_path, item)) else 0}
-                     for item in os.listdir(safe_path)]
-        return jsonify(file_list)
+        dir_sizes = share_size_index if args.get('dir_sizes') == '1' else None
+        if 'limit' not in args and 'cursor' not in args and 'sort' not in args:
+            return jsonify(share_listings.entries(safe_path, depth, dir_sizes))
+        items, next_cursor, total = share_listings.paginate(safe_path, depth, dir_sizes, args.get('sort', 'name'),
+                                                            args.get('order') == 'desc', limit, args.get('cursor'))
+        return jsonify({"items": items, "next_cursor": next_cursor, "total": total})
+    except ValueError as e: return jsonify({"error": str(e)}), 400
     except Exception as e: return jsonify({"error": str(e)}), 500
 
 @app.route('/server/upload/', defaults={'subpath': ''}, methods=['POST'])
@@ -413,50 +693,156 @@ def upload_file(subpath):
     if 'file' not in request.files or not request.files['file'].filename: return jsonify({"error": "No file part"}), 400
     file = request.files['file']; filename = secure_filename(file.filename)
     file.save(os.path.join(safe_path, filename))
+    share_size_index.invalidate(safe_path, get_safe_path('')); share_listings.invalidate(safe_path)
     return jsonify({"status": "success", "message": f"File '{filename}' uploaded."})
 
+@app.route('/server/download/', defaults={'filepath': ''})
 @app.route('/server/download/<path:filepath>')
 @admin_required
 def download_server_file(filepath):
+    """Files support Range/If-Range for resuming and parallel fetches; folders stream as a zip."""
     safe_path = get_safe_path(filepath)
+    if safe_path and os.path.isdir(safe_path): return download_server_folder(safe_path)
     if not safe_path or not os.path.isfile(safe_path): return jsonify({"error": "File not found"}), 404
-    return send_from_directory(os.path.dirname(safe_path), os.path.basename(safe_path), as_attachment=True)
+    return send_from_directory(os.path.dirname(safe_path), os.path.basename(safe_path), as_attachment=True, conditional=True, etag=True)
+
+def download_server_folder(safe_path):
+    entries = file_share.archive_entries(safe_path)
+    etag = file_share.archive_etag(entries)
+    archive_name = secure_filename(os.path.basename(safe_path)) or "server_share"
+    headers = {"ETag": f'"{etag}"', "Accept-Ranges": "bytes", "Content-Disposition": f'attachment; filename="{archive_name}.zip"'}
+    byte_range = request.range
+    if_range = request.if_range
+    # A Range is honoured only if If-Range is absent or names this exact archive.
+    range_valid = (not if_range.etag and not if_range.date) or if_range.etag == etag
+    if byte_range and len(byte_range.ranges) == 1 and range_valid:
+        length = file_share.archive_length(entries, etag)
+        bounds = byte_range.range_for_length(length)
+        if bounds is None:
+            return Response(status=416, headers={**headers, "Content-Range": f"bytes */{length}"})
+        start, stop = bounds
+        headers.update({"Content-Range": f"bytes {start}-{stop - 1}/{length}", "Content-Length": str(stop - start)})
+        return Response(file_share.iter_archive(entries, start, stop - 1), status=206, mimetype="application/zip",
+                        headers=headers, direct_passthrough=True)
+    length = file_share.cached_archive_length(etag)
+    if length is not None: headers["Content-Length"] = str(length)
+    return Response(file_share.iter_archive(entries, etag=etag), mimetype="application/zip", headers=headers, direct_passthrough=True)
+
+# --- RESUMABLE SHARE UPLOADS ---
+
+def get_share_dir():
+    return os.path.abspath(get_config().get("SERVER_SHARE_DIR", "server_share"))
+
+@app.route('/server/uploads', methods=['POST'])
+@admin_required
+@validate_body(validators.UploadInitModel)
+def initiate_upload():
+    """Starts a chunked upload: {"path": <share folder>, "filename", "size", "sha256" (optional)}."""
+    data = g.payload
+    dest_path = get_safe_path(data.get('path', ''))
+    filename = secure_filename(data['filename'])
+    if not dest_path or not os.path.isdir(dest_path): return jsonify({"error": "Invalid destination"}), 400
+    if not filename: return jsonify({"error": "A filename is required"}), 400
+    size = int(data['size'])
+    share_dir = get_share_dir()
+    file_share.collect_stale_uploads(share_dir)
+    upload = file_share.create_upload(share_dir, os.path.relpath(dest_path, share_dir), filename, size, data.get('sha256'))
+    return jsonify({"status": "success", "upload": upload}), 201
+
+@app.route('/server/uploads/<upload_id>', methods=['GET', 'PUT', 'DELETE'])
+@admin_required
+def handle_upload(upload_id):
+    """GET reports progress, PUT ?offset=N streams a raw chunk, DELETE aborts."""
+    share_dir = get_share_dir()
+    if request.method == 'DELETE':
+        if not file_share.abort_upload(share_dir, upload_id): return jsonify({"error": "Upload not found"}), 404
+        return jsonify({"status": "success", "message": "Upload aborted."})
+    upload = file_share.get_upload(share_dir, upload_id)
+    if upload is None: return jsonify({"error": "Upload not found"}), 404
+    if request.method == 'GET': return jsonify(upload)
+    try: offset = int(request.args.get('offset', upload['received']))
+    except ValueError: return jsonify({"error": "offset must be an integer"}), 400
+    if request.content_length and offset + request.content_length > upload['size']:
+        return jsonify({"error": f"chunk runs past the declared size of {upload['size']} bytes", "received": upload['received']}), 409
+    try:
+        received = file_share.write_chunk(share_dir, upload_id, offset, request.stream)
+    except KeyError: return jsonify({"error": "Upload not found"}), 404
+    except ValueError as e:
+        return jsonify({"error": str(e), "received": file_share.get_upload(share_dir, upload_id)['received']}), 409
+    return jsonify({"status": "success", "received": received, "size": upload['size']})
+
+@app.route('/server/uploads/<upload_id>/complete', methods=['POST'])
+@admin_required
+@validate_body(validators.UploadCompleteModel, allow_empty=True)
+def complete_upload(upload_id):
+    share_dir = get_share_dir()
+    try:
+        final_path = file_share.complete_upload(share_dir, upload_id, g.payload.get('sha256'))
+    except KeyError: return jsonify({"error": "Upload not found"}), 404
+    except ValueError as e: return jsonify({"error": str(e)}), 409
+    share_size_index.invalidate(os.path.dirname(final_path), share_dir); share_listings.invalidate(os.path.dirname(final_path))
+    return jsonify({"status": "success", "message": f"File '{os.path.basename(final_path)}' uploaded.",
+                    "path": os.path.relpath(final_path, share_dir).replace(os.sep, '/')})
 
 @app.route('/printers', methods=['GET', 'POST'])
 @token_required
+@validate_body(validators.PrinterListModel)
 def handle_printers():
     company_id = g.current_user['company_id']
     if request.method == 'POST':
         try:
             cursor = g.db.cursor()
+            old_printers = {row['id']: dict(row) for row in cursor.execute("SELECT * FROM printers WHERE company_id = ?", (company_id,)).fetchall()}
             cursor.execute("DELETE FROM printers WHERE company_id = ?", (company_id,))
-            for p in request.json:
+            for p in g.payload:
                 cursor.execute("""
                     INSERT INTO printers (id, company_id, brand, model, setup_cost, maintenance_cost, lifetime_years, power_w, price_kwh, buffer_factor, uptime_percent)
                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
                     (p['id'], company_id, p['brand'], p['model'], p['setup_cost'], p['maintenance_cost'], p['lifetime_years'], p['power_w'], p['price_kwh'], p.get('buffer_factor', 1.0), p.get('uptime_percent', 50)))
             g.db.commit()
-            return jsonify({"status": "saved"})
+            event_hub.bump_catalog(company_id, "printers", "saved")
+            response = {"status": "saved"}
+            if request.args.get('recost') == '1':
+                changed = [p['id'] for p in g.payload if p['id'] in old_printers and any(
+                    old_printers[p['id']][k] != p.get(k, PRINTER_COST_DEFAULTS.get(k)) for k in PRINTER_COST_FIELDS)]
+                if changed: response["recost_run_id"] = start_recost_run(company_id, {"printer_ids": changed, "filaments": None, "since": None})
+            return jsonify(response)
         except Exception as e:
             g.db.rollback(); return jsonify({"status": "error", "message": str(e)}), 500
     else:
         printers_cur = g.db.execute("SELECT * FROM printers WHERE company_id = ?", (company_id,)).fetchall()
-        return jsonify([dict(row) for row in printers_cur])
+        return json_output.stream_json(app, [dict(row) for row in printers_cur])
 
 @app.route('/filaments', methods=['GET', 'POST'])
 @token_required
+@validate_body(validators.FilamentCatalogModel)
 def handle_filaments():
     company_id = g.current_user['company_id']
     if request.method == 'POST':
         try:
             cursor = g.db.cursor()
-            cursor.execute("DELETE FROM filaments WHERE company_id = ?", (company_id,))
-            for material, brands in request.json.items():
-                for brand, details in brands.items():
-                    cursor.execute("INSERT INTO filaments (company_id, material, brand, price, stock_g, efficiency_factor) VALUES (?, ?, ?, ?, ?, ?)",
-                                   (company_id, material, brand, details['price'], details['stock_g'], details['efficiency_factor']))
+            old_prices = {(row['material'], row['brand']): (row['price'], row['efficiency_factor'])
+                          for row in cursor.execute("SELECT material, brand, price, efficiency_factor FROM filaments WHERE company_id = ?", (company_id,)).fetchall()}
+            posted = [(material, brand, details) for material, brands in g.payload.items() for brand, details in brands.items()]
+            keep = {(material, brand) for material, brand, _ in posted}
+            for row in cursor.execute("SELECT material, brand FROM filaments WHERE company_id = ?", (company_id,)).fetchall():
+                if (row['material'], row['brand']) not in keep:
+                    cursor.execute("DELETE FROM filaments WHERE company_id = ? AND material = ? AND brand = ?", (company_id, row['material'], row['brand']))
+            for material, brand, details in posted:
+                # Catalog fields are updated in place; stock changes go through the ledger as adjustments.
+                cursor.execute("""
+                    INSERT INTO filaments (company_id, material, brand, price, stock_g, efficiency_factor) VALUES (?, ?, ?, ?, 0, ?)
+                    ON CONFLICT (company_id, material, brand) DO UPDATE SET price = excluded.price, efficiency_factor = excluded.efficiency_factor""",
+                    (company_id, material, brand, details['price'], details['efficiency_factor']))
+                stock_ledger.set_balance(g.db, company_id, material, brand, details['stock_g'])
             g.db.commit()
-            return jsonify({"status": "saved"})
+            event_hub.bump_catalog(company_id, "filaments", "saved")
+            response = {"status": "saved"}
+            if request.args.get('recost') == '1':
+                changed = [[material, brand] for material, brand, details in posted if (material, brand) in old_prices
+                           and old_prices[(material, brand)] != (details['price'], details['efficiency_factor'])]
+                if changed: response["recost_run_id"] = start_recost_run(company_id, {"printer_ids": None, "filaments": changed, "since": None})
+            return jsonify(response)
         except Exception as e:
             g.db.rollback(); return jsonify({"status": "error", "message": str(e)}), 500
     else:
@@ -466,14 +852,31 @@ def handle_filaments():
             material = row['material']
             if material not in filaments_dict: filaments_dict[material] = {}
             filaments_dict[material][row['brand']] = {'price': row['price'], 'stock_g': row['stock_g'], 'efficiency_factor': row['efficiency_factor']}
-        return jsonify(filaments_dict)
+        return json_output.stream_json(app, filaments_dict)
+
+@app.route('/filaments/movements', methods=['GET'])
+@token_required
+def get_stock_movements():
+    args = request.args
+    try:
+        limit = min(int(args.get('limit', 100)), 1000)
+        before = int(args['before']) if args.get('before') else None
+    except ValueError:
+        return jsonify({"status": "error", "message": "limit and before must be integers."}), 400
+    return jsonify(stock_ledger.list_movements(g.db, g.current_user['company_id'], args.get('material'),
+                                               args.get('brand'), limit, before))
+
+@app.route('/filaments/forecast', methods=['GET'])
+@token_required
+def get_stock_forecast():
+    return jsonify(stock_ledger.consumption_forecast(g.db, g.current_user['company_id']))
 
 @app.route('/logs', methods=['GET'])
 @token_required
 def get_logs():
     log_path = get_company_data_path(g.current_user['company_id'], "app_logs.json")
     try:
-        with open(log_path, 'r') as f: return jsonify(json.load(f))
+        with open(log_path, 'rb') as f: return json_output.stream_json(app, app.json.loads(f.read()))
     except (FileNotFoundError, json.JSONDecodeError): return jsonify([])
 
 @app.route('/processed_log', methods=['GET'])
@@ -481,34 +884,31 @@ def get_logs():
 def get_processed_log():
     log_path = get_company_data_path(g.current_user['company_id'], "processed_log.json")
     try:
-        with open(log_path, 'r') as f: return jsonify(json.load(f))
+        with open(log_path, 'rb') as f: return json_output.stream_json(app, app.json.loads(f.read()))
     except (FileNotFoundError, json.JSONDecodeError): return jsonify({})
 
 @app.route('/generate_quotation', methods=['POST'])
 @token_required
+@validate_body(validators.GenerateQuotationModel, form_field='json')
 def generate_quotation():
     company_id = g.current_user['company_id']
     try:
-        data = json.loads(request.form['json'])
+        data = g.payload
         
-        # --- Logo handling remains the same ---
-        logo_path = None
-        if 'logo' in request.files:
-            uploads_folder = get_company_data_path(company_id, "uploads")
-            os.makedirs(uploads_folder, exist_ok=True)
+        # --- Logo: an uploaded logo replaces the stored one; otherwise the stored logo is used ---
+        company_dir = get_company_data_path(company_id)
+        if 'logo' in request.files and request.files['logo'].filename:
             logo_file = request.files['logo']
-            logo_path = os.path.join(uploads_folder, secure_filename(logo_file.filename))
-            logo_file.save(logo_path)
-            data['company_details']['logo_path'] = logo_path
+            quotations.store_logo(g.db, company_id, company_dir, logo_file.stream, os.path.splitext(logo_file.filename)[1])
+        logo_path = quotations.get_logo_path(g.db, company_id, company_dir)
 
         # --- PDF Generation in Memory ---
         buffer = BytesIO()
-        generate_quotation_pdf(buffer, data) # Your PDF function now writes to the buffer
+        quotations.generate_quotation_pdf(buffer, data, logo_path) # Your PDF function now writes to the buffer
         buffer.seek(0) # Rewind the buffer to the beginning
 
         # --- Create a filename for the download ---
-        customer_name_safe = re.sub(r'[^a-zA-Z0-9_]', '', data['customer_name'].replace(' ', '_'))
-        filename = f"Quotation_{customer_name_safe}_{int(time.time())}.pdf"
+        filename = quotations.quotation_filename(data)
 
         return send_file(
             buffer,
@@ -518,85 +918,374 @@ def generate_quotation():
         )
 
     except Exception as e:
-        traceback.print_exc()
+        logger.exception("Quotation generation failed")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/generate_quotations/batch', methods=['POST'])
+@token_required
+@validate_body(validators.BatchQuotationModel)
+@admission_controlled("batch")
+def generate_quotations_batch():
+    """
+    Many quotations in one call: {"quotes": [...], "format": "zip" | "pdf",
+    "company_details": {...}}. Top-level company_details apply to quotes
+    without their own; the company's stored logo is used throughout.
+    """
+    company_id = g.current_user['company_id']
+    try:
+        data = g.payload
+        quotes, output = data['quotes'], data.get('format', 'zip')
+        if len(quotes) > MAX_QUOTATION_BATCH:
+            return jsonify({"status": "error", "message": f"At most {MAX_QUOTATION_BATCH} quotes per batch."}), 400
+        for quote in quotes:
+            quote['company_details'] = quote.get('company_details') or data.get('company_details') or {}
+        logo_path = quotations.get_logo_path(g.db, company_id, get_company_data_path(company_id))
+
+        buffer = BytesIO()
+        if output == 'pdf':
+            quotations.generate_batch_pdf(buffer, quotes, logo_path)
+            filename, mimetype = f"Quotations_{int(time.time())}.pdf", 'application/pdf'
+        else:
+            quotations.generate_batch_zip(buffer, quotes, logo_path)
+            filename, mimetype = f"Quotations_{int(time.time())}.zip", 'application/zip'
+        buffer.seek(0)
+        return send_file(buffer, as_attachment=True, download_name=filename, mimetype=mimetype)
+    except Exception as e:
+        logger.exception("Batch quotation generation failed")
         return jsonify({"status": "error", "message": str(e)}), 500
 
+@app.route('/company/logo', methods=['GET', 'POST'])
+@token_required
+def company_logo():
+    company_id = g.current_user['company_id']
+    company_dir = get_company_data_path(company_id)
+    if request.method == 'POST':
+        if g.current_user['role'] != 'admin':
+            return jsonify({'message': 'Admin privileges required!'}), 403
+        if 'logo' not in request.files or not request.files['logo'].filename:
+            return jsonify({"error": "No logo file provided"}), 400
+        logo_file = request.files['logo']
+        digest = quotations.store_logo(g.db, company_id, company_dir, logo_file.stream, os.path.splitext(logo_file.filename)[1])
+        return jsonify({"status": "success", "hash": digest})
+    logo_path = quotations.get_logo_path(g.db, company_id, company_dir)
+    if not logo_path or not os.path.isfile(logo_path):
+        return jsonify({"error": "No logo stored"}), 404
+    return send_file(logo_path, etag=os.path.basename(logo_path).split('.')[0], conditional=True)
+
 @app.route('/images/<path:filename>')
 @token_required
 def serve_image(filename):
-    image_dir = get_company_data_path(g.current_user['company_id'], "local_log_images")
-    return send_from_directory(image_dir, filename)
+    company_id = g.current_user['company_id']
+    try:
+        pixels = image_store.parse_variant_size(request.args.get('size'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    blob = image_store.resolve_name(g.db, company_id, filename)
+    archived = False
+    if blob:
+        digest, blob_root = blob['hash'], get_company_data_path(company_id, image_store.BLOB_DIR)
+        original_path = image_store.stored_path(blob_root, blob)
+        archived = original_path != image_store.blob_path(blob_root, digest, blob['ext'])
+    else:
+        # Images uploaded before the content-addressed store was introduced.
+        digest = None
+        original_path = safe_join(get_company_data_path(company_id, image_store.LEGACY_DIR), filename)
+    if not original_path or not os.path.isfile(original_path):
+        return jsonify({"error": "Image not found"}), 404
+    try:
+        path = image_store.get_variant_path(original_path, pixels) if pixels else original_path
+    except Exception as e:
+        logger.exception("Image variant generation failed"); return jsonify({"error": f"Could not generate image variant: {e}"}), 500
+
+    # A URL pinned to the content hash (?v=<image_hash>) can never change, so it is
+    # cached forever; plain filename URLs are revalidated cheaply via the ETag.
+    pinned = digest is not None and request.args.get('v') == digest
+    response = send_file(path, etag=image_store.image_etag(original_path, pixels, digest, archived), conditional=True,
+                         max_age=IMAGE_CACHE_MAX_AGE if pinned else None)
+    if pinned:
+        response.cache_control.public = True; response.cache_control.immutable = True
+    return response
+
+@app.route('/server/images/gc', methods=['POST'])
+@admin_required
+def collect_image_garbage():
+    company_id = g.current_user['company_id']
+    try:
+        stats = image_store.collect_garbage(g.db, company_id, get_company_data_path(company_id, image_store.BLOB_DIR))
+        return jsonify({"status": "success", **stats})
+    except Exception as e:
+        logger.exception("Image garbage collection failed"); return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/server/archive', methods=['POST'])
+@admin_required
+def run_archival():
+    """Runs an archival pass for the caller's company now (the scheduled pass covers every company)."""
+    company_id = g.current_user['company_id']
+    try:
+        stats = archival.run(g.db, company_id, get_company_data_path(company_id), get_config(), company_file_lock(company_id))
+        return jsonify({"status": "success", **stats})
+    except Exception as e:
+        logger.exception("Archival failed"); return jsonify({"status": "error", "message": str(e)}), 500
 
 @app.route('/ocr_upload', methods=['POST'])
 @token_required
+@admission_controlled("ocr", job_events=True)
 def ocr_upload():
-    if 'image' not in request.files: return jsonify({"error": "No image file provided"}), 400
+    if 'image' not in request.files:
+        publish_job_stage("failed", message="No image file provided"); return jsonify({"error": "No image file provided"}), 400
+    filename = request.files['image'].filename
     try:
         reader = get_ocr_reader()
-        if not reader: return jsonify({"error": "OCR model not available."}), 500
-        ocr_results = reader.readtext(request.files['image'].read())
-        return jsonify(extract_data_from_ocr(g.current_user['company_id'], ocr_results))
+        if not reader:
+            publish_job_stage("failed", filename, message="OCR model not available."); return jsonify({"error": "OCR model not available."}), 500
+        image_bytes = request.files['image'].read()
+        publish_job_stage("ocr", filename)
+        metrics.inc("ocr_requests_started_total")
+        try:
+            with metrics.timer("ocr_inference_duration_seconds"):
+                ocr_results = reader.readtext(image_bytes)
+        finally:
+            metrics.inc("ocr_requests_finished_total")
+        extracted = extract_data_from_ocr(g.current_user['company_id'], ocr_results)
+        publish_job_stage("done", filename)
+        return jsonify(extracted)
     except Exception as e:
-        traceback.print_exc(); return jsonify({"error": f"OCR processing failed: {e}"}), 500
+        logger.exception("OCR processing failed")
+        publish_job_stage("failed", filename, message=f"OCR processing failed: {e}")
+        return jsonify({"error": f"OCR processing failed: {e}"}), 500
 
 @app.route('/process_image', methods=['POST'])
 @token_required
+@validate_body(validators.ProcessImageModel, form_field='json')
+@admission_controlled("process", job_events=True)
 def process_image_upload():
     company_id = g.current_user['company_id']
-    if 'image' not in request.files or 'json' not in request.form: 
-        return jsonify({"error": "Missing image or data"}), 400
+    if 'image' not in request.files: 
+        publish_job_stage("failed", message="Missing image or data"); return jsonify({"error": "Missing image or data"}), 400
     
-    final_data = json.loads(request.form['json'])
+    final_data = g.payload
     image_file = request.files['image']
     
     try:
-        # --- Step 1: Save the uploaded image ---
-        image_dir = get_company_data_path(company_id, "local_log_images")
-        os.makedirs(image_dir, exist_ok=True)
-        new_filename = final_data["Filename"] + os.path.splitext(image_file.filename)[1]
-        image_file.save(os.path.join(image_dir, new_filename))
+        # --- Step 1: Save the uploaded image into the content-addressed store ---
+        image_ext = os.path.splitext(image_file.filename)[1].lower()
+        new_filename = final_data["Filename"] + image_ext
+        with metrics.timer("job_stage_duration_seconds", stage="save_image"):
+            image_blob = image_store.save_blob(get_company_data_path(company_id, image_store.BLOB_DIR), image_file.stream, image_ext)
 
         # --- Step 2: Validate Printer and Filament data from the database ---
-        printer_row = g.db.execute("SELECT * FROM printers WHERE id=? AND company_id=?", (final_data.get("printer_id"), company_id)).fetchone()
-        filament_row = g.db.execute("SELECT * FROM filaments WHERE material=? AND brand=? AND company_id=?", (final_data.get("Material"), final_data.get("Brand"), company_id)).fetchone()
+        publish_job_stage("costing")
+        with metrics.timer("job_stage_duration_seconds", stage="db_lookup"):
+            printer_row = g.db.execute("SELECT * FROM printers WHERE id=? AND company_id=?", (final_data.get("printer_id"), company_id)).fetchone()
+            filament_row = g.db.execute("SELECT * FROM filaments WHERE material=? AND brand=? AND company_id=?", (final_data.get("Material"), final_data.get("Brand"), company_id)).fetchone()
         
         if not printer_row or not filament_row:
-            return jsonify({"status": "error", "message": "Critical data missing: Printer or filament not found in the database."}), 400
+            return job_failed("Critical data missing: Printer or filament not found in the database.", 400)
         
         printer, filament = dict(printer_row), dict(filament_row)
 
         # --- Step 3: Perform Calculations ---
-        cogs = calculate_cogs_values(final_data, printer, filament)
+        with metrics.timer("job_stage_duration_seconds", stage="cogs"):
+            cogs = calculate_cogs_values(final_data, printer, filament)
 
-        # --- Step 4: Create Individual Excel Log ---
-        excel_path, excel_msg = create_excel_file(company_id, final_data, printer, filament)
-        if not excel_path:
-            return jsonify({"status": "error", "message": f"Failed to create Excel log: {excel_msg}"}), 500
+        template_path = get_config().get("TEMPLATE_PATH", "FDM.xlsx")
+        if not os.path.exists(template_path):
+            return job_failed(f"Failed to create Excel log: Template '{template_path}' not found.", 500)
 
-        # --- Step 5: Update Master Log ---
-        success, msg = log_to_master_excel(company_id, excel_path, final_data, cogs['user_cogs'], cogs['default_cogs'])
-        if not success:
-            return jsonify({"status": "error", "message": f"Failed to update master log: {msg}"}), 500
-            
-        # --- Step 6: Finalize and commit changes ---
-        update_filament_stock(company_id, final_data)
-        save_app_log(company_id, final_data, cogs, new_filename)
-        
-        processed_log_path = get_company_data_path(company_id, "processed_log.json")
-        processed_log = json.load(open(processed_log_path)) if os.path.exists(processed_log_path) else {}
-        processed_log[os.path.basename(image_file.filename)] = "completed"
-        with open(processed_log_path, 'w') as f: json.dump(processed_log, f, indent=2)
-        
+        # --- Step 4: Commit all database side effects in a single transaction ---
+        try:
+            with metrics.timer("job_stage_duration_seconds", stage="db_commit"):
+                job_id = record_processed_job(g.db, company_id, final_data, cogs, new_filename, image_blob,
+                                              excel_log_path(company_id, final_data["Filename"]),
+                                              os.path.basename(image_file.filename), excel_inputs=(printer, filament))
+                g.db.commit()
+        except Exception:
+            g.db.rollback(); raise
+        event_hub.bump_catalog(company_id, "filaments", "stock")
+
+        # --- Step 5: Write the Excel logs and JSON log files from the committed journal ---
+        publish_job_stage("excel")
+        with metrics.timer("job_stage_duration_seconds", stage="json_logs"):
+            finalized = finalize_job_outputs(g.db, company_id)
+        if not finalized:
+            publish_job_stage("done", job_id=job_id, user_cogs=cogs['user_cogs'], default_cogs=cogs['default_cogs'])
+            return jsonify({"status": "success", "message": "File processed.",
+                            "warning": "The job is saved, but its log files could not be written yet; they will be retried."})
+
+        publish_job_stage("done", job_id=job_id, user_cogs=cogs['user_cogs'], default_cogs=cogs['default_cogs'])
         return jsonify({"status": "success", "message": "File processed and logged successfully."})
 
     except Exception as e:
-        traceback.print_exc()
-        return jsonify({"status": "error", "message": f"An unexpected server error occurred: {str(e)}"}), 500
+        logger.exception("Job processing failed")
+        return job_failed(f"An unexpected server error occurred: {str(e)}", 500)
+
+@app.route('/costing/batch', methods=['POST'])
+@token_required
+@validate_body(validators.BatchCostingModel, allow_empty=True)
+@admission_controlled("batch")
+def batch_costing():
+    """
+    What-if costing of many jobs across printer x filament x labour-rate
+    scenarios. Jobs come inline (`jobs`), from history (`job_ids`), or default
+    to the company's whole job history. `printers` / `filaments` entries may
+    reference the catalog (id, or material+brand) or be full inline objects.
+    """
+    company_id = g.current_user['company_id']
+    data = g.payload
+    try:
+        if data.get('jobs') is not None:
+            jobs = data['jobs']
+        else:
+            query = "SELECT id, filament_g, time_str, labour_time_min FROM jobs WHERE company_id = ?"
+            params = [company_id]
+            if data.get('job_ids') is not None:
+                query += f" AND id IN ({','.join('?' * len(data['job_ids']))})"; params += data['job_ids']
+            jobs = [{"id": row['id'], "Filament (g)": row['filament_g'], "Time (e.g. 7h 30m)": row['time_str'],
+                     "Labour Time (min)": row['labour_time_min']} for row in g.db.execute(query, params)]
+
+        printers = []
+        for p in data.get('printers') or [row['id'] for row in g.db.execute("SELECT id FROM printers WHERE company_id = ?", (company_id,))]:
+            if isinstance(p, dict): printers.append(p); continue
+            row = g.db.execute("SELECT * FROM printers WHERE id = ? AND company_id = ?", (p, company_id)).fetchone()
+            if not row: return jsonify({"status": "error", "message": f"Printer '{p}' not found."}), 400
+            printers.append(dict(row))
+
+        filaments = []
+        for f in data.get('filaments') or [dict(row) for row in g.db.execute("SELECT material, brand FROM filaments WHERE company_id = ?", (company_id,))]:
+            if 'price' in f: filaments.append(f); continue
+            row = g.db.execute("SELECT * FROM filaments WHERE material = ? AND brand = ? AND company_id = ?",
+                               (f.get('material'), f.get('brand'), company_id)).fetchone()
+            if not row: return jsonify({"status": "error", "message": f"Filament {f.get('material')}/{f.get('brand')} not found."}), 400
+            filaments.append(dict(row))
+
+        labour_rates = data.get('labour_rates') or [costing.DEFAULT_LABOUR_RATE_HR]
+        margins = data.get('margin_percents', [])
+        mode = data.get('output', 'aggregate')
+        cells = len(jobs) * len(printers) * len(filaments) * len(labour_rates) * max(len(margins), 1)
+        if mode == 'matrix' and cells > MAX_COSTING_MATRIX_CELLS:
+            return jsonify({"status": "error", "message": f"Matrix of {cells} cells exceeds {MAX_COSTING_MATRIX_CELLS}; request 'aggregate' output."}), 400
+
+        user, default = costing.batch_cogs(jobs, printers, filaments, labour_rates)
+        result = {
+            "axes": {
+                "jobs": [j.get('id', i) for i, j in enumerate(jobs)],
+                "printers": [p.get('id', f"{p.get('brand', '')} {p.get('model', '')}".strip()) for p in printers],
+                "filaments": [f"{f.get('material')}/{f.get('brand')}" for f in filaments],
+                "labour_rates": labour_rates, "margin_percents": margins,
+            }
+        }
+        if mode == 'matrix':
+            result["user_cogs"] = user.tolist(); result["default_cogs"] = default.tolist()
+            if margins: result["user_price"] = costing.apply_margins(user, margins).tolist()
+        else:
+            # Aggregates over the job axis: one value per printer x filament x labour rate.
+            result["job_count"] = len(jobs)
+            result["user_cogs_total"] = user.sum(axis=0).tolist()
+            result["user_cogs_mean"] = (user.mean(axis=0) if len(jobs) else user.sum(axis=0)).tolist()
+            result["default_cogs_total"] = default.sum(axis=0).tolist()
+            if margins: result["user_price_total"] = costing.apply_margins(user.sum(axis=0), margins).tolist()
+        return jsonify(result)
+    except Exception as e:
+        logger.exception("Batch costing failed")
+        return jsonify({"status": "error", "message": f"Batch costing failed: {e}"}), 500
+
+def start_recost_run(company_id, scope):
+    """Registers a re-costing run and starts it on a background thread; returns the run id or None if one is active."""
+    run_id = recosting.start_run(g.db, company_id, scope)
+    if run_id:
+        recosting.run_in_background(lambda: get_company_db_connection(company_id), run_id, company_id, scope, finalize_job_outputs)
+    return run_id
+
+@app.route('/costing/recost', methods=['POST'])
+@admin_required
+@validate_body(validators.RecostModel, allow_empty=True)
+def recost_jobs():
+    """
+    Re-costs stored jobs against the current catalog in the background. Scope
+    with `printer_ids` and/or `filaments` ([{material, brand}]) and `since`;
+    an empty body re-costs the whole history.
+    """
+    data = g.payload
+    scope = {"printer_ids": data.get('printer_ids'), "since": data.get('since'),
+             "filaments": [[f['material'], f['brand']] for f in data['filaments']] if data.get('filaments') is not None else None}
+    run_id = start_recost_run(g.current_user['company_id'], scope)
+    if not run_id:
+        return jsonify({"status": "error", "message": "A re-costing run is already in progress."}), 409
+    return jsonify({"status": "accepted", "run_id": run_id}), 202
+
+@app.route('/costing/recost/<run_id>', methods=['GET'])
+@token_required
+def get_recost_run(run_id):
+    run = recosting.get_run(g.db, g.current_user['company_id'], run_id)
+    if not run: return jsonify({"status": "error", "message": "Run not found."}), 404
+    return jsonify(run)
+
+@app.route('/analytics/usage', methods=['GET'])
+@token_required
+def get_usage_analytics():
+    """Usage/COGS sums from the incrementally maintained rollups, e.g. ?period=week&material=PETG&group_by=period_start,printer_id"""
+    args = request.args
+    group_by = args.get('group_by')
+    try:
+        rows = analytics.query_usage(
+            g.db, g.current_user['company_id'], period_type=args.get('period', 'month'),
+            start=args.get('from'), end=args.get('to'),
+            filters={d: args.get(d) for d in analytics.DIMENSIONS if d != 'period_start'},
+            group_by=group_by.split(',') if group_by is not None else analytics.DIMENSIONS)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify({"period": args.get('period', 'month'), "rows": rows})
+
+@app.route('/search', methods=['GET'])
+@token_required
+def search_jobs():
+    """
+    Full-text job search, e.g. ?q=labubu plate petg spring&material=PETG&from=2024-01-01&to=2024-06-30.
+    Every word matches as a prefix; sort=relevance|recent; paginate with limit/offset (next_offset).
+    """
+    args = request.args
+    t0 = time.perf_counter()
+    try:
+        results, next_offset = job_search.search(
+            g.db, g.current_user['company_id'], args.get('q', ''),
+            filters={key: args.get(key) for key in job_search.FILTERS},
+            start=args.get('from'), end=args.get('to'), sort=args.get('sort', 'relevance'),
+            limit=int(args.get('limit', job_search.DEFAULT_PAGE_SIZE)), offset=int(args.get('offset', 0)))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify({"query": args.get('q', ''), "results": results, "next_offset": next_offset,
+                    "took_ms": round((time.perf_counter() - t0) * 1000, 2)})
+
+@app.route('/events', methods=['GET'])
+def event_stream_redirect():
+    """
+    The event stream is served on its own port (see event_stream.py); this
+    sends EventSource clients there, keeping the query string (token, last_event_id).
+    The listener is plain HTTP, so behind TLS set EVENT_STREAM_PUBLIC_URL to
+    the proxied stream URL.
+    """
+    if not event_hub.address:
+        return jsonify({"status": "error", "message": "The event stream is disabled."}), 503
+    location = get_config().get("EVENT_STREAM_PUBLIC_URL")
+    if not location:
+        host = request.host if request.host.endswith(']') or ':' not in request.host else request.host.rsplit(':', 1)[0]
+        location = f"http://{host}:{event_hub.address[1]}/events"
+    if request.query_string: location += ("&" if "?" in location else "?") + request.query_string.decode("latin-1")
+    return Response(status=307, headers={"Location": location})
 
 @app.route('/download/log/<path:filename>')
 @token_required
 def download_log_file(filename):
-    excel_dir = get_company_data_path(g.current_user['company_id'], "Excel_Logs")
+    """Per-job workbook from Excel_Logs or, once archival has packed its month, from the month's archive."""
+    company_id = g.current_user['company_id']
+    excel_dir = get_company_data_path(company_id, archival.EXCEL_DIR)
+    path = safe_join(os.path.abspath(excel_dir), filename)
+    if path and not os.path.isfile(path):
+        data = archival.read_archived_file(g.db, company_id, get_company_data_path(company_id), archival.KIND_EXCEL_LOG, filename)
+        if data is not None:
+            return send_file(BytesIO(data), as_attachment=True, download_name=os.path.basename(filename),
+                             mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
     return send_from_directory(os.path.abspath(excel_dir), filename, as_attachment=True)
 
 @app.route('/download/masterlog/<year_month>')
@@ -608,36 +1297,6 @@ def download_master_log_file(year_month):
 
 # --- PROCESSING HELPER FUNCTIONS (FULL CODE) ---
 
-def parse_time_string(time_str):
-    h_match = re.search(r'(\d+)\s*h', time_str, re.IGNORECASE); h = int(h_match.group(1)) if h_match else 0
-    m_match = re.search(r'(\d+)\s*m', time_str, re.IGNORECASE); m = int(m_match.group(1)) if m_match else 0
-    s_match = re.search(r'(\d+)\s*s', time_str, re.IGNORECASE); s = int(s_match.group(1)) if s_match else 0
-    return round(h + (m / 60.0) + (s / 3600.0), 2)
-
-def calculate_printer_hourly_rate(printer_data):
-    try:
-        total_cost = printer_data['setup_cost'] + (printer_data['maintenance_cost'] * printer_data['lifetime_years'])
-        total_hours = printer_data['lifetime_years'] * 365 * 24 * (printer_data.get('uptime_percent', 50) / 100)
-        if total_hours == 0: return 0.0
-        return (total_cost / total_hours) + ((printer_data['power_w'] / 1000) * printer_data['price_kwh'])
-    except (KeyError, TypeError, ZeroDivisionError): return 0.0
-
-def calculate_cogs_values(form_data, printer_data, filament_data):
-    try:
-        filament_g = float(form_data.get("Filament (g)", 0)); time_str = form_data.get("Time (e.g. 7h 30m)", "0h 0m")
-        labour_time_min = float(form_data.get("Labour Time (min)", 0)); labour_rate_user = float(form_data.get("Labour Rate (₹/hr)", 0))
-        print_time_hours = parse_time_string(time_str)
-        mat_cost = (filament_data.get('price', 0) / 1000) * filament_g * filament_data.get('efficiency_factor', 1.0)
-        labour_cogs = (labour_rate_user / 60) * labour_time_min
-        printer_cogs = calculate_printer_hourly_rate(printer_data) * printer_data.get('buffer_factor', 1.0) * print_time_hours
-        total_cogs_user = mat_cost + labour_cogs + printer_cogs
-        mat_cost_default = (filament_data.get('price', 0) / 1000) * filament_g
-        labour_cogs_default = (100 / 60) * labour_time_min
-        printer_cogs_default = calculate_printer_hourly_rate(printer_data) * print_time_hours
-        total_cogs_default = mat_cost_default + labour_cogs_default + printer_cogs_default
-        return {"user_cogs": total_cogs_user, "default_cogs": total_cogs_default}
-    except (ValueError, TypeError, KeyError, ZeroDivisionError): return {"user_cogs": 0.0, "default_cogs": 0.0}
-
 def extract_data_from_ocr(company_id, ocr_results):
     """Parses raw OCR text to extract structured print data with improved accuracy."""
     full_text = " ".join([item[1] for item in ocr_results]).lower()
@@ -646,7 +1305,9 @@ def extract_data_from_ocr(company_id, ocr_results):
         "filament": 0.0,
         "time_str": "0h 0m",
         "material": None,
-        "detected_printer_id": None
+        "detected_printer_id": None,
+        # Sent back with the job as "OCR Text" so it becomes searchable.
+        "ocr_text": " ".join(item[1] for item in ocr_results)
     }
 
     filament_g = 0.0
@@ -663,7 +1324,7 @@ def extract_data_from_ocr(company_id, ocr_results):
                 if numeric_values:
                     filament_g = round(max(numeric_values), 2)
             except (ValueError, TypeError):
-                print("Could not convert found filament values to numbers.")
+                logger.warning("Could not convert found filament values to numbers.")
                 filament_g = 0.0
 
     extracted_data["filament"] = filament_g
@@ -704,24 +1365,141 @@ def extract_data_from_ocr(company_id, ocr_results):
 
     return extracted_data
 
-def update_filament_stock(company_id, final_data):
-    try:
-        material, brand = final_data.get("Material"), final_data.get("Brand")
-        grams_used = float(final_data.get("Filament (g)", 0))
-        if not all([material, brand, grams_used > 0]): return
-        g.db.execute("UPDATE filaments SET stock_g = stock_g - ? WHERE company_id = ? AND material = ? AND brand = ?",
-                       (grams_used, company_id, material, brand))
-        g.db.commit()
-    except Exception as e:
-        g.db.rollback(); print(f"❌ Error updating stock for company {company_id}: {e}")
+def update_filament_stock(conn, company_id, final_data, job_id=None):
+    """Books the job's filament use in the stock ledger. Runs inside the caller's transaction."""
+    material, brand = final_data.get("Material"), final_data.get("Brand")
+    grams_used = float(final_data.get("Filament (g)", 0))
+    if not all([material, brand, grams_used > 0]): return
+    stock_ledger.record_movement(conn, company_id, material, brand, -grams_used, "job", job_id)
+
+def record_processed_job(conn, company_id, final_data, cogs, local_image_filename, image_blob, excel_path, source_name,
+                         excel_inputs=None):
+    """
+    Writes every database side effect of a processed job without committing:
+    stock decrement, image references, job record, analytics rollups, search
+    index entry, processed marker and the journal row that describes the file
+    outputs (JSON logs and, with `excel_inputs` = (printer, filament), the
+    job's workbook at `excel_path` and its master log row). The caller commits
+    once for the whole job, which also marks the journal rows of earlier jobs
+    applied (see `finalize_job_outputs`).
+    """
+    with _written_job_outputs_lock:
+        written = [(journal, row_id) for cid, journal, row_id in _written_job_outputs if cid == company_id]
+    for journal in OUTPUT_JOURNALS:
+        ids = [(row_id,) for table, row_id in written if table == journal]
+        if ids: conn.executemany(f"UPDATE {journal} SET applied = 1 WHERE id = ?", ids)
+    job_id = str(uuid.uuid4())
+    image_hash, _, image_size = image_blob
+    now = datetime.utcnow().isoformat()
+    time_str = final_data.get("Time (e.g. 7h 30m)", "0h 0m")
+    update_filament_stock(conn, company_id, final_data, job_id)
+    image_store.link_name(conn, company_id, local_image_filename, image_hash,
+                          os.path.splitext(local_image_filename)[1], image_size)
+    image_store.add_reference(conn, company_id, image_hash)
+    job = {
+        "id": job_id, "company_id": company_id, "filename": final_data["Filename"], "source_name": source_name,
+        "timestamp": final_data["timestamp"], "printer_id": final_data.get("printer_id"),
+        "printer_name": final_data.get("Printer"), "material": final_data.get("Material"), "brand": final_data.get("Brand"),
+        "filament_g": float(final_data.get("Filament (g)", 0)), "time_str": time_str, "time_h": parse_time_string(time_str),
+        "labour_time_min": float(final_data.get("Labour Time (min)", 0)),
+        "labour_rate_hr": float(final_data.get("Labour Rate (₹/hr)", 0)),
+        "filament_cost_kg": float(final_data.get("Filament Cost (₹/kg)", 0)),
+        "user_cogs": cogs['user_cogs'], "default_cogs": cogs['default_cogs'],
+        "image_path": local_image_filename, "image_hash": image_hash, "excel_path": excel_path,
+        "ocr_text": final_data.get("OCR Text") or final_data.get("ocr_text"), "created_at": now,
+    }
+    insert_row(conn, "jobs", job)
+    analytics.apply_job(conn, job)
+    job_search.index_job(conn, job)
+    conn.execute("INSERT OR REPLACE INTO processed_files (company_id, source_name, status, job_id) VALUES (?, ?, ?, ?)",
+                 (company_id, source_name, "completed", job_id))
+    payload = {"app_log": build_app_log_entry(job_id, final_data, cogs, local_image_filename, image_hash),
+               "processed": {source_name: "completed"}}
+    if excel_inputs:
+        printer, filament = excel_inputs
+        payload["excel"] = {"final_data": final_data, "printer": printer, "filament": filament,
+                            "user_cogs": cogs['user_cogs'], "default_cogs": cogs['default_cogs']}
+    conn.execute("INSERT INTO job_outputs (job_id, company_id, payload, created_at) VALUES (?, ?, ?, ?)",
+                 (job_id, company_id, json.dumps(payload), now))
+    return job_id
+
+def company_file_lock(company_id):
+    """Serializes read-modify-write of a company's JSON logs and master workbooks within this process."""
+    with _company_file_locks_guard:
+        return _company_file_locks.setdefault(company_id, threading.RLock())
+
+def finalize_job_outputs(conn, company_id=None):
+    """
+    Applies pending journal rows: per-job workbooks and their master log rows,
+    app_logs.json, processed_log.json and, for re-costed jobs, the monthly
+    master logs. Idempotent: workbooks are rewritten in place, master log
+    rows are keyed by file name and JSON entries by job id, so replaying a
+    row after a crash between the file writes and the bookkeeping commit
+    changes nothing. Returns False if some company's outputs failed; those
+    rows stay pending and are retried by the next call.
+
+    Written rows are not marked applied here: that would be a second commit
+    (and fsync) per job. They are remembered in memory and marked by the
+    company's next `record_processed_job` transaction; until then this
+    process skips them, and after a restart they are replayed harmlessly.
+    """
+    pending = []
+    for journal in OUTPUT_JOURNALS:
+        query = f"SELECT '{journal}' AS journal, id, company_id, payload FROM {journal} WHERE applied = 0"
+        params = ()
+        if company_id is not None:
+            query += " AND company_id = ?"; params = (company_id,)
+        pending += conn.execute(query + " ORDER BY id", params).fetchall()
+    pending_keys = {(row['company_id'], row['journal'], row['id']) for row in pending}
+    with _written_job_outputs_lock:
+        # Rows no longer pending were marked applied by a committed job.
+        _written_job_outputs.difference_update([key for key in _written_job_outputs
+                                                if (company_id is None or key[0] == company_id) and key not in pending_keys])
+    by_company, ok = {}, True
+    for row in pending:
+        by_company.setdefault(row['company_id'], []).append(row)
+    for cid, rows in by_company.items():
+        try:
+            with company_file_lock(cid):
+                with _written_job_outputs_lock:
+                    rows = [row for row in rows if (cid, row['journal'], row['id']) not in _written_job_outputs]
+                if not rows: continue
+                payloads = [json.loads(row['payload']) for row in rows]
+                for excel in (p["excel"] for p in payloads if "excel" in p):
+                    write_job_workbooks(cid, excel)
+                cogs_updates = {k: v for p in payloads for k, v in p.get("cogs_updates", {}).items()}
+                save_app_log(cid, [p["app_log"] for p in payloads if "app_log" in p], cogs_updates)
+                save_processed_log(cid, {k: v for p in payloads for k, v in p.get("processed", {}).items()})
+                if cogs_updates: update_master_log_cogs(cid, cogs_updates.values())
+                with _written_job_outputs_lock:
+                    _written_job_outputs.update((cid, row['journal'], row['id']) for row in rows)
+        except Exception as e:
+            logger.exception(f"❌ FAILED to finalize job outputs for company {cid}: {e}"); ok = False; continue
+        event_hub.publish(cid, "log", {"entries": [p["app_log"] for p in payloads if "app_log" in p],
+                                       "cogs_updates": list(cogs_updates.values())})
+    return ok
+
+def write_job_workbooks(company_id, excel):
+    """Writes a journaled job's workbook and its master log row; raises if either fails."""
+    final_data = excel["final_data"]
+    with metrics.timer("job_stage_duration_seconds", stage="create_excel"):
+        excel_path, msg = create_excel_file(company_id, final_data, excel["printer"], excel["filament"])
+    if not excel_path:
+        raise RuntimeError(f"Failed to create Excel log: {msg}")
+    with metrics.timer("job_stage_duration_seconds", stage="master_excel"):
+        success, msg = log_to_master_excel(company_id, excel_path, final_data, excel["user_cogs"], excel["default_cogs"])
+    if not success:
+        raise RuntimeError(f"Failed to update master log: {msg}")
+
+def excel_log_path(company_id, filename):
+    return get_company_data_path(company_id, "Excel_Logs", f"{filename}.xlsx")
 
 def create_excel_file(company_id, final_data, printer, filament):
     try:
-        template_path = APP_CONFIG.get("TEMPLATE_PATH", "FDM.xlsx")
+        template_path = get_config().get("TEMPLATE_PATH", "FDM.xlsx")
         if not os.path.exists(template_path): return None, f"Template '{template_path}' not found."
         wb = load_workbook(template_path)
-        excel_output_dir = get_company_data_path(company_id, "Excel_Logs"); os.makedirs(excel_output_dir, exist_ok=True)
-        new_path = os.path.join(excel_output_dir, f"{final_data['Filename']}.xlsx")
+        new_path = excel_log_path(company_id, final_data['Filename']); os.makedirs(os.path.dirname(new_path), exist_ok=True)
         calc_ws, adv_ws = wb["Calculation Sheet"], wb["Adv. Inputs"]
         calc_ws['D4'] = final_data["Filename"]; calc_ws['D6'] = datetime.fromisoformat(final_data["timestamp"])
         calc_ws['D7'] = "FabraForma"; calc_ws['D9'] = final_data["Material"]
@@ -738,13 +1516,13 @@ def create_excel_file(company_id, final_data, printer, filament):
         wb.save(new_path)
         return new_path, "Success"
     except Exception as e:
-        traceback.print_exc(); return None, f"Error in create_excel_file: {e}"
+        logger.exception("create_excel_file failed"); return None, f"Error in create_excel_file: {e}"
 
 def log_to_master_excel(company_id, file_path, final_data, user_cogs, default_cogs):
     try:
         source_wb = load_workbook(file_path, data_only=True); calc_ws = source_wb["Calculation Sheet"]
         date_val = calc_ws["D6"].value or datetime.now()
-        config = load_app_config()
+        config = get_config()
         values = [calc_ws[cell].value for cell in config["cells"]]
         p_num = os.path.splitext(os.path.basename(file_path))[0]
         new_row = [None, date_val, p_num] + values + [user_cogs, default_cogs, f'=HYPERLINK("{os.path.abspath(file_path)}", "Source File")']
@@ -752,161 +1530,149 @@ def log_to_master_excel(company_id, file_path, final_data, user_cogs, default_co
         ym_folder = get_company_data_path(company_id, "Monthly_Expenditure", f"{date_val.year}_{month_name}")
         os.makedirs(ym_folder, exist_ok=True)
         master_path = os.path.join(ym_folder, f"master_log_{month_name}.xlsx")
-        if os.path.exists(master_path):
-            master_wb = load_workbook(master_path); master_ws = master_wb.active
-            for row_idx in range(master_ws.max_row, 1, -1):
-                if master_ws.cell(row=row_idx, column=2).value == "TOTALS": master_ws.delete_rows(row_idx); break
-            all_rows = [list(row) for row in master_ws.iter_rows(min_row=2, values_only=True) if row and row[2] != p_num]
-        else:
-            master_wb = Workbook(); master_ws = master_wb.active; master_ws.title = "DataLog"
-            master_ws.append(config["headers"]); all_rows = []
-        all_rows.append(new_row)
-        all_rows.sort(key=lambda row: (row[1] if isinstance(row[1], datetime) else datetime.min, str(row[2])))
-        if master_ws.max_row > 1: master_ws.delete_rows(2, master_ws.max_row)
-        for idx, row_data in enumerate(all_rows, start=1):
-            row_data[0] = idx
-            if isinstance(row_data[1], datetime): row_data[1] = row_data[1].strftime("%Y-%m-%d %H:%M:%S")
-            master_ws.append(row_data)
-        last_row = master_ws.max_row; totals_row_idx = last_row + 1
-        master_ws.cell(row=totals_row_idx, column=2, value="TOTALS").font = Font(bold=True)
-        cols_to_sum = ["Filament (g)", "Time (h)", "Labour Time (min)", "User COGS (₹)", "Default COGS (₹)"]
-        header_row = [cell.value for cell in master_ws[1]]
-        for col_name in cols_to_sum:
-            try:
-                col_idx = header_row.index(col_name) + 1
-                formula = f"=SUM({get_column_letter(col_idx)}2:{get_column_letter(col_idx)}{last_row})"
-                master_ws.cell(row=totals_row_idx, column=col_idx, value=formula).font = Font(bold=True)
-            except ValueError: print(f"⚠️ Master log missing header '{col_name}'.")
-        master_wb.save(master_path)
+        # Concurrent jobs in the same month would otherwise read and rewrite the workbook at the same time.
+        with company_file_lock(company_id):
+            if os.path.exists(master_path):
+                master_wb = load_workbook(master_path); master_ws = master_wb.active
+                for row_idx in range(master_ws.max_row, 1, -1):
+                    if master_ws.cell(row=row_idx, column=2).value == "TOTALS": master_ws.delete_rows(row_idx); break
+                all_rows = [list(row) for row in master_ws.iter_rows(min_row=2, values_only=True) if row and row[2] != p_num]
+            else:
+                master_wb = Workbook(); master_ws = master_wb.active; master_ws.title = "DataLog"
+                master_ws.append(config["headers"]); all_rows = []
+            all_rows.append(new_row)
+            all_rows.sort(key=lambda row: (row[1] if isinstance(row[1], datetime) else datetime.min, str(row[2])))
+            if master_ws.max_row > 1: master_ws.delete_rows(2, master_ws.max_row)
+            for idx, row_data in enumerate(all_rows, start=1):
+                row_data[0] = idx
+                if isinstance(row_data[1], datetime): row_data[1] = row_data[1].strftime("%Y-%m-%d %H:%M:%S")
+                master_ws.append(row_data)
+            last_row = master_ws.max_row; totals_row_idx = last_row + 1
+            master_ws.cell(row=totals_row_idx, column=2, value="TOTALS").font = Font(bold=True)
+            cols_to_sum = ["Filament (g)", "Time (h)", "Labour Time (min)", "User COGS (₹)", "Default COGS (₹)"]
+            header_row = [cell.value for cell in master_ws[1]]
+            for col_name in cols_to_sum:
+                try:
+                    col_idx = header_row.index(col_name) + 1
+                    formula = f"=SUM({get_column_letter(col_idx)}2:{get_column_letter(col_idx)}{last_row})"
+                    master_ws.cell(row=totals_row_idx, column=col_idx, value=formula).font = Font(bold=True)
+                except ValueError: logger.warning(f"⚠️ Master log missing header '{col_name}'.")
+            master_wb.save(master_path)
         return True, f"Logged to master: {os.path.basename(file_path)}"
     except Exception as e:
-        traceback.print_exc(); return False, f"Error in log_to_master_excel: {e}"
-
-def save_app_log(company_id, final_data, cogs_data, local_image_filename):
-    log_path = get_company_data_path(company_id, "app_logs.json")
+        logger.exception("log_to_master_excel failed"); return False, f"Error in log_to_master_excel: {e}"
+
+def build_app_log_entry(job_id, final_data, cogs_data, local_image_filename, image_hash):
+    return {
+        "job_id": job_id, "timestamp": final_data["timestamp"], "filename": final_data["Filename"],
+        "image_path": local_image_filename, "image_hash": image_hash,
+        "data": { "Printer": final_data["Printer"], "Material": final_data["Material"], "Brand": final_data["Brand"],
+                  "Filament (g)": final_data["Filament (g)"], "Time": final_data["Time (e.g. 7h 30m)"],
+                  "User COGS (₹)": f"{cogs_data['user_cogs']:.2f}", "Default COGS (₹)": f"{cogs_data['default_cogs']:.2f}" }}
+
+def write_json_atomic(path, data, indent):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
     try:
-        logs = []
-        if os.path.exists(log_path):
-            with open(log_path, 'r') as f: content = f.read(); logs = json.loads(content) if content else []
-        log_entry = {
-            "timestamp": final_data["timestamp"], "filename": final_data["Filename"], "image_path": local_image_filename,
-            "data": { "Printer": final_data["Printer"], "Material": final_data["Material"], "Brand": final_data["Brand"],
-                      "Filament (g)": final_data["Filament (g)"], "Time": final_data["Time (e.g. 7h 30m)"],
-                      "User COGS (₹)": f"{cogs_data['user_cogs']:.2f}", "Default COGS (₹)": f"{cogs_data['default_cogs']:.2f}" }}
-        logs.append(log_entry); logs.sort(key=lambda x: x['timestamp'], reverse=True)
-        with open(log_path, 'w') as f: json.dump(logs, f, indent=4)
-    except Exception as e: print(f"❌ FAILED to save app log for company {company_id}: {e}")
-
-def generate_quotation_pdf(buffer, data):
-    """
-    Generates a quotation PDF and writes it to an in-memory buffer.
-    
-    Args:
-        buffer (BytesIO): The in-memory buffer to write the PDF to.
-        data (dict): The quotation data from the client.
-    """
-    c = canvas.Canvas(buffer, pagesize=letter)
-    width, height = letter
-
-    # --- Company Details & Logo ---
-    comp_details = data.get("company_details", {})
-    if comp_details.get("logo_path") and os.path.exists(comp_details["logo_path"]):
+        with open(tmp_path, 'w') as f: json.dump(data, f, indent=indent)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        raise
+
+def update_master_log_cogs(company_id, updates):
+    """Rewrites the COGS cells of re-costed jobs in their monthly master logs, loading each workbook once."""
+    by_month = {}
+    for update in updates:
+        date_val = datetime.fromisoformat(update["timestamp"])
+        by_month.setdefault((date_val.year, date_val.strftime("%B")), {})[update["filename"]] = update
+    for (year, month_name), month_updates in by_month.items():
+        master_path = get_company_data_path(company_id, "Monthly_Expenditure", f"{year}_{month_name}", f"master_log_{month_name}.xlsx")
+        if not os.path.exists(master_path): continue
+        master_wb = load_workbook(master_path); master_ws = master_wb.active
+        header_row = [cell.value for cell in master_ws[1]]
         try:
-            img = utils.ImageReader(comp_details["logo_path"])
-            # Draw logo, maintaining aspect ratio
-            i_width, i_height = img.getSize()
-            aspect = i_height / float(i_width)
-            c.drawImage(img, 40, height - 100, width=80, height=(80 * aspect))
-        except Exception as e:
-            print(f"Could not draw logo on PDF: {e}")
-
-    c.setFont("Helvetica-Bold", 16)
-    c.drawRightString(width - 50, height - 60, comp_details.get("name", "Your Company"))
-    c.setFont("Helvetica", 10)
-    c.drawRightString(width - 50, height - 75, comp_details.get("address", "Company Address"))
-    c.drawRightString(width - 50, height - 90, comp_details.get("contact", "Contact Info"))
-
-    # --- Document Title ---
-    c.setFont("Helvetica-Bold", 24)
-    c.drawString(50, height - 150, "Quotation")
-    c.line(50, height - 155, width - 50, height - 155)
-
-    # --- Customer and Date Info ---
-    c.setFont("Helvetica-Bold", 12)
-    c.drawString(50, height - 190, "BILLED TO:")
-    c.setFont("Helvetica", 12)
-    c.drawString(50, height - 205, data.get("customer_name", "Valued Customer"))
-    if data.get("customer_company"):
-        c.drawString(50, height - 220, data.get("customer_company"))
-    
-    c.setFont("Helvetica", 12)
-    c.drawRightString(width - 50, height - 190, f"Date: {datetime.now().strftime('%Y-%m-%d')}")
-    # You could add a unique quote number here if needed
-    # c.drawRightString(width - 50, height - 205, f"Quote #: {str(uuid.uuid4())[:8].upper()}")
-
-    # --- Table Header ---
-    y_position = height - 260
-    c.setFont("Helvetica-Bold", 11)
-    c.drawString(60, y_position, "Part Description")
-    c.drawRightString(width - 200, y_position, "Unit Price")
-    c.drawRightString(width - 50, y_position, "Total")
-    c.line(50, y_position - 10, width - 50, y_position - 10)
-    y_position -= 30
-
-    # --- Pricing Calculations ---
-    total_cogs = sum(part.get("cogs", 0) for part in data["parts"])
-    margin_percent = data.get("margin_percent", 0)
-    subtotal = total_cogs / (1 - (margin_percent / 100.0)) if margin_percent < 100 else 0
-    tax_rate_percent = data.get("tax_rate_percent", 0)
-    tax_amount = subtotal * (tax_rate_percent / 100.0)
-    grand_total = subtotal + tax_amount
-    
-    # --- Table Items ---
-    c.setFont("Helvetica", 10)
-    # For this simple quote, we'll list the parts as a single line item.
-    # A more complex system would loop through `data["parts"]`.
-    line_item_description = f"{len(data['parts'])} Custom Manufactured Part(s)"
-    c.drawString(60, y_position, line_item_description)
-    c.drawRightString(width - 200, y_position, f"Rs{subtotal:,.2f}")
-    c.drawRightString(width - 50, y_position, f"Rs{subtotal:,.2f}")
-    y_position -= 30
-
-    # --- Totals Section ---
-    c.line(width - 250, y_position, width - 50, y_position)
-    y_position -= 20
-    c.setFont("Helvetica", 11)
-    c.drawRightString(width - 200, y_position, "Subtotal:")
-    c.drawRightString(width - 50, y_position, f"Rs{subtotal:,.2f}")
-    y_position -= 20
-    c.drawRightString(width - 200, y_position, f"Tax ({tax_rate_percent}%):")
-    c.drawRightString(width - 50, y_position, f"Rs{tax_amount:,.2f}")
-    y_position -= 20
-    c.setFont("Helvetica-Bold", 12)
-    c.drawRightString(width - 200, y_position, "Grand Total:")
-    c.drawRightString(width - 50, y_position, f"Rs{grand_total:,.2f}")
-    
-    # --- Footer/Terms ---
-    c.setFont("Helvetica-Oblique", 9)
-    c.drawString(50, 50, "Thank you for your business! Prices are valid for 30 days.")
-
-    c.showPage()
-    c.save()
+            user_col, default_col = header_row.index("User COGS (₹)") + 1, header_row.index("Default COGS (₹)") + 1
+        except ValueError:
+            logger.warning(f"⚠️ Master log {master_path} missing COGS headers; skipping re-cost update."); continue
+        dirty = False
+        for row_idx in range(2, master_ws.max_row + 1):
+            update = month_updates.get(master_ws.cell(row=row_idx, column=3).value)
+            if not update: continue
+            master_ws.cell(row=row_idx, column=user_col, value=update["user_cogs"])
+            master_ws.cell(row=row_idx, column=default_col, value=update["default_cogs"])
+            dirty = True
+        if dirty: master_wb.save(master_path)
+
+def save_app_log(company_id, log_entries, cogs_updates=None):
+    log_path = get_company_data_path(company_id, "app_logs.json")
+    logs = []
+    if os.path.exists(log_path):
+        with open(log_path, 'r') as f: content = f.read(); logs = json.loads(content) if content else []
+    known_ids = {entry.get("job_id") for entry in logs}
+    new_entries = [entry for entry in log_entries if entry["job_id"] not in known_ids]
+    changed = bool(new_entries)
+    if cogs_updates:
+        # Legacy entries carry no job id; fall back to filename + timestamp.
+        by_key = {(u["filename"], u["timestamp"]): u for u in cogs_updates.values()}
+        for entry in logs:
+            update = cogs_updates.get(entry.get("job_id")) or by_key.get((entry.get("filename"), entry.get("timestamp")))
+            if not update: continue
+            values = {"User COGS (₹)": f"{update['user_cogs']:.2f}", "Default COGS (₹)": f"{update['default_cogs']:.2f}"}
+            if any(entry["data"].get(k) != v for k, v in values.items()):
+                entry["data"].update(values); changed = True
+    if not changed: return
+    logs.extend(new_entries); logs.sort(key=lambda x: x['timestamp'], reverse=True)
+    write_json_atomic(log_path, logs, indent=4)
+
+def save_processed_log(company_id, markers):
+    processed_log_path = get_company_data_path(company_id, "processed_log.json")
+    processed_log = {}
+    if os.path.exists(processed_log_path):
+        with open(processed_log_path, 'r') as f: processed_log = json.load(f)
+    if all(processed_log.get(k) == v for k, v in markers.items()): return
+    processed_log.update(markers)
+    write_json_atomic(processed_log_path, processed_log, indent=2)
 
 # --- APP INITIALIZATION ---
 
+def archive_all_companies():
+    directory = get_db_connection()
+    try: company_ids = [row['id'] for row in directory.execute("SELECT id FROM companies")]
+    finally: directory.close()
+    for cid in company_ids:
+        conn = get_company_db_connection(cid)
+        try:
+            stats = archival.run(conn, cid, get_company_data_path(cid), config_store.current(), company_file_lock(cid))
+            logger.info(f"Archival for company {cid}: {stats}")
+        except Exception:
+            logger.exception(f"Archival failed for company {cid}")
+        finally:
+            conn.close()
+
 def initialize_app():
-    global APP_CONFIG
-    APP_CONFIG = load_app_config()
-    defaults = { "SERVER_SHARE_DIR": "server_share", "TEMPLATE_PATH": "FDM.xlsx", "cells": ["D4", "D9", "D10", "D11", "D12", "D13"],
-                 "headers": ["Sr. No", "Date", "Part Number", "Filename", "Material", "Filament Cost (₹/kg)", "Filament (g)", "Time (h)", "Labour Time (min)", "User COGS (₹)", "Default COGS (₹)", "Source Link"] }
-    app.config['SECRET_KEY'] = APP_CONFIG.get('SECRET_KEY', 'a_default_super_secret_key_that_should_be_changed')
-    if any(key not in APP_CONFIG for key in defaults.keys()):
-        APP_CONFIG = {**defaults, **APP_CONFIG}
-        save_app_config(APP_CONFIG)
+    config_error = None
+    try: config_store.load()
+    except app_config.ConfigError as e: config_error = e
+    apply_config(None, config_store.current())
+    if config_error:
+        logger.critical(f"🛑 {config_error} Falling back to default settings; fix the file or save valid settings.")
+    elif not os.path.exists(config_store.path):
+        config_store.save(app_config.thaw(config_store.current()))
+    config_store.on_change(apply_config)
+    config_store.watch()
     os.makedirs(os.path.join(SCRIPT_DIR, "data"), exist_ok=True)
-    os.makedirs(APP_CONFIG["SERVER_SHARE_DIR"], exist_ok=True)
     with app.app_context():
         init_db(SCRIPT_DIR)
+    for _, conn in iter_company_connections():
+        # Seed the stock ledger for filaments that predate it.
+        stock_ledger.ensure_opening_balances(conn); conn.commit()
+        recosting.mark_interrupted(conn)
+        # Replay file outputs of jobs that committed but did not finish finalizing.
+        finalize_job_outputs(conn)
+        # Jobs created outside processing (legacy imports) or in a freshly split shard.
+        if job_search.sync_index(conn): conn.commit()
+    file_share.collect_stale_uploads(get_share_dir())
+    archival.schedule(lambda: config_store.current().get("ARCHIVE_INTERVAL_HOURS", DEFAULT_ARCHIVE_INTERVAL_HOURS), archive_all_companies)
     return True
 
 initialize_app()
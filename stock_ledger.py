@@ -0,0 +1,85 @@
+# stock_ledger.py
+"""
+Append-only filament stock ledger.
+
+Every change to `filaments.stock_g` goes through `record_movement`, which
+updates the materialized balance and appends a `stock_movements` row in the
+caller's transaction. Burn rates are computed from index range scans over
+recent windows of the ledger rather than from the whole history.
+"""
+from datetime import datetime, timedelta
+
+FORECAST_WINDOWS_DAYS = (7, 30)
+
+def _now():
+    return datetime.utcnow().isoformat()
+
+def record_movement(conn, company_id, material, brand, delta_g, reason, job_id=None):
+    """Applies a stock change and logs it. Returns the new balance, or None if the spool type is unknown."""
+    cur = conn.execute("UPDATE filaments SET stock_g = COALESCE(stock_g, 0) + ? WHERE company_id = ? AND material = ? AND brand = ?",
+                       (delta_g, company_id, material, brand))
+    if cur.rowcount == 0:
+        return None
+    balance = conn.execute("SELECT stock_g FROM filaments WHERE company_id = ? AND material = ? AND brand = ?",
+                           (company_id, material, brand)).fetchone()['stock_g']
+    conn.execute("""
+        INSERT INTO stock_movements (company_id, material, brand, delta_g, balance_after, reason, job_id, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)""", (company_id, material, brand, delta_g, balance, reason, job_id, _now()))
+    return balance
+
+def set_balance(conn, company_id, material, brand, new_stock_g, reason="adjustment"):
+    """Moves the balance to an absolute value (e.g. after a stocktake) as a single adjustment movement."""
+    row = conn.execute("SELECT stock_g FROM filaments WHERE company_id = ? AND material = ? AND brand = ?",
+                       (company_id, material, brand)).fetchone()
+    if row is None:
+        return None
+    delta = float(new_stock_g) - (row['stock_g'] or 0)
+    if delta == 0:
+        return row['stock_g']
+    return record_movement(conn, company_id, material, brand, delta, reason)
+
+def ensure_opening_balances(conn):
+    """Gives every filament without ledger history an 'opening' movement equal to its current stock."""
+    rows = conn.execute("""
+        SELECT f.company_id, f.material, f.brand, f.stock_g FROM filaments f
+        WHERE NOT EXISTS (SELECT 1 FROM stock_movements m
+                          WHERE m.company_id = f.company_id AND m.material = f.material AND m.brand = f.brand)""").fetchall()
+    now = _now()
+    conn.executemany("""
+        INSERT INTO stock_movements (company_id, material, brand, delta_g, balance_after, reason, job_id, created_at)
+        VALUES (?, ?, ?, ?, ?, 'opening', NULL, ?)""",
+        [(r['company_id'], r['material'], r['brand'], r['stock_g'] or 0, r['stock_g'] or 0, now) for r in rows])
+    return len(rows)
+
+def list_movements(conn, company_id, material=None, brand=None, limit=100, before=None):
+    where, params = ["company_id = ?"], [company_id]
+    if material: where.append("material = ?"); params.append(material)
+    if brand: where.append("brand = ?"); params.append(brand)
+    if before: where.append("id < ?"); params.append(before)
+    sql = f"SELECT * FROM stock_movements WHERE {' AND '.join(where)} ORDER BY id DESC LIMIT ?"
+    return [dict(row) for row in conn.execute(sql, params + [limit])]
+
+def consumption_forecast(conn, company_id, windows_days=FORECAST_WINDOWS_DAYS):
+    """
+    Burn rate (g/day) per spool type over each window, and days until the
+    current balance runs out at the longest window's rate.
+    """
+    now = datetime.utcnow()
+    filaments = conn.execute("SELECT material, brand, stock_g FROM filaments WHERE company_id = ? ORDER BY material, brand",
+                             (company_id,)).fetchall()
+    forecast = []
+    for f in filaments:
+        entry = {"material": f['material'], "brand": f['brand'], "stock_g": f['stock_g'], "burn_rate_g_per_day": {}}
+        for days in windows_days:
+            since = (now - timedelta(days=days)).isoformat()
+            # Range scan on idx_stock_movements_lookup (company, material, brand, created_at).
+            used = conn.execute("""
+                SELECT COALESCE(SUM(-delta_g), 0) AS used FROM stock_movements
+                WHERE company_id = ? AND material = ? AND brand = ? AND created_at >= ? AND reason = 'job'""",
+                (company_id, f['material'], f['brand'], since)).fetchone()['used']
+            entry["burn_rate_g_per_day"][str(days)] = used / days
+        rate = entry["burn_rate_g_per_day"][str(max(windows_days))]
+        stock = f['stock_g'] or 0
+        entry["days_until_empty"] = (max(stock, 0) / rate) if rate > 0 else None
+        forecast.append(entry)
+    return forecast
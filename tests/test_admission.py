@@ -0,0 +1,41 @@
+# tests/test_admission.py
+import os
+import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import admission
+
+WORKER_THREADS = 4
+
+def test_upload_storm_leaves_a_worker_for_cheap_requests():
+    controller = admission.AdmissionController()
+    limits = {name: {"max_queue": 8, "queue_timeout": 30} for name in ("ocr", "process")}
+    controller.configure(WORKER_THREADS, 1, limits)
+    release = threading.Event()
+    outcomes = []
+
+    def expensive(endpoint_class, company):
+        try:
+            with controller.admit(endpoint_class, company):
+                release.wait(30)
+            outcomes.append("ok")
+        except admission.Rejected as e:
+            outcomes.append((e.status, e.reason))
+
+    # A waitress-like pool: requests take a worker thread in arrival order.
+    with ThreadPoolExecutor(WORKER_THREADS) as workers:
+        for i in range(20):
+            workers.submit(expensive, "ocr" if i % 2 else "process", f"company{i % 3}")
+        try:
+            started = time.monotonic()
+            cheap = workers.submit(lambda: "catalog")
+            assert cheap.result(timeout=5) == "catalog"
+            assert time.monotonic() - started < 5
+            snapshot = controller.snapshot()
+            assert snapshot["in_flight"] + snapshot["queued"] <= WORKER_THREADS - 1
+        finally:
+            release.set()
+    assert (503, "thread_budget") in outcomes
@@ -0,0 +1,21 @@
+# tests/test_quotations.py
+import os
+import sys
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import validators
+import quotations
+
+def test_quotation_without_names_prints_the_placeholders(monkeypatch):
+    drawn = []
+    for method in ("drawString", "drawRightString"):
+        original = getattr(quotations.canvas.Canvas, method)
+        monkeypatch.setattr(quotations.canvas.Canvas, method,
+                            lambda self, x, y, text, *a, _original=original, **k: (drawn.append(text), _original(self, x, y, text, *a, **k))[1])
+    data = validators.validate_payload(validators.GenerateQuotationModel, {
+        "customer_name": "Jane", "parts": [{"cogs": 100}, {"name": "Bracket", "cogs": 50}],
+        "margin_percent": 20, "itemized": True, "company_details": {"address": "1 Main St"}})
+    quotations.generate_quotation_pdf(BytesIO(), data)
+    for text in ("Your Company", "1 Main St", "Contact Info", "Part 1", "Bracket"):
+        assert text in drawn
@@ -0,0 +1,47 @@
+# tests/test_recosting.py
+import os
+import sys
+import json
+import math
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import database
+import analytics
+import recosting
+
+COMPANY = "acme"
+
+def test_recost_covers_jobs_imported_from_legacy_logs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    database.init_db(str(tmp_path))
+    conn = database.get_db_connection()
+    conn.execute("INSERT INTO companies (id, name) VALUES (?, ?)", (COMPANY, COMPANY))
+    conn.execute("""INSERT INTO printers (id, company_id, brand, model, setup_cost, maintenance_cost, lifetime_years, power_w, price_kwh, buffer_factor, uptime_percent)
+                    VALUES ('p1', ?, 'Bambu', 'P1S', 60000, 5000, 3, 350, 8, 1.0, 50)""", (COMPANY,))
+    conn.execute("INSERT INTO filaments (company_id, material, brand, price, stock_g, efficiency_factor) VALUES (?, 'PLA', 'Generic', 1200, 1000, 1.0)", (COMPANY,))
+    company_dir = tmp_path / "data" / COMPANY
+    company_dir.mkdir(parents=True)
+    (company_dir / "app_logs.json").write_text(json.dumps([{
+        "filename": "bracket", "timestamp": "2024-03-04T10:00:00", "image_path": "bracket.png",
+        "data": {"Printer": "P1S", "Material": "PLA", "Brand": "Generic", "Filament (g)": 50, "Time": "2h 0m",
+                 "User COGS (₹)": "10.00", "Default COGS (₹)": "10.00"}}]))
+    assert analytics.import_legacy_app_logs(conn, COMPANY, str(company_dir)) == 1
+    # Databases imported before labour_rate_hr was written explicitly hold NULL there.
+    conn.execute("UPDATE jobs SET labour_rate_hr = NULL WHERE company_id = ?", (COMPANY,))
+    analytics.rebuild_rollups(conn, COMPANY)
+    conn.commit()
+
+    run_id = recosting.start_run(conn, COMPANY, {"printer_ids": None, "filaments": None, "since": None})
+    recosting.run(conn, run_id, COMPANY, {"printer_ids": None, "filaments": None, "since": None})
+
+    run = recosting.get_run(conn, COMPANY, run_id)
+    assert run['status'] == 'completed', run['error']
+    assert run['changed'] == 1
+    job = conn.execute("SELECT user_cogs, default_cogs FROM jobs WHERE company_id = ?", (COMPANY,)).fetchone()
+    assert math.isfinite(job['user_cogs']) and job['user_cogs'] > 0
+    assert math.isfinite(job['default_cogs']) and job['default_cogs'] > 0
+    # The COGS updates are journaled under the run, not as a job.
+    assert [row['run_id'] for row in conn.execute("SELECT run_id FROM recost_outputs WHERE applied = 0")] == [run_id]
+    assert conn.execute("SELECT COUNT(*) FROM job_outputs WHERE job_id = ?", (run_id,)).fetchone()[0] == 0
+    assert conn.execute("PRAGMA foreign_key_check(job_outputs)").fetchall() == []
+    conn.close()
@@ -1,5 +1,8 @@
-from pydantic import BaseModel, EmailStr, Field, validator
-from typing import List, Optional, Dict
+import re
+from datetime import datetime
+from functools import lru_cache
+from pydantic import BaseModel, EmailStr, Field, TypeAdapter, ValidationError, validator
+from typing import Any, List, Literal, Optional, Dict, Union
 
 # --- AUTHENTICATION & USER MANAGEMENT ---
 
@@ -8,6 +11,9 @@ class LoginModel(BaseModel):
     password: str
     remember_me: bool = False
 
+class RememberTokenModel(BaseModel):
+    remember_token: Optional[str] = None
+
 class RegisterCompanyModel(BaseModel):
     company_name: str = Field(..., min_length=1)
     admin_username: str = Field(..., min_length=3)
@@ -38,7 +44,7 @@ class UpdateProfileModel(BaseModel):
 # --- DATA MANAGEMENT ---
 
 class PrinterModel(BaseModel):
-    id: str
+    id: str = Field(..., min_length=1)
     brand: str = Field(..., min_length=1)
     model: str = Field(..., min_length=1)
     setup_cost: float = Field(..., ge=0)
@@ -46,16 +52,29 @@ class PrinterModel(BaseModel):
     lifetime_years: int = Field(..., ge=1)
     power_w: float = Field(..., ge=0)
     price_kwh: float = Field(..., ge=0)
-    buffer_factor: float = Field(..., ge=1.0)
-    uptime_percent: float = Field(..., ge=0, le=100)
+    buffer_factor: float = Field(1.0, ge=1.0)
+    uptime_percent: float = Field(50, ge=0, le=100)
 
 class FilamentsPostModel(BaseModel):
     price: float = Field(..., ge=0)
     stock_g: float = Field(..., ge=0)
     efficiency_factor: float = Field(..., gt=0)
 
+PrinterListModel = List[PrinterModel]
+FilamentCatalogModel = Dict[str, Dict[str, FilamentsPostModel]]
+
+class FilamentRefModel(BaseModel):
+    material: str = Field(..., min_length=1)
+    brand: str = Field(..., min_length=1)
+
 # --- CORE LOGIC ---
 
+def _check_iso_timestamp(v):
+    if v is not None:
+        try: datetime.fromisoformat(v)
+        except ValueError: raise ValueError(f"'{v}' is not an ISO 8601 timestamp")
+    return v
+
 class ProcessImageModel(BaseModel):
     filename: str = Field(..., min_length=1, alias='Filename')
     filament_g: float = Field(..., ge=0, alias='Filament (g)')
@@ -66,27 +85,175 @@ class ProcessImageModel(BaseModel):
     material: str = Field(..., alias='Material')
     brand: str = Field(..., alias='Brand')
     filament_cost_kg: float = Field(..., ge=0, alias='Filament Cost (₹/kg)')
-    labour_time_min: int = Field(..., ge=0, alias='Labour Time (min)')
-    labour_rate_hr: float = Field(..., ge=0, alias='Labour Rate (₹/hr)')
+    labour_time_min: float = Field(..., ge=0, alias='Labour Time (min)')
+    labour_rate_hr: float = Field(100, ge=0, alias='Labour Rate (₹/hr)')
+    ocr_text: Optional[str] = Field(None, max_length=20000, alias='OCR Text')
 
     class Config:
-        allow_population_by_field_name = True
+        populate_by_name = True
 
+    @validator('filename')
+    def filename_must_be_a_plain_name(cls, v):
+        # Used as-is for the image, Excel and master log file names.
+        if v.strip() in ('.', '..') or any(ch in v for ch in '/\\:*?"<>|\0'):
+            raise ValueError("Filename must not contain path separators or reserved characters")
+        return v
+
+    _timestamp_is_iso = validator('timestamp', allow_reuse=True)(_check_iso_timestamp)
+
+# Omitted names and details stay None so quotations.py prints its placeholders.
 class QuotationPartModel(BaseModel):
-    name: str
-    cogs: float = Field(..., ge=0)
+    name: Optional[str] = None
+    cogs: Optional[float] = Field(None, ge=0)
 
 class CompanyDetailsModel(BaseModel):
-    name: str
-    address: str
-    contact: str
+    name: Optional[str] = None
+    address: Optional[str] = None
+    contact: Optional[str] = None
     logo_path: Optional[str] = None
 
 class GenerateQuotationModel(BaseModel):
-    customer_name: str = Field(..., min_length=1)
+    customer_name: str = Field('Valued Customer', min_length=1)
     customer_company: Optional[str] = None
     parts: List[QuotationPartModel]
-    margin_percent: float = Field(..., ge=0)
-    tax_rate_percent: float = Field(..., ge=0)
-    company_details: CompanyDetailsModel
+    margin_percent: float = Field(0, ge=0)
+    tax_rate_percent: float = Field(0, ge=0)
+    company_details: Optional[CompanyDetailsModel] = None  # Batch quotes without their own use the batch's.
+    itemized: bool = False
+
+class BatchQuotationModel(BaseModel):
+    quotes: List[GenerateQuotationModel] = Field(..., min_length=1)
+    format: Literal['zip', 'pdf'] = 'zip'
+    company_details: Optional[CompanyDetailsModel] = None
+
+class BatchCostingModel(BaseModel):
+    jobs: Optional[List[Dict[str, Any]]] = None
+    job_ids: Optional[List[str]] = None
+    printers: Optional[List[Union[str, Dict[str, Any]]]] = None
+    filaments: Optional[List[Dict[str, Any]]] = None
+    labour_rates: Optional[List[float]] = Field(None, min_length=1)
+    margin_percents: List[float] = []
+    output: Literal['matrix', 'aggregate'] = 'aggregate'
+
+class RecostModel(BaseModel):
+    printer_ids: Optional[List[str]] = None
+    filaments: Optional[List[FilamentRefModel]] = None
+    since: Optional[str] = None
+
+    _since_is_iso = validator('since', allow_reuse=True)(_check_iso_timestamp)
+
+# --- FILE SHARE ---
+
+class UploadInitModel(BaseModel):
+    path: str = ''
+    filename: str = Field(..., min_length=1)
+    size: int = Field(..., ge=0)
+    sha256: Optional[str] = Field(None, pattern=r'^[0-9a-fA-F]{64}$')
+
+class UploadCompleteModel(BaseModel):
+    sha256: Optional[str] = Field(None, pattern=r'^[0-9a-fA-F]{64}$')
+
+# --- REQUEST VALIDATION ---
+
+class PayloadError(ValueError):
+    """Invalid request payload; `errors` is a list of {"field", "message"} dicts."""
+    def __init__(self, message, errors=()):
+        super().__init__(message)
+        self.errors = list(errors)
 
+@lru_cache(maxsize=None)
+def get_validator(schema):
+    """Compiled validator for a model or type (e.g. List[PrinterModel]), built once per schema."""
+    return TypeAdapter(schema)
+
+def error_list(e):
+    return [{"field": ".".join(str(part) for part in error["loc"]), "message": error["msg"]} for error in e.errors()]
+
+def validate_payload(schema, data):
+    """
+    Validates `data` against `schema` and returns it as plain JSON-style data:
+    values coerced, defaults filled in and fields keyed by their aliases (so
+    ProcessImageModel accepts `filename` but handlers see "Filename").
+    Raises PayloadError.
+    """
+    try:
+        adapter = get_validator(schema)
+        return adapter.dump_python(adapter.validate_python(data), by_alias=True)
+    except ValidationError as e:
+        errors = error_list(e)
+        raise PayloadError("Invalid request: " + "; ".join(f"{err['field'] or 'body'}: {err['message']}" for err in errors), errors)
+
+# --- SERVER CONFIGURATION ---
+
+LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
+
+class AdmissionLimitModel(BaseModel):
+    max_concurrent: Optional[int] = Field(None, ge=1)
+    max_queue: Optional[int] = Field(None, ge=0)
+    queue_timeout: Optional[float] = Field(None, gt=0)
+    company_max_concurrent: Optional[int] = Field(None, ge=1)
+    company_max_queue: Optional[int] = Field(None, ge=0)
+
+    class Config:
+        extra = 'forbid'
+
+class ServerConfigModel(BaseModel):
+    SERVER_SHARE_DIR: str = Field('server_share', min_length=1)
+    TEMPLATE_PATH: str = Field('FDM.xlsx', min_length=1)
+    cells: List[str] = Field(..., min_length=1)
+    headers: List[str] = Field(..., min_length=1)
+    SECRET_KEY: Optional[str] = Field(None, min_length=1)
+    LOG_DIR: Optional[str] = Field(None, min_length=1)
+    LOG_LEVEL: Optional[str] = None
+    LOG_MAX_BYTES: Optional[int] = Field(None, ge=1024)
+    LOG_BACKUP_COUNT: Optional[int] = Field(None, ge=0)
+    PROFILE_DIR: Optional[str] = Field(None, min_length=1)
+    PROFILE_SAMPLE_RATE: Optional[float] = Field(None, ge=0, le=1)
+    PROFILE_SLOW_MS: Optional[float] = Field(None, ge=0)
+    PROFILE_MAX_FILES: Optional[int] = Field(None, ge=1)
+    OCR_SERVICE_ADDRESS: Optional[str] = None
+    OCR_SERVICE_AUTHKEY: Optional[str] = None
+    METRICS_TOKEN: Optional[str] = None
+    JSON_PROVIDER: Optional[str] = None
+    COMPRESSION_MIN_BYTES: Optional[int] = Field(None, ge=0)
+    CONFIG_RELOAD_INTERVAL: Optional[float] = Field(None, ge=0.5)
+    ADMISSION_WORKER_THREADS: Optional[int] = Field(None, ge=1)
+    ADMISSION_RESERVED_THREADS: Optional[int] = Field(None, ge=0)
+    ADMISSION_LIMITS: Optional[Dict[Literal['ocr', 'process', 'batch'], AdmissionLimitModel]] = None
+    ARCHIVE_INTERVAL_HOURS: Optional[float] = Field(None, ge=0)
+    ARCHIVE_IMAGE_AGE_DAYS: Optional[int] = Field(None, ge=0)
+    ARCHIVE_IMAGE_QUALITY: Optional[int] = Field(None, ge=1, le=100)
+    ARCHIVE_MONTH_GRACE_DAYS: Optional[int] = Field(None, ge=0)
+    EVENT_STREAM_HOST: Optional[str] = Field(None, min_length=1)
+    EVENT_STREAM_PORT: Optional[int] = Field(None, ge=0, le=65535)
+    EVENT_STREAM_PUBLIC_URL: Optional[str] = Field(None, pattern=r'^https?://')
+    EVENT_STREAM_RELAY_ADDRESS: Optional[str] = Field(None, min_length=1)
+
+    class Config:
+        extra = 'allow'  # Unknown keys are kept as-is for clients that store their own settings.
+
+    @validator('cells', each_item=True)
+    def cell_must_be_a_reference(cls, v):
+        if not re.fullmatch(r'[A-Z]{1,3}[1-9][0-9]{0,6}', v):
+            raise ValueError(f"'{v}' is not a cell reference like 'D4'")
+        return v
+
+    @validator('headers')
+    def headers_must_match_cells(cls, v, values):
+        # Master log rows are: Sr. No, Date, Part Number, <one column per cell>, User COGS, Default COGS, Source Link.
+        cells = values.get('cells')
+        if cells is not None and len(v) != len(cells) + 6:
+            raise ValueError(f"Expected {len(cells) + 6} headers for {len(cells)} cells, got {len(v)}")
+        return v
+
+    @validator('LOG_LEVEL')
+    def log_level_must_be_valid(cls, v):
+        if v is not None and v.upper() not in LOG_LEVELS:
+            raise ValueError(f"LOG_LEVEL must be one of {', '.join(LOG_LEVELS)}")
+        return v.upper() if v else v
+
+    @validator('JSON_PROVIDER')
+    def json_provider_must_be_valid(cls, v):
+        if v is not None and v not in ('orjson', 'stdlib'):
+            raise ValueError("JSON_PROVIDER must be 'orjson' or 'stdlib'")
+        return v